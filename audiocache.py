@@ -0,0 +1,121 @@
+"""Content-addressed on-disk cache for synthesized Polly audio.
+
+Captions repeat heavily across images and devices, so audio is stored under
+a hash of everything that determines the synthesized bytes. The cache keeps
+an in-memory index of the files in least-recently-used order and evicts the
+oldest entries once the directory grows past its byte budget.
+"""
+
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from threading import Lock
+
+
+def normalize_text(text):
+    """Collapse the whitespace differences that do not change the speech."""
+    return ' '.join(text.split())
+
+
+def cache_key(voice, output_format, text, sample_rate=None):
+    """Return the cache key for a synthesis request."""
+    parts = (voice, output_format, normalize_text(text))
+    if sample_rate is not None:
+        parts += (sample_rate,)
+    material = '\x00'.join(parts)
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+
+class AudioCache(object):
+    """A size-bounded LRU store of audio files keyed by content hash.
+
+    `name` labels the report, e.g. for a second cache of speech marks.
+    """
+
+    def __init__(self, directory, max_bytes, name='Audio cache'):
+        self.directory = directory
+        self.name = name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._index = OrderedDict()
+        self._size = 0
+        self._mutex = Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Rebuild the index from a previous run, oldest use first.
+        entries = list()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name.endswith('.tmp') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self._size += size
+        with self._mutex:
+            self._evict()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Return the path of the cached audio for `key`, or None."""
+        with self._mutex:
+            size = self._index.get(key)
+            if size is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += size
+        path = self.path(key)
+        try:
+            # Keep the on-disk order in step so a restart keeps the LRU order.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return path
+
+    def put(self, key, data):
+        """Store `data` under `key` and return its path."""
+        path = self.path(key)
+        tmp_path = '{}.{}.tmp'.format(path, id(data))
+        with io.open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._mutex:
+            self._size -= self._index.pop(key, 0)
+            self._index[key] = len(data)
+            self._size += len(data)
+            self._evict()
+        return path
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._mutex:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'bytes_saved': self.bytes_saved,
+                'entries': len(self._index),
+                'bytes': self._size,
+            }
+
+    def report(self):
+        return ('{name}: {hits} hits, {misses} misses ({hit_rate:.0%}), '
+                '{bytes_saved} bytes saved, {entries} entries using '
+                '{bytes} bytes').format(name=self.name, **self.stats())
@@ -0,0 +1,65 @@
+"""Tests for the on-disk audio cache."""
+
+import os
+
+import audiocache
+
+
+def test_cache_key_ignores_whitespace():
+    assert (audiocache.cache_key('Joanna', 'mp3', 'a  dog\n on grass')
+            == audiocache.cache_key('Joanna', 'mp3', 'a dog on grass'))
+    assert (audiocache.cache_key('Joanna', 'mp3', 'a dog')
+            != audiocache.cache_key('Joanna', 'mp3', 'a dog', '8000'))
+
+
+def test_evicts_least_recently_used_past_max_bytes(tmp_path):
+    cache = audiocache.AudioCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    cache.put('c', b'cccc')
+
+    assert cache.get('a') is None
+    assert not os.path.exists(cache.path('a'))
+    assert cache.stats()['entries'] == 2
+    assert cache.stats()['bytes'] == 8
+
+
+def test_get_makes_an_entry_most_recent(tmp_path):
+    cache = audiocache.AudioCache(str(tmp_path), max_bytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == cache.path('a')
+    cache.put('c', b'cccc')
+
+    assert cache.get('b') is None
+    assert open(cache.get('a'), 'rb').read() == b'aaaa'
+
+
+def test_index_is_rebuilt_in_mtime_order(tmp_path):
+    cache = audiocache.AudioCache(str(tmp_path), max_bytes=100)
+    for age, key in enumerate(['old', 'middle', 'new']):
+        path = cache.put(key, b'x' * 4)
+        os.utime(path, (1000 + age, 1000 + age))
+    (tmp_path / 'partial.tmp').write_bytes(b'x' * 50)
+
+    # A restart with a smaller budget drops the oldest entry first.
+    cache = audiocache.AudioCache(str(tmp_path), max_bytes=8)
+    assert cache.stats()['entries'] == 2
+    assert cache.get('old') is None
+    assert cache.get('middle') is not None
+    assert cache.get('new') is not None
+
+
+def test_stats_count_hits_misses_and_bytes_saved(tmp_path):
+    cache = audiocache.AudioCache(str(tmp_path), max_bytes=100, name='Marks')
+    cache.put('a', b'aaaa')
+    cache.get('a')
+    cache.get('a')
+    cache.get('b')
+
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 1
+    assert stats['bytes_saved'] == 8
+    assert abs(stats['hit_rate'] - 2.0 / 3) < 1e-9
+    assert cache.report().startswith('Marks: 2 hits, 1 misses')
@@ -0,0 +1,49 @@
+"""Several images or captions in one REK/POL exchange.
+
+With --batch_size above one a device offers the images it admitted
+together: one REKBATCH (or POLBATCH) request lists them, a node bids once
+for the whole batch, and the job that follows carries one entry per image
+in `items`:
+
+  {'type': 'REKACK', 'batch_id': ..., 'img_name': <batch id>, 'node_id': ...,
+   'dev_id': ..., 'items': [{'img_name': ..., 'img_data': ...}, ...]}
+
+The rekognition node works on the items in parallel and answers with one
+REKRES whose `results` hold an entry per image. Audio is still delivered
+per image, as each file already needs a transfer of its own, but the Polly
+node synthesizes the items of a batch in parallel. The handshake is paid
+once per batch instead of once per image.
+
+A batch goes by its id in the `img_name` field wherever the single-image
+protocol puts the image name, so bids and traces key it the same way.
+"""
+
+import uuid
+
+
+def new_batch_id():
+    return 'batch-' + uuid.uuid4().hex[:16]
+
+
+def groups(items, size):
+    """Split `items` into lists of at most `size`."""
+    size = max(size, 1)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def expand(data, field):
+    """Return one payload per entry of `field`, or [data] for a single one.
+
+    Every entry inherits the other fields of the payload, so the handlers
+    of the single-image protocol can process the entries unchanged.
+    """
+    entries = data.get(field)
+    if entries is None:
+        return [data]
+    shared = dict((k, v) for k, v in data.items() if k != field)
+    expanded = list()
+    for entry in entries:
+        payload = dict(shared)
+        payload.update(entry)
+        expanded.append(payload)
+    return expanded
@@ -0,0 +1,29 @@
+"""Tests for the batch requests."""
+
+import batching
+
+
+def test_groups():
+    assert batching.groups(['a', 'b', 'c'], 2) == [['a', 'b'], ['c']]
+    assert batching.groups(['a', 'b'], 0) == [['a'], ['b']]
+    assert batching.groups([], 4) == []
+
+
+def test_expand_gives_every_item_the_shared_fields():
+    data = {'type': 'REKACK', 'batch_id': 'batch-1', 'img_name': 'batch-1',
+            'dev_id': 'dev-0', 'items': [{'img_name': 'img0.jpg'},
+                                         {'img_name': 'img1.jpg'}]}
+    jobs = batching.expand(data, 'items')
+    assert [job['img_name'] for job in jobs] == ['img0.jpg', 'img1.jpg']
+    assert all(job['dev_id'] == 'dev-0' and job['batch_id'] == 'batch-1'
+               for job in jobs)
+    assert all('items' not in job for job in jobs)
+
+
+def test_expand_leaves_single_payloads_alone():
+    data = {'type': 'REKRES', 'img_name': 'img0.jpg'}
+    assert batching.expand(data, 'results') == [data]
+
+
+def test_batch_ids_are_unique():
+    assert batching.new_batch_id() != batching.new_batch_id()
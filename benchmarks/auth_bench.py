@@ -0,0 +1,183 @@
+"""Benchmark device authentication against a local Ethereum test chain.
+
+Runs dappserver.authenticate and payment.authenticate against an
+eth-tester chain with a payment contract implementing paymentABI.json, at
+several concurrency levels. Every concurrent worker pays from its own
+funded account, as separate devices would. Reports the latency percentiles
+and the sustained authentications per second of each run.
+
+Run from the repository root:
+
+  $ pip install -r requirements-bench.txt
+  $ python -m benchmarks.auth_bench --concurrency=1,4,16 --requests=200
+
+The exit status is non-zero if any authentication failed, so the benchmark
+can run in CI; --output writes the results as JSON for comparing runs.
+"""
+
+import argparse
+import json
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from web3 import Web3
+
+from benchmarks import localchain
+from benchmarks import paycontract
+from benchmarks.stats import percentile
+
+TARGETS = ('dappserver', 'payment')
+
+
+def make_authenticate(target, chain, contract, concurrency, batch_window):
+    """Return authenticate(account) calling the target's auth path."""
+    if target == 'dappserver':
+        import chain as payments
+        import dappserver
+
+        payment = payments.PaymentContract(
+            chain.url, contract.address, abi_path=paycontract.ABI_PATH,
+            pool_size=concurrency, chain_id=chain.chain_id)
+        if batch_window > 0:
+            payment = payments.BatchedPayments(payment, batch_window)
+
+        def authenticate(account):
+            return dappserver.authenticate(
+                account.address, account.key.hex(), payment)
+    else:
+        import payment
+
+        def authenticate(account):
+            # payment.authenticate connects anew for every request.
+            return payment.authenticate(
+                account.address, account.key.hex(),
+                Web3.HTTPProvider(chain.url), contract.address,
+                chain.chain_id)
+    return authenticate
+
+
+def run_level(authenticate, accounts, requests, warmup):
+    """Run `requests` authentications, one worker per account."""
+    latencies = list()
+    failures = [0]
+    remaining = [warmup + requests]
+    mutex = Lock()
+
+    def worker(account):
+        while True:
+            with mutex:
+                if remaining[0] <= 0:
+                    return
+                measured = remaining[0] <= requests
+                remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                ok = authenticate(account)
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+            if not measured:
+                continue
+            with mutex:
+                latencies.append(elapsed)
+                if not ok:
+                    failures[0] += 1
+
+    with ThreadPoolExecutor(max_workers=len(accounts)) as executor:
+        started = time.perf_counter()
+        for future in [executor.submit(worker, a) for a in accounts]:
+            future.result()
+        wall = time.perf_counter() - started
+    # The warmup requests are part of the wall time; scale it down to the
+    # share of requests that were measured.
+    wall *= float(requests) / (warmup + requests)
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'failures': failures[0],
+        'auth_per_sec': (len(latencies) - failures[0]) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark authentication against a local test chain.')
+    parser.add_argument(
+        '--targets',
+        default=','.join(TARGETS),
+        help='Comma separated auth paths to run: dappserver, payment.')
+    parser.add_argument(
+        '--concurrency',
+        default='1,4,16',
+        help='Comma separated numbers of concurrent authentications.')
+    parser.add_argument(
+        '--requests',
+        type=int,
+        default=200,
+        help='Measured authentications per concurrency level.')
+    parser.add_argument(
+        '--warmup',
+        type=int,
+        default=10,
+        help='Authentications run before measuring each level.')
+    parser.add_argument(
+        '--batch_window',
+        type=float,
+        default=0,
+        help='Batch window of the dappserver payments, as in dappserver.py.')
+    parser.add_argument(
+        '--output',
+        help='Write the results as JSON to this file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    targets = [t for t in args.targets.split(',') if t]
+    for target in targets:
+        if target not in TARGETS:
+            sys.exit('Unknown target {}'.format(target))
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    chain = localchain.LocalChain()
+    # The repo uses web3's camelCase API, which newer web3 releases warn
+    # about on every call. Starting the chain and importing the auth
+    # modules reset the warning filters, so this is repeated below.
+    warnings.simplefilter('ignore', DeprecationWarning)
+    contract = paycontract.deploy(chain.w3, Web3.toWei('0.01', 'ether'))
+    accounts = chain.fund(max(levels), Web3.toWei('1000', 'ether'))
+
+    results = list()
+    print('{:<11} {:>5} {:>8} {:>6} {:>9} {:>8} {:>8} {:>8}'.format(
+        'target', 'conc', 'requests', 'failed', 'auth/s', 'p50 ms',
+        'p95 ms', 'p99 ms'))
+    for target in targets:
+        for level in levels:
+            authenticate = make_authenticate(
+                target, chain, contract, level, args.batch_window)
+            warnings.simplefilter('ignore', DeprecationWarning)
+            result = run_level(
+                authenticate, accounts[:level], args.requests, args.warmup)
+            result.update({'target': target, 'concurrency': level})
+            results.append(result)
+            print('{target:<11} {concurrency:>5} {requests:>8} {failures:>6} '
+                  '{auth_per_sec:>9.1f} {p50_ms:>8.1f} {p95_ms:>8.1f} '
+                  '{p99_ms:>8.1f}'.format(**result))
+    chain.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if any(result['failures'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
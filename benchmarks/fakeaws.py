@@ -0,0 +1,245 @@
+"""Fake S3, Rekognition and Polly endpoints for the pipeline benchmark.
+
+One HTTP server answers the calls the nodes make through boto3 when they
+are started with --aws_endpoint_url:
+
+  S3           PutObject and multipart uploads; the objects are discarded
+  Rekognition  DetectLabels, returning a fixed set of labels
+  Polly        SynthesizeSpeech, returning silence of the length Polly would
+               speak the text for: valid MP3 frames that mp3frames.py can
+               split and join, Ogg, raw PCM or word speech marks
+
+Each service waits its injected latency before answering, to stand in for
+the round trip to AWS. Any credentials are accepted; the nodes only need
+some to sign their requests with, e.g. AWS_ACCESS_KEY_ID=fake.
+
+  $ python -m benchmarks.fakeaws --port=4566 --polly_latency=0.15
+"""
+
+import argparse
+import json
+import re
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.parse import parse_qs, urlparse
+
+import encoding
+
+SERVICES = ('s3', 'rekognition', 'polly')
+
+LABELS = ('Person', 'Dog', 'Bicycle', 'Tree', 'Car', 'Building', 'Grass',
+          'Sky', 'Road', 'Bench', 'Cat', 'Table')
+
+# MPEG layer III frames of silence for each Polly sample rate, with about
+# the bitrates of encoding.ENCODINGS: (second header byte, bitrate index,
+# sample rate index, samples per frame). 22050 and 16000 Hz are MPEG-2,
+# 8000 Hz is MPEG-2.5; all are mono without CRC.
+_MP3_FRAMES = {
+    '22050': (0xf3, 6, 0, 576),
+    '16000': (0xf3, 4, 2, 576),
+    '8000': (0xe3, 2, 2, 576),
+}
+_MP3_BITRATES = (0, 8, 16, 24, 32, 40, 48)
+
+_OGG_BYTES_PER_SECOND = 5000
+
+_CHUNK_SIGNATURE = re.compile(rb'^[0-9a-fA-F]+(;[^\r\n]*)?$')
+
+
+def speech_seconds(text):
+    """How long the fake Polly speaks `text`, as encoding.py estimates it."""
+    return len(text) * encoding.MS_PER_CHAR / 1000.0 + encoding.TRAILING_SILENCE
+
+
+def silent_mp3(seconds, sample_rate='22050'):
+    """Return `seconds` of silence as a stream of MP3 frames."""
+    second_byte, bitrate_index, rate_index, samples = _MP3_FRAMES[sample_rate]
+    rate = int(sample_rate)
+    length = 72 * _MP3_BITRATES[bitrate_index] * 1000 // rate
+    header = bytes(bytearray((0xff, second_byte,
+                              (bitrate_index << 4) | (rate_index << 2), 0xc0)))
+    frame = header + b'\x00' * (length - len(header))
+    count = max(int(seconds * rate / samples + 0.5), 1)
+    return frame * count
+
+
+def speech_marks(text):
+    """Word speech marks as Polly returns them, one JSON object per line."""
+    lines = list()
+    elapsed = 0
+    for match in re.finditer(r'\S+', text):
+        lines.append(json.dumps({
+            'time': elapsed, 'type': 'word', 'start': match.start(),
+            'end': match.end(), 'value': match.group(0)}))
+        elapsed += (len(match.group(0)) + 1) * encoding.MS_PER_CHAR
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def synthesize(request):
+    """Return (content type, audio) for a SynthesizeSpeech request body."""
+    text = request.get('Text', '')
+    output_format = request.get('OutputFormat', 'mp3')
+    seconds = speech_seconds(text)
+    if output_format == 'json':
+        return 'application/x-json-stream', speech_marks(text)
+    if output_format == 'pcm':
+        rate = int(request.get('SampleRate', '16000'))
+        return 'audio/pcm', b'\x00\x00' * int(seconds * rate)
+    if output_format == 'ogg_vorbis':
+        return 'audio/ogg', b'OggS' + b'\x00' * int(seconds * _OGG_BYTES_PER_SECOND)
+    return 'audio/mpeg', silent_mp3(seconds, request.get('SampleRate', '22050'))
+
+
+def _decode_aws_chunked(body):
+    """Strip the chunk framing of an aws-chunked upload."""
+    data = bytearray()
+    position = 0
+    while position < len(body):
+        end = body.index(b'\r\n', position)
+        line = body[position:end]
+        if not _CHUNK_SIGNATURE.match(line):
+            break
+        size = int(line.split(b';', 1)[0], 16)
+        if size == 0:
+            break
+        data += body[end + 2:end + 2 + size]
+        position = end + 2 + size + 2
+    return bytes(data)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            body = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b';', 1)[0], 16)
+                if size == 0:
+                    # Trailers up to the empty line.
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            body = bytes(body)
+        else:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if 'aws-chunked' in self.headers.get('Content-Encoding', ''):
+            body = _decode_aws_chunked(body)
+        return body
+
+    def _respond(self, status, body=b'', content_type='application/xml',
+                 headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('x-amzn-RequestId', 'fake')
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):
+        body = self._read_body()
+        self.server.aws.count('s3', len(body))
+        self._respond(200, headers=[('ETag', '"fake"')])
+
+    def do_POST(self):
+        body = self._read_body()
+        url = urlparse(self.path)
+        target = self.headers.get('X-Amz-Target', '')
+        if target.startswith('RekognitionService.'):
+            self.server.aws.count('rekognition', len(body))
+            request = json.loads(body.decode('utf-8') or '{}')
+            labels = [{'Name': name, 'Confidence': 99.0 - i, 'Instances': [],
+                       'Parents': []}
+                      for i, name in enumerate(LABELS[:request.get('MaxLabels', 10)])]
+            self._respond(200, json.dumps({
+                'Labels': labels, 'LabelModelVersion': '2.0'}).encode('utf-8'),
+                'application/x-amz-json-1.1')
+        elif url.path == '/v1/speech':
+            self.server.aws.count('polly', len(body))
+            request = json.loads(body.decode('utf-8'))
+            content_type, audio = synthesize(request)
+            self._respond(200, audio, content_type, [
+                ('x-amzn-RequestCharacters', str(len(request.get('Text', ''))))])
+        else:
+            # S3 multipart uploads.
+            self.server.aws.count('s3', len(body))
+            query = parse_qs(url.query, keep_blank_values=True)
+            if 'uploads' in query:
+                result = ('<InitiateMultipartUploadResult><Bucket></Bucket>'
+                          '<Key></Key><UploadId>fake</UploadId>'
+                          '</InitiateMultipartUploadResult>')
+            else:
+                result = ('<CompleteMultipartUploadResult><ETag>"fake"</ETag>'
+                          '</CompleteMultipartUploadResult>')
+            self._respond(200, result.encode('utf-8'))
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeAWS(object):
+    """The fake services, served on a loopback port at `url`.
+
+    `latencies` maps a service name to the seconds it waits before
+    answering. `requests` and `bytes_received` count the calls per service.
+    """
+
+    def __init__(self, latencies=None, port=0):
+        self.latencies = dict(latencies or {})
+        self.requests = dict((service, 0) for service in SERVICES)
+        self.bytes_received = dict((service, 0) for service in SERVICES)
+        self._mutex = Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.aws = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def count(self, service, size):
+        with self._mutex:
+            self.requests[service] += 1
+            self.bytes_received[service] += size
+        latency = self.latencies.get(service, 0)
+        if latency > 0:
+            time.sleep(latency)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description='Fake S3, Rekognition and Polly endpoints.')
+    parser.add_argument(
+        '--port', type=int, default=4566, help='Port to listen on.')
+    for service in SERVICES:
+        parser.add_argument(
+            '--{}_latency'.format(service),
+            type=float,
+            default=0.0,
+            help='Seconds {} waits before answering.'.format(service))
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    aws = FakeAWS(dict((service, getattr(args, service + '_latency'))
+                       for service in SERVICES), args.port)
+    print('Fake AWS listening on {}'.format(aws.url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        aws.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""An in-process Ethereum test chain served over HTTP JSON-RPC.
+
+The chain is eth-tester with the py-evm backend, which mines a block for
+every transaction. It is served on a loopback port so that the code under
+test talks to it exactly as it talks to a remote node, through an HTTP
+provider, batches and connection pooling included. The backend is not
+thread safe, so requests are executed one at a time.
+"""
+
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+from web3 import EthereumTesterProvider, Web3
+
+
+def _to_json_rpc(value):
+    """Encode eth-tester results the way a JSON-RPC node does."""
+    if isinstance(value, bool) or value is None or isinstance(value, str):
+        return value
+    if isinstance(value, int):
+        return hex(value)
+    if isinstance(value, (bytes, bytearray)):
+        return '0x' + bytes(value).hex()
+    if isinstance(value, dict) or hasattr(value, 'items'):
+        return dict((k, _to_json_rpc(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_to_json_rpc(v) for v in value]
+    return value
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if isinstance(body, list):
+            response = [self.server.chain.handle(request) for request in body]
+        else:
+            response = self.server.chain.handle(body)
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class LocalChain(object):
+    """An eth-tester chain with a JSON-RPC endpoint at `url`.
+
+    `w3` talks to the backend directly and is meant for setting up the
+    chain before the measured run.
+    """
+
+    def __init__(self):
+        self.provider = EthereumTesterProvider()
+        self.w3 = Web3(self.provider)
+        self.chain_id = self.w3.eth.chain_id
+        self.requests = 0
+        self._mutex = Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.chain = self
+        self.url = 'http://127.0.0.1:{}'.format(self._server.server_port)
+        thread = Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle(self, request):
+        response = {'jsonrpc': '2.0', 'id': request.get('id')}
+        with self._mutex:
+            self.requests += 1
+            try:
+                result = self.provider.make_request(
+                    request['method'], request.get('params', []))
+            except Exception as e:
+                result = {'error': {'code': -32000, 'message': str(e)}}
+        if 'error' in result:
+            error = result['error']
+            if not isinstance(error, dict):
+                error = {'code': -32000, 'message': str(error)}
+            response['error'] = error
+        else:
+            response['result'] = _to_json_rpc(result.get('result'))
+        return response
+
+    def fund(self, count, value):
+        """Create `count` accounts holding `value` wei each."""
+        accounts = list()
+        for _ in range(count):
+            account = self.w3.eth.account.create()
+            self.w3.eth.sendTransaction({
+                'from': self.w3.eth.accounts[0],
+                'to': account.address,
+                'value': value,
+            })
+            accounts.append(account)
+        return accounts
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
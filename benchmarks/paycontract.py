@@ -0,0 +1,153 @@
+"""A payment contract implementing paymentABI.json for local test chains.
+
+The deployed contract's source is not part of this repository, so this is
+a small hand-written EVM program with the same interface:
+
+  pay()                payable, requires msg.value >= minPayment, adds it to
+                       payments[msg.sender] and emits
+                       PaymentReceived(msg.sender, msg.value)
+  minPayment()         the minimum payment set at deployment
+  payments(address)    total wei paid by an address
+  drain()              sends the balance to the deployer
+
+Storage follows Solidity's layout (owner in slot 0, minPayment in slot 1,
+the payments mapping at slot 2), so it behaves like the compiled contract
+for everything the DApp server and the payment index use.
+"""
+
+import json
+import os
+
+from eth_utils import keccak
+
+ABI_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'paymentABI.json')
+
+OPCODES = {
+    'STOP': 0x00, 'ADD': 0x01, 'LT': 0x10, 'EQ': 0x14, 'ISZERO': 0x15,
+    'SHR': 0x1c, 'SHA3': 0x20, 'ADDRESS': 0x30, 'BALANCE': 0x31,
+    'CALLER': 0x33, 'CALLVALUE': 0x34, 'CALLDATALOAD': 0x35,
+    'CALLDATASIZE': 0x36, 'CODECOPY': 0x39, 'MSTORE': 0x52, 'SLOAD': 0x54,
+    'SSTORE': 0x55, 'JUMPI': 0x57, 'GAS': 0x5a, 'JUMPDEST': 0x5b,
+    'DUP1': 0x80, 'SWAP1': 0x90, 'LOG3': 0xa3, 'CALL': 0xf1, 'RETURN': 0xf3,
+    'REVERT': 0xfd,
+}
+
+
+def selector(signature):
+    return keccak(text=signature)[:4]
+
+
+def assemble(program):
+    """Assemble a list of opcode names, ('push', value, width) and ':label'.
+
+    ('push', ':label') pushes the two byte offset of a label.
+    """
+    labels = dict()
+    offset = 0
+    for item in program:
+        if isinstance(item, str) and item.startswith(':'):
+            labels[item] = offset
+        elif isinstance(item, tuple):
+            offset += 1 + (2 if isinstance(item[1], str) else item[2])
+        else:
+            offset += 1
+    code = bytearray()
+    for item in program:
+        if isinstance(item, str) and item.startswith(':'):
+            continue
+        if isinstance(item, tuple):
+            if isinstance(item[1], str):
+                value, width = labels[item[1]], 2
+            else:
+                value, width = item[1], item[2]
+            code.append(0x5f + width)
+            code += value.to_bytes(width, 'big')
+        else:
+            code.append(OPCODES[item])
+    return bytes(code)
+
+
+def _push(value, width=1):
+    if isinstance(value, bytes):
+        return ('push', int.from_bytes(value, 'big'), len(value))
+    return ('push', value, width)
+
+
+def _nonpayable():
+    return ['CALLVALUE', ('push', ':revert'), 'JUMPI']
+
+
+def _mapping_slot():
+    # keccak256(key . 2) with the key on top of the stack.
+    return [_push(0), 'MSTORE', _push(2), _push(0x20), 'MSTORE',
+            _push(0x40), _push(0), 'SHA3']
+
+
+def _return_word():
+    return [_push(0), 'MSTORE', _push(0x20), _push(0), 'RETURN']
+
+
+def runtime_code():
+    event = keccak(text='PaymentReceived(address,uint256)')
+    program = [
+        _push(4), 'CALLDATASIZE', 'LT', ('push', ':revert'), 'JUMPI',
+        _push(0), 'CALLDATALOAD', _push(0xe0), 'SHR',
+    ]
+    for signature, label in (('pay()', ':pay'),
+                             ('minPayment()', ':min_payment'),
+                             ('payments(address)', ':payments'),
+                             ('drain()', ':drain')):
+        program += ['DUP1', _push(selector(signature)), 'EQ',
+                    ('push', label), 'JUMPI']
+    program += [':revert', 'JUMPDEST', _push(0), 'DUP1', 'REVERT']
+
+    program += [':pay', 'JUMPDEST',
+                'CALLVALUE', _push(1), 'SLOAD', 'SWAP1', 'LT',
+                ('push', ':revert'), 'JUMPI',
+                'CALLER'] + _mapping_slot() + [
+                'DUP1', 'SLOAD', 'CALLVALUE', 'ADD', 'SWAP1', 'SSTORE',
+                'CALLVALUE', 'CALLER', _push(event), _push(0), 'DUP1', 'LOG3',
+                'STOP']
+    program += [':min_payment', 'JUMPDEST'] + _nonpayable() + [
+                _push(1), 'SLOAD'] + _return_word()
+    program += [':payments', 'JUMPDEST'] + _nonpayable() + [
+                _push(4), 'CALLDATALOAD'] + _mapping_slot() + [
+                'SLOAD'] + _return_word()
+    program += [':drain', 'JUMPDEST'] + _nonpayable() + [
+                _push(0), 'SLOAD', 'CALLER', 'EQ', 'ISZERO',
+                ('push', ':revert'), 'JUMPI',
+                _push(0), 'DUP1', 'DUP1', 'DUP1',
+                'ADDRESS', 'BALANCE', _push(0), 'SLOAD', 'GAS', 'CALL',
+                'ISZERO', ('push', ':revert'), 'JUMPI', 'STOP']
+    return assemble(program)
+
+
+def init_code(min_payment):
+    """Return creation code storing the owner and minimum payment."""
+    runtime = runtime_code()
+
+    def program(runtime_offset):
+        return [
+            'CALLER', _push(0), 'SSTORE',
+            _push(min_payment, 32), _push(1), 'SSTORE',
+            _push(len(runtime), 2), 'DUP1', _push(runtime_offset, 2),
+            _push(0), 'CODECOPY', _push(0), 'RETURN',
+        ]
+    header = assemble(program(0))
+    return assemble(program(len(header))) + runtime
+
+
+def deploy(w3, min_payment, deployer=None):
+    """Deploy the contract from an unlocked account and return its address."""
+    with open(ABI_PATH) as f:
+        abi = json.load(f)
+    deployer = deployer or w3.eth.accounts[0]
+    txn_hash = w3.eth.sendTransaction({
+        'from': deployer,
+        'data': init_code(min_payment),
+        'gas': 500000,
+    })
+    receipt = w3.eth.waitForTransactionReceipt(txn_hash)
+    return w3.eth.contract(address=receipt['contractAddress'], abi=abi)
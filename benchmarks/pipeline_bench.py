@@ -0,0 +1,580 @@
+"""Benchmark the whole image to audio flow on one machine.
+
+Every run starts the local broker, rekognition and polly nodes and devices
+as separate processes with --transport=local, the nodes calling the fake
+AWS services of fakeaws.py, and waits until every device has received the
+audio of all its images:
+
+  REK -> REKSYM -> REKACK -> REKRES -> POL -> POLSYM -> POLACK -> POLRES
+
+The broker traces every publish, config update and config ack, and the
+latency of each stage is taken from those records, so the times are when
+the broker accepted a message or config, on one clock. The devices are
+authorized by writing their config directly; no DApp server or chain is
+involved.
+
+The runs sweep image size, device count and node count (the number of
+rekognition and of polly nodes). For each run the results hold the images
+per second, p50/p95/p99 latency per stage, and the CPU seconds and peak RSS
+of each role. Run from the repository root:
+
+  $ python -m benchmarks.pipeline_bench --image_kb=64,512 --devices=1,4 \\
+      --nodes=1,2 --output=pipeline.json
+
+Every process also writes its spans to spans.jsonl in the run's directory,
+so with --keep `python tracing.py <dir>/spans.jsonl` shows where the slowest
+image spent its time. CPU and RSS are read from /proc, so they are only reported on Linux. The
+nodes wait --config_delay seconds around device config updates, 20 in the
+scripts; the default here of 1 keeps to the broker's rate limit without
+letting the waits dominate every stage. Config updates the broker rejects
+are not retried by the nodes, so an image whose bid or result was lost
+never finishes; such runs report fewer completed images and exit non-zero.
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+
+import localbus
+import routing
+from benchmarks import fakeaws
+from benchmarks.stats import latency_summary
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROJECT_ID = 'bench'
+REGISTRY_ID = 'bench'
+CLOUD_REGION = 'local'
+TOPIC = 'my-topic'
+
+# Dispatch mode of the benchmark that runs direct dispatch with the devices'
+# --chain.
+CHAIN = 'chain'
+
+# (stage, message type that starts it, message type that ends it); 'done'
+# is the device acking the last chunk of the audio. With direct dispatch
+# the jobs take the place of the bid handshakes, and in a chain the
+# rekognition node publishes the POLJOB itself.
+STAGES = (
+    ('rek_bid', 'REK', 'REKSYM'),
+    ('rek_award', 'REKSYM', 'REKACK'),
+    ('rekognition', 'REKACK', 'REKRES'),
+    ('rekognition', 'REKJOB', 'REKRES'),
+    ('rek_to_polly', 'REKJOB', 'POLJOB'),
+    ('pol_request', 'REKRES', 'POL'),
+    ('pol_request', 'REKRES', 'POLJOB'),
+    ('pol_bid', 'POL', 'POLSYM'),
+    ('pol_award', 'POLSYM', 'POLACK'),
+    ('polly', 'POLACK', 'POLRES'),
+    ('polly', 'POLJOB', 'POLRES'),
+    ('audio_transfer', 'POLRES', 'done'),
+    ('total', 'REK', 'done'),
+    ('total', 'REKJOB', 'done'),
+)
+STAGE_NAMES = tuple(dict.fromkeys(stage for stage, _, _ in STAGES))
+# A batch request opens the same stages as a request for one image.
+BATCH_TYPES = {'REKBATCH': 'REK', 'POLBATCH': 'POL'}
+
+
+def device_name(device_id):
+    return 'projects/{}/locations/{}/registries/{}/devices/{}'.format(
+        PROJECT_ID, CLOUD_REGION, REGISTRY_ID, device_id)
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('localhost', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def make_image(path, size):
+    """Write a JPEG of about `size` bytes, padded after its end marker."""
+    out = io.BytesIO()
+    Image.new('RGB', (64, 64), (120, 160, 200)).save(out, 'JPEG')
+    data = out.getvalue()
+    with open(path, 'wb') as f:
+        f.write(data + b'\x00' * max(size - len(data), 0))
+
+
+def process_usage(pid):
+    """Return (CPU seconds, peak RSS bytes) of a running process, or Nones."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # The fields after the command name, which may contain spaces.
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / float(
+            os.sysconf('SC_CLK_TCK'))
+        peak = None
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) * 1024
+        return cpu, peak
+    except (IOError, OSError, IndexError, ValueError):
+        return None, None
+
+
+class Trace(object):
+    """Follows the broker's trace file and collects the stage times."""
+
+    def __init__(self, path):
+        self._path = path
+        self._offset = 0
+        # (device id, image name) -> {message type or 'done': time}
+        self.marks = dict()
+        # (device name, config version) -> (device id, image name) of the
+        # last chunk of an audio transfer.
+        self._last_chunks = dict()
+        # transfer id -> (device id, image name, number of chunks)
+        self._transfers = dict()
+        # Bytes the topic delivered, once for every matching subscription.
+        self.topic_bytes = 0
+        # (device id, batch id) -> (device id, image name) of its images
+        self._batches = dict()
+
+    def _mark(self, key, kind, when):
+        # Marks for a batch count for each of its images.
+        for image_key in self._batches.get(key, [key]):
+            self.marks.setdefault(image_key, dict()).setdefault(kind, when)
+
+    def read(self):
+        if not os.path.exists(self._path):
+            return
+        with open(self._path) as f:
+            f.seek(self._offset)
+            while True:
+                line = f.readline()
+                if not line.endswith('\n'):
+                    break
+                self._offset = f.tell()
+                self._add(json.loads(line))
+
+    def _add(self, record):
+        fields = record.get('fields', {})
+        kind = BATCH_TYPES.get(fields.get('type'), fields.get('type'))
+        when = record['time']
+        if record['event'] == 'publish':
+            self.topic_bytes += record.get('size', 0) * record.get('deliveries', 0)
+            if kind and 'img_name' in fields:
+                if 'img_names' in fields:
+                    self._batches[(fields['dev_id'], fields['img_name'])] = [
+                        (fields['dev_id'], name) for name in fields['img_names']]
+                self._mark((fields['dev_id'], fields['img_name']), kind, when)
+        elif record['event'] == 'config':
+            device_id = record['name'].rsplit('/', 1)[-1]
+            if kind == 'POLRES' and fields.get('part') == 'manifest':
+                key = (device_id, fields['img_name'])
+                self._mark(key, kind, when)
+                self._transfers[fields['transfer_id']] = key + (fields['chunks'],)
+            elif kind == 'POLRES':
+                transfer = self._transfers.get(fields.get('transfer_id'))
+                if transfer is not None and fields.get('seq') == transfer[2] - 1:
+                    self._last_chunks[(record['name'], record['version'])] = \
+                        transfer[:2]
+            elif kind and 'img_name' in fields:
+                self._mark((device_id, fields['img_name']), kind, when)
+        elif record['event'] == 'config_ack':
+            key = self._last_chunks.pop((record['name'], record['version']), None)
+            if key is not None:
+                self._mark(key, 'done', when)
+
+    def done(self):
+        return [key for key, marks in self.marks.items() if 'done' in marks]
+
+    def stages(self):
+        latencies = dict((stage, list()) for stage in STAGE_NAMES)
+        for marks in self.marks.values():
+            for stage, start, end in STAGES:
+                if start in marks and end in marks:
+                    latencies[stage].append(marks[end] - marks[start])
+        return dict((stage, latency_summary(latencies[stage]))
+                    for stage in STAGE_NAMES)
+
+
+class Pipeline(object):
+    """The processes of one run, each in its own directory under `workdir`."""
+
+    def __init__(self, workdir, args):
+        self.workdir = workdir
+        self.args = args
+        self.processes = list()
+        self.port = free_port()
+        self.trace_path = os.path.join(workdir, 'trace.jsonl')
+        self.span_path = os.path.abspath(os.path.join(workdir, 'spans.jsonl'))
+        self.env = dict(os.environ)
+        self.env.update({
+            'AWS_ACCESS_KEY_ID': 'fake',
+            'AWS_SECRET_ACCESS_KEY': 'fake',
+            'PYTHONUNBUFFERED': '1',
+        })
+
+    def start(self, role, name, script, arguments):
+        directory = os.path.join(self.workdir, name, 'run')
+        os.makedirs(directory)
+        log = open(os.path.join(self.workdir, name, 'log.txt'), 'w')
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(REPO, script)] + arguments,
+            cwd=directory, env=self.env, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((role, name, process, log))
+        return directory
+
+    def script_arguments(self, device_id):
+        return [
+            '--project_id', PROJECT_ID,
+            '--registry_id', REGISTRY_ID,
+            '--cloud_region', CLOUD_REGION,
+            '--device_id', device_id,
+            '--private_key_file', 'unused',
+            '--algorithm', 'RS256',
+            '--service_account_json', 'unused',
+            '--transport', 'local',
+            '--local_broker', 'localhost:{}'.format(self.port),
+            '--span_file', self.span_path,
+        ]
+
+    def start_broker(self):
+        self.start('broker', 'broker', 'localbus.py', [
+            '--port', str(self.port),
+            '--trace', self.trace_path,
+            '--latency', str(self.args.broker_latency),
+            '--config_rate', str(self.args.config_rate),
+        ])
+        deadline = time.time() + 10
+        while True:
+            try:
+                return localbus.connect(('localhost', self.port))
+            except (IOError, OSError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def start_nodes(self, broker, count, aws_url, dispatch):
+        subscriptions = set()
+        for i, (role, script) in itertools.product(
+                range(count), (('rek', 'reknode.py'), ('polly', 'pollyNode.py'))):
+            node_id = '{}-{}'.format(role, i)
+            # With direct dispatch the nodes of a role share one subscription.
+            subscription = node_id
+            if dispatch != routing.BID:
+                subscription = role + '-jobs'
+            lanes = list()
+            if self.args.lanes and dispatch == routing.BID:
+                lanes = ['--bulk_subscription', node_id + '-bulk']
+                subscriptions.add('projects/{}/subscriptions/{}-bulk'.format(
+                    PROJECT_ID, node_id))
+            self.start(role, node_id, script, self.script_arguments(node_id) + lanes + [
+                '--pubsub_subscription', subscription,
+                '--pubsub_topic', TOPIC,
+                '--dispatch', routing.BID if dispatch == routing.BID else routing.DIRECT,
+                '--aws_endpoint_url', aws_url,
+                '--config_delay', str(self.args.config_delay),
+            ])
+            subscriptions.add(
+                'projects/{}/subscriptions/{}'.format(PROJECT_ID, subscription))
+        # Requests published before a node subscribed would never reach it.
+        deadline = time.time() + 60
+        while not all(broker.has_subscription(s) for s in subscriptions):
+            self.check_running()
+            if time.time() > deadline:
+                raise RuntimeError('Nodes did not subscribe within 60 seconds')
+            time.sleep(0.2)
+
+    def start_devices(self, broker, count, images, image_size, dispatch):
+        expected = list()
+        for i in range(count):
+            device_id = 'dev-{}'.format(i)
+            images_path = os.path.join(self.workdir, device_id + '-images') + os.sep
+            os.makedirs(images_path)
+            for j in range(images):
+                path = os.path.join(images_path, 'img{}.jpg'.format(j))
+                make_image(path, image_size)
+                expected.append((device_id, path))
+            extra = ['--dispatch', routing.DIRECT, '--chain'] if dispatch == CHAIN \
+                else ['--dispatch', dispatch]
+            if self.args.credit_window is not None:
+                extra += ['--credit_window', str(self.args.credit_window)]
+            if self.args.batch_size is not None:
+                extra += ['--batch_size', str(self.args.batch_size)]
+            if self.args.inline_kb is not None:
+                extra += [
+                    '--claim_check_store', 'file://' + os.path.join(
+                        os.path.abspath(self.workdir), 'claims'),
+                    '--inline_threshold', str(self.args.inline_kb * 1024),
+                ]
+            # Stands in for the DApp server's answer.
+            broker.update_config(
+                device_name(device_id), b'{"status": "authorized"}')
+            self.start('device', device_id, 'iotdevice.py',
+                       self.script_arguments(device_id) + [
+                           '--images_path', images_path,
+                           '--pubsub_subscription', TOPIC,
+                           '--bid_window', str(self.args.bid_window),
+                           '--dapp_id', 'dapp',
+                           '--dapp_key', 'unused',
+                           '--dapp_addr', 'unused',
+                           '--auth_topic', 'auth',
+                       ] + extra)
+        return expected
+
+    def check_running(self):
+        for role, name, process, log in self.processes:
+            if process.poll() is not None:
+                raise RuntimeError('{} exited with status {}, see {}'.format(
+                    name, process.returncode, log.name))
+
+    def usage(self):
+        """CPU seconds and peak RSS per role."""
+        roles = dict()
+        for role, name, process, log in self.processes:
+            cpu, peak = process_usage(process.pid)
+            roles.setdefault(role, list()).append((cpu, peak))
+        summary = dict()
+        for role, usage in roles.items():
+            cpus = [cpu for cpu, _ in usage if cpu is not None]
+            peaks = [peak for _, peak in usage if peak is not None]
+            summary[role] = {
+                'processes': len(usage),
+                'cpu_s': sum(cpus) if cpus else None,
+                'peak_rss_mb_max': max(peaks) / 1048576.0 if peaks else None,
+                'peak_rss_mb_mean': (sum(peaks) / float(len(peaks)) / 1048576.0
+                                     if peaks else None),
+            }
+        return summary
+
+    def stop(self):
+        for role, name, process, log in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for role, name, process, log in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+            log.close()
+
+
+def run(args, dispatch, image_kb, devices, nodes):
+    workdir = tempfile.mkdtemp(prefix='pipeline-', dir=args.workdir)
+    pipeline = Pipeline(workdir, args)
+    aws = fakeaws.FakeAWS({
+        's3': args.s3_latency,
+        'rekognition': args.rekognition_latency,
+        'polly': args.polly_latency,
+    })
+    trace = Trace(pipeline.trace_path)
+    result = {'dispatch': dispatch, 'image_kb': image_kb, 'devices': devices, 'nodes': nodes,
+              'images': devices * args.images, 'workdir': workdir}
+    try:
+        broker = pipeline.start_broker()
+        pipeline.start_nodes(broker, nodes, aws.url, dispatch)
+        expected = pipeline.start_devices(
+            broker, devices, args.images, image_kb * 1024, dispatch)
+        deadline = time.time() + args.timeout
+        while time.time() < deadline:
+            pipeline.check_running()
+            trace.read()
+            if len(trace.done()) >= len(expected):
+                break
+            time.sleep(0.5)
+        trace.read()
+        result['roles'] = pipeline.usage()
+    except RuntimeError as e:
+        result['error'] = str(e)
+    finally:
+        pipeline.stop()
+        aws.close()
+
+    done = [trace.marks[key] for key in trace.done()]
+    result['completed'] = len(done)
+    if done:
+        first = min(marks.get('REK', marks.get('REKJOB', marks['done']))
+                    for marks in done)
+        last = max(marks['done'] for marks in done)
+        result['wall_s'] = last - first
+        result['images_per_sec'] = len(done) / (last - first) if last > first else None
+    result['stages'] = trace.stages()
+    result['topic_bytes'] = trace.topic_bytes
+    result['aws_requests'] = dict(aws.requests)
+    for usage in result.get('roles', {}).values():
+        if usage['cpu_s'] is not None and done:
+            usage['cpu_s_per_image'] = usage['cpu_s'] / len(done)
+    if not args.keep and 'error' not in result and len(done) == result['images']:
+        shutil.rmtree(workdir, ignore_errors=True)
+        del result['workdir']
+    return result
+
+
+def git_commit():
+    """Return (commit, whether the tree has local changes) or Nones."""
+    try:
+        commit = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO).decode('ascii').strip()
+        status = subprocess.check_output(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO)
+        return commit, bool(status.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the image to audio flow on one machine.')
+    parser.add_argument(
+        '--dispatch',
+        default=routing.BID,
+        help=('Comma separated dispatch modes: bid, direct, or chain for '
+              'direct dispatch with the devices\' --chain.'))
+    parser.add_argument(
+        '--image_kb',
+        default='64,512',
+        help='Comma separated image sizes in KiB.')
+    parser.add_argument(
+        '--devices',
+        default='1,4',
+        help='Comma separated numbers of devices.')
+    parser.add_argument(
+        '--nodes',
+        default='1,2',
+        help='Comma separated numbers of rekognition nodes, with as many '
+             'polly nodes.')
+    parser.add_argument(
+        '--images',
+        type=int,
+        default=1,
+        help='Images every device captions.')
+    parser.add_argument(
+        '--lanes',
+        action='store_true',
+        help=('With bid dispatch, start the nodes with a bulk subscription '
+              'for the jobs besides the one for the requests.'))
+    parser.add_argument(
+        '--credit_window',
+        type=int,
+        default=None,
+        help='--credit_window of the devices.')
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=None,
+        help='--batch_size of the devices.')
+    parser.add_argument(
+        '--inline_kb',
+        type=int,
+        default=None,
+        help=('Devices send images larger than this through a claim-check '
+              'store in the run directory; by default all are inline.'))
+    parser.add_argument(
+        '--s3_latency',
+        type=float,
+        default=0.05,
+        help='Seconds the fake S3 takes per upload.')
+    parser.add_argument(
+        '--rekognition_latency',
+        type=float,
+        default=0.3,
+        help='Seconds the fake Rekognition takes per DetectLabels call.')
+    parser.add_argument(
+        '--polly_latency',
+        type=float,
+        default=0.15,
+        help='Seconds the fake Polly takes per SynthesizeSpeech call.')
+    parser.add_argument(
+        '--broker_latency',
+        type=float,
+        default=0.0,
+        help='Seconds before the broker delivers a message or config.')
+    parser.add_argument(
+        '--config_rate',
+        type=float,
+        default=localbus.CONFIG_UPDATES_PER_SECOND,
+        help='Config updates the broker allows per second for each device.')
+    parser.add_argument(
+        '--config_delay',
+        type=float,
+        default=1,
+        help='--config_delay of the rekognition and polly nodes.')
+    parser.add_argument(
+        '--bid_window',
+        type=float,
+        default=3,
+        help='--bid_window of the devices.')
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=600,
+        help='Seconds to wait for a run to finish.')
+    parser.add_argument(
+        '--workdir',
+        default=None,
+        help='Directory for the runs\' files; a temporary one by default.')
+    parser.add_argument(
+        '--keep',
+        action='store_true',
+        help='Keep the logs and files of runs that completed.')
+    parser.add_argument(
+        '--output',
+        help='Write the results as JSON to this file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    commit, dirty = git_commit()
+    results = list()
+    print('{:>8} {:>9} {:>7} {:>5} {:>6} {:>9} {:>10} {:>10} {:>10} {:>9}'.format(
+        'dispatch', 'image KiB', 'devices', 'nodes', 'done', 'images/s',
+        'p50 ms', 'p95 ms', 'p99 ms', 'topic KiB'))
+    for dispatch, image_kb, devices, nodes in itertools.product(
+            [mode for mode in args.dispatch.split(',') if mode],
+            parse_list(args.image_kb), parse_list(args.devices),
+            parse_list(args.nodes)):
+        result = run(args, dispatch, image_kb, devices, nodes)
+        results.append(result)
+        total = result['stages']['total']
+        print('{:>8} {:>9} {:>7} {:>5} {:>6} {:>9} {:>10} {:>10} {:>10} {:>9}'.format(
+            dispatch, image_kb, devices, nodes,
+            '{}/{}'.format(result['completed'], result['images']),
+            '{:.3f}'.format(result['images_per_sec'])
+            if result.get('images_per_sec') else '-',
+            *['{:.0f}'.format(total[p]) if total[p] is not None else '-'
+              for p in ('p50_ms', 'p95_ms', 'p99_ms')] +
+            ['{:.0f}'.format(result['topic_bytes'] / 1024.0)]))
+        if 'error' in result:
+            print('  ' + result['error'])
+        if 'workdir' in result:
+            print('  logs in ' + result['workdir'])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': commit,
+                'dirty': dirty,
+                'python': platform.python_version(),
+                'cpus': os.cpu_count(),
+                'settings': vars(args),
+                'runs': results,
+            }, f, indent=2)
+    if any('error' in r or r['completed'] < r['images'] for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,24 @@
+"""Summary statistics shared by the benchmarks."""
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def latency_summary(seconds):
+    """Count and p50/p95/p99/max in milliseconds of a list of durations."""
+    values = sorted(seconds)
+    if not values:
+        return {'count': 0, 'p50_ms': None, 'p95_ms': None, 'p99_ms': None,
+                'max_ms': None}
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p95_ms': percentile(values, 0.95) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'max_ms': values[-1] * 1000,
+    }
@@ -0,0 +1,251 @@
+"""Load-aware bidding for the REK/POL handshake.
+
+A node answers a REK or POL broadcast with a bid that carries its current
+queue depth and an estimate of when it would finish the job, and declines
+outright when it is already at capacity. The device collects the bids for
+an image during a short window and hands the job to the best one instead
+of to whichever node happened to answer first.
+
+Bids and results also carry the node's free credits, the jobs it can still
+take. A device admits images into a stage only while it has fewer in
+flight than the credits the nodes granted it plus a small local window, so
+under load the backlog waits on the device instead of piling up in every
+node's queue.
+"""
+
+import math
+import time
+from threading import Lock
+
+
+class LoadTracker(object):
+    """Tracks the jobs a node has in flight and how long they take.
+
+    A bid made for a key reserves the node's credits for its jobs until
+    they start, or for `reserve_ttl` seconds if they never come because
+    another node won them.
+    """
+
+    def __init__(self, capacity, service_time=30.0, smoothing=0.2,
+                 reserve_ttl=10.0):
+        self.capacity = capacity
+        self.reserve_ttl = reserve_ttl
+        self._service_time = service_time
+        self._smoothing = smoothing
+        self._in_flight = 0
+        self._reserved = dict()
+        self._mutex = Lock()
+
+    def _expire(self, now):
+        for key, (reserved, jobs) in list(self._reserved.items()):
+            if now - reserved > self.reserve_ttl:
+                del self._reserved[key]
+
+    def _free(self):
+        reserved = sum(jobs for _, jobs in self._reserved.values())
+        return max(self.capacity - self._in_flight - reserved, 0)
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def credits(self):
+        """Jobs this node can take before it is at capacity."""
+        with self._mutex:
+            self._expire(time.time())
+            return self._free()
+
+    @property
+    def service_time(self):
+        """Smoothed seconds a job has been taking."""
+        return self._service_time
+
+    def bid(self, key=None, jobs=1):
+        """Return the bid fields for `jobs` new jobs, or None to decline.
+
+        With a `key` the bid reserves a credit for each of the jobs.
+        """
+        with self._mutex:
+            self._expire(time.time())
+            if self._free() < jobs:
+                return None
+            if key is not None:
+                self._reserved[key] = (time.time(), jobs)
+            # Up to `capacity` jobs run at once, so the last of the new jobs
+            # finishes after this many rounds of the service time.
+            rounds = math.ceil(float(self._in_flight + jobs) / self.capacity)
+            return {
+                'queue_depth': self._in_flight,
+                'eta': rounds * self._service_time,
+                'credits': self._free(),
+            }
+
+    def start(self, key=None):
+        """Record that a job was accepted; returns its start time."""
+        with self._mutex:
+            reservation = self._reserved.pop(key, None)
+            if reservation is not None and reservation[1] > 1:
+                self._reserved[key] = (reservation[0], reservation[1] - 1)
+            self._in_flight += 1
+        return time.time()
+
+    def finish(self, started):
+        """Record that the job started at `started` is done."""
+        elapsed = time.time() - started
+        with self._mutex:
+            self._in_flight -= 1
+            self._service_time += self._smoothing * (
+                elapsed - self._service_time)
+
+
+class BidBook(object):
+    """Collects node bids per image and picks a winner after a window.
+
+    Late bids for a decided image are ignored for `decided_ttl` seconds,
+    long enough for bids that sat out a node's config delay.
+    """
+
+    def __init__(self, window, decided_ttl=120.0):
+        self.window = window
+        self.decided_ttl = decided_ttl
+        self._bids = dict()
+        self._opened = dict()
+        # image -> time its winner was picked
+        self._decided = dict()
+        self._mutex = Lock()
+
+    def __len__(self):
+        """Images whose bid window is still open."""
+        return len(self._opened)
+
+    def offer(self, img, node_id, data):
+        """Record a bid from `node_id` for `img`."""
+        with self._mutex:
+            if img in self._decided:
+                return
+            if img not in self._bids:
+                self._bids[img] = list()
+                self._opened[img] = time.time()
+            # Bids from nodes that do not report a load estimate rank last,
+            # in arrival order.
+            eta = data.get('eta', float('inf'))
+            self._bids[img].append(
+                (eta, len(self._bids[img]), node_id, data))
+
+    def ready(self):
+        """Return (img, node_id, data) for every image whose window closed."""
+        now = time.time()
+        winners = list()
+        with self._mutex:
+            for img, decided in list(self._decided.items()):
+                if now - decided > self.decided_ttl:
+                    del self._decided[img]
+            for img, opened in list(self._opened.items()):
+                if now - opened < self.window:
+                    continue
+                eta, _, node_id, data = min(self._bids.pop(img))
+                self._opened.pop(img)
+                self._decided[img] = now
+                winners.append((img, node_id, data))
+        return winners
+
+
+class CreditWindow(object):
+    """Limits the images a device has in flight in one stage.
+
+    An image may enter the stage while fewer than `window` plus the credits
+    granted by the nodes are in flight. Every node's latest advertisement
+    replaces its previous one and is dropped after `grant_ttl` seconds;
+    awarding a job to a node uses up one of its credits. Images still in
+    flight after `timeout` seconds are given up on, so lost messages do not
+    hold the window shut.
+
+    With bids, a node at capacity declines without answering, so a request
+    nobody bid on within a while is withdrawn by unanswered() to be sent
+    again once credits are granted.
+    """
+
+    def __init__(self, window, timeout=600.0, grant_ttl=60.0):
+        self.window = window
+        self.timeout = timeout
+        self.grant_ttl = grant_ttl
+        self._in_flight = dict()
+        self._answered = set()
+        self._grants = dict()
+        self._mutex = Lock()
+
+    def __len__(self):
+        """Images in flight."""
+        return len(self._in_flight)
+
+    def _granted(self, now):
+        for node_id, (credits, granted) in list(self._grants.items()):
+            if now - granted > self.grant_ttl:
+                del self._grants[node_id]
+        return sum(credits for credits, _ in self._grants.values())
+
+    @property
+    def granted(self):
+        """Credits the nodes currently grant."""
+        with self._mutex:
+            return self._granted(time.time())
+
+    def grant(self, node_id, credits):
+        """Record the free credits a node advertised; None is ignored."""
+        if credits is None:
+            return
+        with self._mutex:
+            self._grants[node_id] = (max(int(credits), 0), time.time())
+
+    def consume(self, node_id):
+        """Use up a credit of the node a job was awarded to."""
+        with self._mutex:
+            grant = self._grants.get(node_id)
+            if grant is not None:
+                self._grants[node_id] = (max(grant[0] - 1, 0), grant[1])
+
+    def acquire(self, key, item=None):
+        """Admit `key` into the stage; returns False if the window is full.
+
+        `item` is what unanswered() returns for the key.
+        """
+        now = time.time()
+        with self._mutex:
+            if key in self._in_flight:
+                return True
+            if len(self._in_flight) >= self.window + self._granted(now):
+                return False
+            self._in_flight[key] = (now, item)
+            return True
+
+    def answered(self, key):
+        """Record that a node bid for `key`."""
+        with self._mutex:
+            if key in self._in_flight:
+                self._answered.add(key)
+
+    def unanswered(self, seconds):
+        """Withdraw and return the items nobody bid on within `seconds`."""
+        now = time.time()
+        with self._mutex:
+            withdrawn = [key for key, (started, _) in self._in_flight.items()
+                         if key not in self._answered and now - started > seconds]
+            return [self._in_flight.pop(key)[1] for key in withdrawn]
+
+    def release(self, key):
+        """Record that `key` left the stage; unknown keys are ignored."""
+        with self._mutex:
+            self._in_flight.pop(key, None)
+            self._answered.discard(key)
+
+    def expire(self):
+        """Give up on the images in flight for longer than the timeout."""
+        now = time.time()
+        with self._mutex:
+            expired = [key for key, (started, _) in self._in_flight.items()
+                       if now - started > self.timeout]
+            for key in expired:
+                del self._in_flight[key]
+                self._answered.discard(key)
+        return expired
@@ -0,0 +1,99 @@
+"""Tests for node bids and credits."""
+
+import bidding
+
+
+def _clock(monkeypatch, start=1000.0):
+    now = [start]
+    monkeypatch.setattr(bidding.time, 'time', lambda: now[0])
+    return now
+
+
+def test_bid_book_forgets_decided_images(monkeypatch):
+    now = _clock(monkeypatch)
+    book = bidding.BidBook(3, decided_ttl=60)
+    book.offer('img0', 'rek-0', {'eta': 5})
+    book.offer('img0', 'rek-1', {'eta': 2})
+    now[0] += 3
+    assert [(img, node) for img, node, _ in book.ready()] == [('img0', 'rek-1')]
+
+    # A late bid does not reopen the image...
+    book.offer('img0', 'rek-2', {'eta': 1})
+    assert len(book) == 0
+    # ...until the decision is forgotten.
+    now[0] += 61
+    assert book.ready() == []
+    assert book._decided == {}
+
+
+def test_load_tracker_reserves_a_credit_per_bid():
+    load = bidding.LoadTracker(2)
+    assert load.bid(('dev-0', 'img0'))['credits'] == 1
+    assert load.bid(('dev-1', 'img0'))['credits'] == 0
+    # Both credits are promised, so a third device is declined.
+    assert load.bid(('dev-2', 'img0')) is None
+
+    load.finish(load.start(('dev-0', 'img0')))
+    assert load.credits == 1
+
+
+def test_load_tracker_eta_counts_jobs_running_in_parallel():
+    load = bidding.LoadTracker(4, service_time=10.0)
+    for _ in range(3):
+        load.start()
+    # The fourth job runs next to the three, not after them.
+    bid = load.bid()
+    assert (bid['queue_depth'], bid['eta']) == (3, 10.0)
+
+
+def test_load_tracker_declines_a_batch_it_cannot_take_whole():
+    load = bidding.LoadTracker(4)
+    load.bid(('dev-0', 'img0'))
+    assert load.bid(('dev-1', 'batch-1'), 4) is None
+    assert load.bid(('dev-1', 'batch-1'), 3)['credits'] == 0
+
+    # Each job of the batch that starts uses up one of its reservations.
+    for _ in range(3):
+        load.start(('dev-1', 'batch-1'))
+    assert load.in_flight == 3
+    assert load.credits == 0
+
+
+def test_load_tracker_releases_reservations_nobody_claimed(monkeypatch):
+    now = _clock(monkeypatch)
+    load = bidding.LoadTracker(1, reserve_ttl=10)
+    assert load.bid(('dev-0', 'img0')) is not None
+    assert load.bid(('dev-1', 'img0')) is None
+    now[0] += 11
+    assert load.bid(('dev-1', 'img0')) is not None
+
+
+def test_credit_window_admits_window_plus_granted_credits():
+    window = bidding.CreditWindow(1)
+    assert window.acquire('img0')
+    assert not window.acquire('img1')
+
+    window.grant('rek-0', 2)
+    assert window.acquire('img1')
+    assert window.acquire('img2')
+    assert not window.acquire('img3')
+
+    # The award used up a credit, so releasing one image is not enough.
+    window.consume('rek-0')
+    assert window.granted == 1
+    window.release('img0')
+    assert not window.acquire('img3')
+    window.release('img1')
+    assert window.acquire('img3')
+
+
+def test_credit_window_withdraws_unanswered_requests(monkeypatch):
+    now = _clock(monkeypatch)
+    window = bidding.CreditWindow(2)
+    window.acquire('img0', ('img0', 'A dog.'))
+    window.acquire('img1', ('img1', 'A cat.'))
+    window.answered('img1')
+    now[0] += 11
+
+    assert window.unanswered(10) == [('img0', 'A dog.')]
+    assert len(window) == 1
@@ -0,0 +1,27 @@
+"""The spoken caption a device requests for the labels of an image.
+
+The caption is built from a fixed template around the image title and the
+Rekognition labels. Polly nodes receive the same caption split into its
+segments, so that every template part and label can be synthesized once
+and reused across captions.
+"""
+
+CAPTION_PREFIX = 'The labels in image'
+CAPTION_JOIN = 'are'
+
+
+def caption_title(image_name):
+    return image_name.split('/')[-1]
+
+
+def caption_segments(image_name, labels):
+    """Return the phrases the caption for `image_name` is spoken from."""
+    return [CAPTION_PREFIX, caption_title(image_name), CAPTION_JOIN] + list(labels)
+
+
+def build_caption(image_name, labels):
+    """Return the caption text for `image_name` and its labels."""
+    st = CAPTION_PREFIX + " " + caption_title(image_name) + " " + CAPTION_JOIN + " "
+    for l in labels:
+        st = st + l + " "
+    return st
@@ -0,0 +1,308 @@
+"""Access to the payment contract shared by every authentication.
+
+The DApp server used to read the ABI, build a Web3 provider and open a new
+HTTP connection for each authentication. A PaymentContract is built once
+at startup and keeps the contract object and a pooled HTTP session to the
+Ethereum node for the lifetime of the process.
+"""
+
+import json
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+from threading import Lock, Thread
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3 import Web3, HTTPProvider
+
+PROVIDER_URL = "https://ropsten.infura.io/v3/f9c884008XXXXXXXXX6e5"
+CONTRACT_ADDRESS = "0xfB6916095ca1dXXXXXXXXXXXXXXX74c37c5d359"
+CHAIN_ID = 3
+PAYMENT_GAS = 70000
+PAYMENT_ATTEMPTS = 3
+# Seconds to wait for a payment to be mined before it counts as failed.
+RECEIPT_TIMEOUT = 120
+
+# Node errors meaning the nonce was taken by another transaction from the
+# same address, e.g. one sent by another DApp server replica.
+NONCE_ERRORS = ('nonce too low', 'already known', 'known transaction',
+                'replacement transaction underpriced',
+                'invalid transaction nonce')
+
+
+def is_nonce_error(error):
+    message = str(error).lower()
+    return any(text in message for text in NONCE_ERRORS)
+
+
+class PooledHTTPProvider(HTTPProvider):
+    """An HTTPProvider that sends every request over one pooled session."""
+
+    def __init__(self, endpoint_uri, pool_size=10, request_kwargs=None):
+        super(PooledHTTPProvider, self).__init__(endpoint_uri, request_kwargs)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, request_data):
+        """POST an encoded JSON-RPC request and return the raw response."""
+        kwargs = self.get_request_kwargs()
+        kwargs.setdefault('timeout', 10)
+        response = self.session.post(self.endpoint_uri, data=request_data, **kwargs)
+        response.raise_for_status()
+        return response.content
+
+    def make_request(self, method, params):
+        request_data = self.encode_rpc_request(method, params)
+        return self.decode_rpc_response(self.post(request_data))
+
+    def make_batch_request(self, calls):
+        """Send (method, params) calls as one JSON-RPC batch.
+
+        Returns the responses in the order of `calls`.
+        """
+        batch = [
+            {'jsonrpc': '2.0', 'method': method, 'params': params,
+             'id': next(self.request_counter)}
+            for method, params in calls]
+        responses = json.loads(self.post(json.dumps(batch).encode('utf-8')))
+        by_id = dict((response.get('id'), response) for response in responses)
+        return [by_id.get(request['id'], {'error': {'message': 'No response'}})
+                for request in batch]
+
+
+class NonceManager(object):
+    """Allocates transaction nonces per address without a chain round trip.
+
+    The first allocation for an address is seeded from the node's pending
+    transaction count; after that nonces are handed out locally, so several
+    payments from the same address can be in flight at once. When a send
+    fails because the nonce was already used, the address is resynchronized
+    on next use to the larger of its local nonce and the chain's count, so
+    nonces still in flight here are not handed out again.
+    """
+
+    def __init__(self, w3):
+        self.w3 = w3
+        self._next = dict()
+        self._stale = set()
+        self._seed_locks = dict()
+        self._mutex = Lock()
+
+    def allocate(self, addr):
+        """Return the next unused nonce for `addr`."""
+        account = addr.lower()
+        with self._mutex:
+            if account in self._next and account not in self._stale:
+                nonce = self._next[account]
+                self._next[account] = nonce + 1
+                return nonce
+            seed_lock = self._seed_locks.setdefault(account, Lock())
+        # Only allocations for this address wait while it is seeded.
+        with seed_lock:
+            if not self.is_seeded(addr):
+                self.seed(addr, self.w3.eth.getTransactionCount(addr, 'pending'))
+            with self._mutex:
+                nonce = self._next[account]
+                self._next[account] = nonce + 1
+                return nonce
+
+    def is_seeded(self, addr):
+        """Return whether `addr` can be allocated without reading the chain."""
+        account = addr.lower()
+        with self._mutex:
+            return account in self._next and account not in self._stale
+
+    def seed(self, addr, count):
+        """Record the chain's pending transaction count of `addr`.
+
+        The next nonce never moves back, as the local one may be ahead of
+        the chain with payments that are still being sent.
+        """
+        account = addr.lower()
+        with self._mutex:
+            self._next[account] = max(self._next.get(account, 0), count)
+            self._stale.discard(account)
+
+    def resync(self, addr):
+        """Re-read the nonce of `addr` from the chain on its next use."""
+        with self._mutex:
+            self._stale.add(addr.lower())
+
+    def release(self, addr, nonce):
+        """Give back `nonce` of a send the node rejected.
+
+        This only works while it is the last nonce handed out; otherwise
+        the gap stays until the next nonce error resynchronizes.
+        """
+        account = addr.lower()
+        with self._mutex:
+            if self._next.get(account) == nonce + 1:
+                self._next[account] = nonce
+
+
+class PaymentContract(object):
+    """The payment contract together with a persistent Web3 connection."""
+
+    def __init__(self, provider_url=PROVIDER_URL,
+                 contract_address=CONTRACT_ADDRESS, abi_path='paymentABI.json',
+                 pool_size=10, w3=None, chain_id=CHAIN_ID):
+        with open(abi_path) as f:
+            paymentabi = json.load(f)
+        if w3 is None:
+            w3 = Web3(PooledHTTPProvider(provider_url, pool_size))
+        self.w3 = w3
+        self.chain_id = chain_id
+        self.contract = w3.eth.contract(address=contract_address, abi=paymentabi)
+        self.nonces = NonceManager(w3)
+
+    def build_payment(self, key, nonce, value, gas_price=None):
+        """Return the signed raw transaction paying `value` wei to the contract."""
+        if gas_price is None:
+            gas_price = self.w3.toWei('1', 'gwei')
+        txn = self.contract.functions.pay().buildTransaction({
+            'chainId': self.chain_id,
+            'gas': PAYMENT_GAS,
+            'gasPrice': gas_price,
+            'nonce': nonce,
+            'value': value,
+            })
+        signed_txn = self.w3.eth.account.sign_transaction(txn, private_key=key)
+        return signed_txn.rawTransaction
+
+    def owns(self, addr, key):
+        """Return whether `key` is the private key of `addr`, without the chain."""
+        try:
+            return self.w3.eth.account.from_key(key).address.lower() == addr.lower()
+        except Exception:
+            return False
+
+    def confirm(self, tx_hash, timeout=RECEIPT_TIMEOUT):
+        """Wait until `tx_hash` is mined and return whether it succeeded.
+
+        A transaction the node accepted can still revert, e.g. when the
+        address cannot cover the value, so only a receipt with status 1
+        counts as a payment.
+        """
+        receipt = self.w3.eth.waitForTransactionReceipt(tx_hash, timeout=timeout)
+        return receipt['status'] == 1
+
+    def pay(self, addr, key, value, attempts=PAYMENT_ATTEMPTS):
+        """Send a payment from `addr` and return the transaction hash.
+
+        Replicas allocate nonces independently, so a nonce another replica
+        used first is resynchronized from the chain and the payment retried.
+        """
+        while True:
+            attempts -= 1
+            nonce = self.nonces.allocate(addr)
+            try:
+                return self.w3.eth.sendRawTransaction(
+                    self.build_payment(key, nonce, value))
+            except Exception as e:
+                if not is_nonce_error(e):
+                    self.nonces.release(addr, nonce)
+                    raise
+                self.nonces.resync(addr)
+                if attempts <= 0:
+                    raise
+
+
+class BatchedPayments(object):
+    """Coalesces concurrent payments into JSON-RPC batches.
+
+    Payments submitted within `window` seconds of each other are sent
+    together: one batch reads the pending nonce of every address that is not
+    seeded yet, the transactions are signed locally, and one more batch
+    sends them all. Each caller gets the result of its own transaction.
+    Everything else is delegated to the wrapped PaymentContract.
+    """
+
+    def __init__(self, payment, window=0.05, max_batch=100):
+        self.payment = payment
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = Queue()
+        worker = Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+
+    def __getattr__(self, name):
+        return getattr(self.payment, name)
+
+    def pay(self, addr, key, value, attempts=PAYMENT_ATTEMPTS):
+        """Send a payment from `addr` and return the transaction hash."""
+        future = Future()
+        self._queue.put((addr, key, value, attempts, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+            try:
+                self._send(batch)
+            except Exception as e:
+                for _, _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _send(self, batch):
+        provider = self.payment.w3.provider
+        nonces = self.payment.nonces
+        unseeded = dict()
+        for addr, _, _, _, _ in batch:
+            if not nonces.is_seeded(addr):
+                unseeded.setdefault(addr.lower(), addr)
+        unseeded = list(unseeded.values())
+        if unseeded:
+            responses = provider.make_batch_request(
+                [('eth_getTransactionCount', [addr, 'pending']) for addr in unseeded])
+            for addr, response in zip(unseeded, responses):
+                if 'result' in response:
+                    nonces.seed(addr, int(response['result'], 16))
+        sends = list()
+        for item in batch:
+            addr, key, value, _, future = item
+            try:
+                nonce = nonces.allocate(addr)
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            try:
+                raw = self.payment.build_payment(key, nonce, value)
+            except Exception as e:
+                nonces.release(addr, nonce)
+                future.set_exception(e)
+                continue
+            sends.append((item, nonce, raw))
+        if not sends:
+            return
+        responses = provider.make_batch_request(
+            [('eth_sendRawTransaction', [self.payment.w3.toHex(raw)]) for _, _, raw in sends])
+        for (item, nonce, _), response in zip(sends, responses):
+            addr, key, value, attempts, future = item
+            if 'error' in response:
+                error = ValueError(response['error'].get('message'))
+                if not is_nonce_error(error):
+                    nonces.release(addr, nonce)
+                    future.set_exception(error)
+                    continue
+                nonces.resync(addr)
+                if attempts > 1:
+                    # Retry in the next batch with a nonce read from the chain.
+                    self._queue.put((addr, key, value, attempts - 1, future))
+                else:
+                    future.set_exception(error)
+            else:
+                future.set_result(response['result'])
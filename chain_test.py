@@ -0,0 +1,203 @@
+"""Tests for the nonce allocation and batching of payments."""
+
+from threading import Barrier, Lock, Thread
+
+import chain
+
+ADDRESS = '0x00000000000000000000000000000000000000AA'
+
+
+class _Eth(object):
+    """The node's pending transaction count of every address."""
+
+    def __init__(self, count=0):
+        self.count = count
+        self.reads = 0
+        self._mutex = Lock()
+
+    def getTransactionCount(self, addr, block):
+        with self._mutex:
+            self.reads += 1
+            return self.count
+
+
+class _Web3(object):
+    def __init__(self, count=0):
+        self.eth = _Eth(count)
+
+
+def test_nonces_are_seeded_once_then_allocated_locally():
+    w3 = _Web3(count=5)
+    nonces = chain.NonceManager(w3)
+    assert [nonces.allocate(ADDRESS) for _ in range(3)] == [5, 6, 7]
+    assert nonces.allocate(ADDRESS.lower()) == 8
+    assert w3.eth.reads == 1
+
+
+def test_resync_takes_the_larger_of_local_and_chain():
+    w3 = _Web3(count=5)
+    nonces = chain.NonceManager(w3)
+    for _ in range(3):
+        nonces.allocate(ADDRESS)
+
+    # Another replica sent two payments from the address.
+    w3.eth.count = 10
+    nonces.resync(ADDRESS)
+    assert not nonces.is_seeded(ADDRESS)
+    assert nonces.allocate(ADDRESS) == 10
+
+    # The chain lags behind the payments still in flight here.
+    w3.eth.count = 6
+    nonces.resync(ADDRESS)
+    assert nonces.allocate(ADDRESS) == 11
+    assert w3.eth.reads == 3
+
+
+def test_release_gives_back_only_the_last_nonce():
+    nonces = chain.NonceManager(_Web3(count=0))
+    first = nonces.allocate(ADDRESS)
+    second = nonces.allocate(ADDRESS)
+    # A later nonce is in flight, so the first one cannot be reused.
+    nonces.release(ADDRESS, first)
+    assert nonces.allocate(ADDRESS) == 2
+    nonces.release(ADDRESS, 2)
+    assert nonces.allocate(ADDRESS) == 2
+    assert second == 1
+
+
+def test_concurrent_allocations_across_a_resync_are_unique():
+    w3 = _Web3(count=0)
+    nonces = chain.NonceManager(w3)
+    threads = 8
+    barrier = Barrier(threads)
+    allocated = list()
+    mutex = Lock()
+
+    def allocate():
+        barrier.wait()
+        for i in range(50):
+            if i == 25:
+                w3.eth.count = 100
+                nonces.resync(ADDRESS)
+            nonce = nonces.allocate(ADDRESS)
+            with mutex:
+                allocated.append(nonce)
+
+    workers = [Thread(target=allocate) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert len(allocated) == len(set(allocated)) == threads * 50
+    # Nonces run on from the local ones, or jump once to the chain's count.
+    allocated.sort()
+    gaps = [(a, b) for a, b in zip(allocated, allocated[1:]) if b != a + 1]
+    assert allocated[0] == 0
+    assert gaps == [] or (len(gaps) == 1 and gaps[0][1] == 100)
+    assert w3.eth.reads <= 1 + threads
+
+
+class _Provider(object):
+    """A node answering JSON-RPC batches of counts and raw transactions.
+
+    A raw transaction is 'addr:nonce'; nonces below the address's count
+    are rejected as already used, and addresses in `broke` cannot pay.
+    """
+
+    def __init__(self):
+        self.counts = dict()
+        self.broke = set()
+        self.batches = list()
+        self._mutex = Lock()
+
+    def make_batch_request(self, calls):
+        with self._mutex:
+            self.batches.append([method for method, _ in calls])
+            return [self._call(method, params) for method, params in calls]
+
+    def _call(self, method, params):
+        if method == 'eth_getTransactionCount':
+            return {'result': hex(self.counts.get(params[0].lower(), 0))}
+        addr, nonce = bytes.fromhex(params[0][2:]).decode('ascii').split(':')
+        nonce = int(nonce)
+        if addr in self.broke:
+            return {'error': {'message': 'insufficient funds for gas * price + value'}}
+        if nonce < self.counts.get(addr, 0):
+            return {'error': {'message': 'nonce too low'}}
+        self.counts[addr] = nonce + 1
+        return {'result': '0x{}{:04x}'.format(addr[-2:], nonce)}
+
+
+class _Payment(object):
+    def __init__(self, provider):
+        self.w3 = _Web3()
+        self.w3.provider = provider
+        self.w3.toHex = lambda raw: '0x' + raw.hex()
+        self.nonces = chain.NonceManager(self.w3)
+
+    def build_payment(self, key, nonce, value):
+        return '{}:{}'.format(key, nonce).encode('ascii')
+
+
+def _pay_concurrently(payments, addresses):
+    """Pay from every address at once; returns results or errors in order."""
+    results = [None] * len(addresses)
+
+    def pay(i):
+        try:
+            results[i] = payments.pay(addresses[i], addresses[i].lower(), 1)
+        except ValueError as e:
+            results[i] = e
+
+    workers = [Thread(target=pay, args=(i,)) for i in range(len(addresses))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+ADDRESSES = ['0x00000000000000000000000000000000000000{:02X}'.format(i)
+             for i in range(0xa0, 0xa4)]
+
+
+def test_concurrent_payments_share_two_batches():
+    provider = _Provider()
+    provider.counts[ADDRESSES[1].lower()] = 7
+    payments = chain.BatchedPayments(_Payment(provider), window=0.5)
+
+    results = _pay_concurrently(payments, ADDRESSES + ADDRESSES[:1])
+
+    assert provider.batches == [
+        ['eth_getTransactionCount'] * 4, ['eth_sendRawTransaction'] * 5]
+    assert results[1] == '0xa10007'
+    assert sorted([results[0], results[4]]) == ['0xa00000', '0xa00001']
+
+
+def test_nonce_error_is_retried_with_the_chain_count():
+    provider = _Provider()
+    payment = _Payment(provider)
+    payments = chain.BatchedPayments(payment, window=0.01)
+    assert payments.pay(ADDRESSES[0], ADDRESSES[0].lower(), 1) == '0xa00000'
+
+    # Another replica paid twice from the address.
+    provider.counts[ADDRESSES[0].lower()] = 3
+    assert payments.pay(ADDRESSES[0], ADDRESSES[0].lower(), 1) == '0xa00003'
+    assert provider.batches[2:] == [
+        ['eth_sendRawTransaction'], ['eth_getTransactionCount'],
+        ['eth_sendRawTransaction']]
+    assert payment.nonces.allocate(ADDRESSES[0]) == 4
+
+
+def test_other_errors_fail_without_retry():
+    provider = _Provider()
+    provider.broke.add(ADDRESSES[0].lower())
+    payment = _Payment(provider)
+    payments = chain.BatchedPayments(payment, window=0.01)
+
+    error = _pay_concurrently(payments, ADDRESSES[:1])[0]
+    assert 'insufficient funds' in str(error)
+    assert provider.batches == [['eth_getTransactionCount'], ['eth_sendRawTransaction']]
+    # The rejected nonce is free for the next payment.
+    assert payment.nonces.allocate(ADDRESSES[0]) == 0
@@ -0,0 +1,169 @@
+"""Chunked delivery of files over the Cloud IoT device config channel.
+
+A device config is limited to 64 KiB, which a few seconds of base64 encoded
+audio already exceeds. A file is therefore sent as a manifest, carrying its
+size, chunk count and SHA-256, followed by numbered chunks pushed in order.
+The receiving device appends every chunk straight to a partial file and only
+moves it into place once the checksum matches, so neither end ever holds
+the whole file in memory.
+"""
+
+import base64
+import hashlib
+import io
+import os
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+
+# Raw bytes per chunk; base64 and the JSON envelope keep the config below
+# the 64 KiB limit.
+CHUNK_SIZE = 45 * 1024
+# Seconds after which a transfer still missing chunks is abandoned, e.g.
+# because the sender gave up on it.
+TRANSFER_TIMEOUT = 600
+# Finished transfer ids remembered to ignore redelivered manifests.
+FINISHED_TRANSFERS = 1000
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with io.open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def transfer_messages(msg_type, path, chunk_size=CHUNK_SIZE, **fields):
+    """Yield the manifest and chunk payloads that deliver the file at `path`.
+
+    Extra keyword arguments (image name, node id, ...) go into the manifest.
+    """
+    size = os.path.getsize(path)
+    transfer_id = uuid.uuid4().hex
+    manifest = {
+        'type': msg_type,
+        'part': 'manifest',
+        'transfer_id': transfer_id,
+        'size': size,
+        'chunks': (size + chunk_size - 1) // chunk_size,
+        'sha256': file_sha256(path),
+    }
+    manifest.update(fields)
+    yield manifest
+    with io.open(path, 'rb') as f:
+        seq = 0
+        for block in iter(lambda: f.read(chunk_size), b''):
+            yield {
+                'type': msg_type,
+                'part': 'chunk',
+                'transfer_id': transfer_id,
+                'seq': seq,
+                'data': base64.b64encode(block).decode('ascii'),
+            }
+            seq += 1
+
+
+class _Transfer(object):
+
+    def __init__(self, manifest, path):
+        self.manifest = manifest
+        self.path = path
+        self.part_path = path + '.part'
+        self.next_seq = 0
+        self.sha = hashlib.sha256()
+        self.started = time.time()
+        self.file = io.open(self.part_path, 'wb')
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+
+class Reassembler(object):
+    """Rebuilds files from manifest and chunk payloads.
+
+    A transfer that got no chunk to finish it within `timeout` seconds is
+    discarded with its partial file.
+    """
+
+    def __init__(self, timeout=TRANSFER_TIMEOUT, max_finished=FINISHED_TRANSFERS):
+        self.timeout = timeout
+        self.max_finished = max_finished
+        self._transfers = dict()
+        # Ids of finished transfers, oldest first; the values are unused.
+        self._finished = OrderedDict()
+        self._mutex = Lock()
+
+    def __len__(self):
+        """Transfers still waiting for chunks."""
+        return len(self._transfers)
+
+    def _expire(self, now):
+        for transfer_id, transfer in list(self._transfers.items()):
+            if now - transfer.started > self.timeout:
+                del self._transfers[transfer_id]
+                transfer.discard()
+
+    def _finish(self, transfer_id):
+        self._finished[transfer_id] = None
+        while len(self._finished) > self.max_finished:
+            self._finished.popitem(last=False)
+
+    def start(self, manifest, path):
+        """Begin receiving the transfer described by `manifest` into `path`.
+
+        Returns the manifest if the file is empty and so already complete.
+        """
+        with self._mutex:
+            self._expire(time.time())
+            transfer_id = manifest['transfer_id']
+            if transfer_id in self._transfers or transfer_id in self._finished:
+                # The config channel redelivers the latest config on reconnect.
+                return None
+            transfer = _Transfer(manifest, path)
+            if manifest['chunks'] == 0:
+                transfer.file.close()
+                os.replace(transfer.part_path, path)
+                self._finish(transfer_id)
+                return manifest
+            self._transfers[transfer_id] = transfer
+            return None
+
+    def add_chunk(self, chunk):
+        """Append a chunk to its file.
+
+        Returns the manifest of the transfer once its last chunk arrived and
+        the file was verified, and None otherwise. Raises ValueError when a
+        chunk is missing or the checksum does not match; the partial file is
+        discarded in that case.
+        """
+        with self._mutex:
+            self._expire(time.time())
+            transfer = self._transfers.get(chunk['transfer_id'])
+            if transfer is None or chunk['seq'] < transfer.next_seq:
+                # Unknown transfer or a redelivered chunk.
+                return None
+            if chunk['seq'] != transfer.next_seq:
+                self._transfers.pop(chunk['transfer_id']).discard()
+                raise ValueError('Expected chunk {} of transfer {}, got {}'.format(
+                    transfer.next_seq, chunk['transfer_id'], chunk['seq']))
+            block = base64.b64decode(chunk['data'])
+            transfer.file.write(block)
+            transfer.sha.update(block)
+            transfer.next_seq += 1
+            if transfer.next_seq < transfer.manifest['chunks']:
+                return None
+            self._transfers.pop(chunk['transfer_id'])
+            self._finish(chunk['transfer_id'])
+            transfer.file.close()
+            if transfer.sha.hexdigest() != transfer.manifest['sha256']:
+                transfer.discard()
+                raise ValueError('Checksum mismatch for transfer {}'.format(
+                    chunk['transfer_id']))
+            os.replace(transfer.part_path, transfer.path)
+            return transfer.manifest
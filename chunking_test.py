@@ -0,0 +1,130 @@
+"""Tests for the chunked file transfers."""
+
+import os
+
+import pytest
+
+import chunking
+
+
+def _messages(tmp_path, data, chunk_size=4):
+    source = tmp_path / 'source.mp3'
+    source.write_bytes(data)
+    return list(chunking.transfer_messages(
+        'POLRES', str(source), chunk_size=chunk_size, img_name='img0.jpg'))
+
+
+def test_stale_transfer_is_discarded(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(chunking.time, 'time', lambda: now[0])
+    reassembler = chunking.Reassembler(timeout=60)
+    manifest, first = _messages(tmp_path, b'0123456789')[:2]
+    target = str(tmp_path / 'sound.mp3')
+    reassembler.start(manifest, target)
+    reassembler.add_chunk(first)
+    assert len(reassembler) == 1
+
+    # The sender gave up; the next transfer clears the stale one.
+    now[0] += 61
+    other = _messages(tmp_path, b'abc')[0]
+    reassembler.start(other, str(tmp_path / 'other.mp3'))
+    assert len(reassembler) == 1
+    assert not os.path.exists(target + '.part')
+
+
+def test_finished_transfers_are_bounded(tmp_path):
+    reassembler = chunking.Reassembler(max_finished=2)
+    manifests = [_messages(tmp_path, b'')[0] for _ in range(3)]
+    for i, manifest in enumerate(manifests):
+        target = str(tmp_path / 'sound{}.mp3'.format(i))
+        assert reassembler.start(manifest, target) == manifest
+    # The newest ids are still recognised as redelivered.
+    assert reassembler.start(manifests[-1], str(tmp_path / 'again.mp3')) is None
+    assert not os.path.exists(str(tmp_path / 'again.mp3'))
+    assert len(reassembler._finished) == 2
+
+
+def _receive(reassembler, messages, target):
+    result = reassembler.start(messages[0], target)
+    for chunk in messages[1:]:
+        result = reassembler.add_chunk(chunk) or result
+    return result
+
+
+def test_file_is_rebuilt_in_place(tmp_path):
+    data = os.urandom(10)
+    messages = _messages(tmp_path, data)
+    assert messages[0]['chunks'] == 3
+    assert messages[0]['img_name'] == 'img0.jpg'
+    target = str(tmp_path / 'sound.mp3')
+
+    manifest = _receive(chunking.Reassembler(), messages, target)
+
+    assert manifest == messages[0]
+    with open(target, 'rb') as f:
+        assert f.read() == data
+    assert not os.path.exists(target + '.part')
+
+
+def test_empty_file_completes_on_its_manifest(tmp_path):
+    manifest = _messages(tmp_path, b'')[0]
+    assert manifest['chunks'] == 0
+    target = str(tmp_path / 'sound.mp3')
+    reassembler = chunking.Reassembler()
+
+    assert reassembler.start(manifest, target) == manifest
+    assert len(reassembler) == 0
+    with open(target, 'rb') as f:
+        assert f.read() == b''
+
+
+def test_redelivered_manifest_and_chunks_are_ignored(tmp_path):
+    data = os.urandom(10)
+    manifest, first, second, third = _messages(tmp_path, data)
+    target = str(tmp_path / 'sound.mp3')
+    reassembler = chunking.Reassembler()
+
+    assert reassembler.start(manifest, target) is None
+    assert reassembler.add_chunk(first) is None
+    # The config channel hands out the latest config again on reconnect.
+    assert reassembler.start(manifest, target) is None
+    assert reassembler.add_chunk(first) is None
+    assert reassembler.add_chunk(second) is None
+    assert reassembler.add_chunk(third) == manifest
+    assert reassembler.add_chunk(third) is None
+    assert reassembler.start(manifest, target) is None
+    with open(target, 'rb') as f:
+        assert f.read() == data
+
+
+def test_out_of_order_chunk_discards_the_transfer(tmp_path):
+    manifest, first, second, third = _messages(tmp_path, os.urandom(10))
+    target = str(tmp_path / 'sound.mp3')
+    reassembler = chunking.Reassembler()
+    reassembler.start(manifest, target)
+    reassembler.add_chunk(first)
+
+    with pytest.raises(ValueError):
+        reassembler.add_chunk(third)
+
+    assert len(reassembler) == 0
+    assert not os.path.exists(target + '.part')
+    # The rest of the transfer is dropped without error.
+    assert reassembler.add_chunk(second) is None
+    assert not os.path.exists(target)
+
+
+def test_checksum_mismatch_discards_the_file(tmp_path):
+    manifest, first, second, third = _messages(tmp_path, os.urandom(10))
+    manifest['sha256'] = chunking.hashlib.sha256(b'other audio').hexdigest()
+    target = str(tmp_path / 'sound.mp3')
+    reassembler = chunking.Reassembler()
+    reassembler.start(manifest, target)
+    reassembler.add_chunk(first)
+    reassembler.add_chunk(second)
+
+    with pytest.raises(ValueError):
+        reassembler.add_chunk(third)
+
+    assert not os.path.exists(target)
+    assert not os.path.exists(target + '.part')
@@ -0,0 +1,203 @@
+"""Claim-check transfer of images through object storage.
+
+A REKJOB or REKACK used to carry its image as base64 on the central topic.
+With a claim-check store the device uploads the image once, under the
+SHA-256 of its bytes, and the message only carries the reference:
+
+  {'type': 'REKJOB', ..., 'img_ref': 's3://bucket/images/<sha256>'}
+
+The node that takes the job fetches the object itself, and checks it
+against the key. Images at or below the inline threshold still travel in
+`img_data`: for them the upload and the fetch cost more than the bytes.
+
+Stores are named by URL, s3://bucket/prefix for S3 or file:///directory
+for a directory all processes on one machine share, as the benchmark does.
+Because keys are content hashes, an image sent again (a new bid round, a
+second device with the same picture) is uploaded only once.
+"""
+
+import base64
+import hashlib
+import io
+import os
+from threading import Lock
+from urllib.parse import urlparse
+
+# Raw image bytes up to which an image is sent inline.
+INLINE_THRESHOLD = 64 * 1024
+
+
+class ClaimCheckError(Exception):
+    """A referenced image is missing or does not match its key."""
+
+
+def content_key(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class LocalStore(object):
+    """Images in a directory, for a single machine and the benchmark."""
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def url(self, key):
+        return 'file://' + os.path.join(self.directory, key)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.directory, key))
+
+    def put(self, key, data):
+        path = os.path.join(self.directory, key)
+        tmp_path = '{}.{}.tmp'.format(path, id(data))
+        with io.open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def get(self, key):
+        try:
+            with io.open(os.path.join(self.directory, key), 'rb') as f:
+                return f.read()
+        except (IOError, OSError) as e:
+            raise ClaimCheckError('Cannot read image {}: {}'.format(key, e))
+
+
+class S3Store(object):
+    """Images in an S3 bucket under `prefix`."""
+
+    def __init__(self, bucket, prefix='', endpoint_url=None):
+        import boto3
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self._s3 = boto3.client('s3', region_name='us-east-1',
+                                endpoint_url=endpoint_url)
+
+    def url(self, key):
+        return 's3://{}/{}{}'.format(self.bucket, self.prefix, key)
+
+    def exists(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            self._s3.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except ClientError:
+            return False
+
+    def put(self, key, data):
+        self._s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data)
+
+    def get(self, key):
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self._s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+            return response['Body'].read()
+        except ClientError as e:
+            raise ClaimCheckError('Cannot read image {}: {}'.format(key, e))
+
+
+def open_store(url, endpoint_url=None):
+    """Return the store a URL names; a plain path is a local directory."""
+    parsed = urlparse(url)
+    if parsed.scheme == 's3':
+        prefix = parsed.path.lstrip('/')
+        if prefix and not prefix.endswith('/'):
+            prefix += '/'
+        return S3Store(parsed.netloc, prefix, endpoint_url)
+    if parsed.scheme in ('', 'file'):
+        return LocalStore(parsed.path)
+    raise ValueError('Unsupported claim-check store: {}'.format(url))
+
+
+def split_reference(ref):
+    """Return the URL of the store holding a referenced image, and its key."""
+    base, _, key = ref.rpartition('/')
+    if len(key) != 64:
+        raise ClaimCheckError('Invalid image reference: {}'.format(ref))
+    return base + '/', key
+
+
+def s3_location(ref):
+    """Return (bucket, object key) of an S3 reference, or None."""
+    if ref is None:
+        return None
+    parsed = urlparse(ref)
+    if parsed.scheme != 's3':
+        return None
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+class Sender(object):
+    """Puts the images of outgoing payloads inline or in the store."""
+
+    def __init__(self, store=None, threshold=INLINE_THRESHOLD):
+        self.store = store
+        self.threshold = threshold
+        self._stored = set()
+        self._mutex = Lock()
+
+    def attach(self, payload_json, data):
+        """Add the image `data` to a payload as img_data or img_ref."""
+        if self.store is None or len(data) <= self.threshold:
+            payload_json['img_data'] = base64.b64encode(data).decode('utf-8')
+            return payload_json
+        key = content_key(data)
+        with self._mutex:
+            stored = key in self._stored
+        if not stored:
+            if not self.store.exists(key):
+                self.store.put(key, data)
+            with self._mutex:
+                self._stored.add(key)
+        payload_json['img_ref'] = self.store.url(key)
+        return payload_json
+
+
+class Fetcher(object):
+    """Returns the image of a received payload, fetching it if referenced."""
+
+    def __init__(self, endpoint_url=None):
+        self.endpoint_url = endpoint_url
+        self._stores = dict()
+        self._mutex = Lock()
+
+    def _store(self, url):
+        with self._mutex:
+            store = self._stores.get(url)
+            if store is None:
+                store = self._stores[url] = open_store(url, self.endpoint_url)
+            return store
+
+    def load(self, data):
+        """Return the image bytes of a payload.
+
+        Raises ClaimCheckError when the referenced image is missing or its
+        bytes do not hash to its key.
+        """
+        ref = data.get('img_ref')
+        if ref is None:
+            return base64.b64decode(data['img_data'])
+        url, key = split_reference(ref)
+        image_data = self._store(url).get(key)
+        if content_key(image_data) != key:
+            raise ClaimCheckError('Image {} does not match its key'.format(ref))
+        return image_data
+
+
+def add_arguments(parser):
+    """Add the claim-check flags of the device to an argparse parser."""
+    parser.add_argument(
+        '--claim_check_store',
+        default=None,
+        help=('Upload images larger than --inline_threshold to this store, '
+              's3://bucket/prefix or file:///directory, and send only their '
+              'reference. Without it every image is sent inline.'))
+    parser.add_argument(
+        '--inline_threshold',
+        type=int,
+        default=INLINE_THRESHOLD,
+        help='Largest image in bytes sent inline in the job message.')
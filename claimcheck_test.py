@@ -0,0 +1,43 @@
+"""Tests for the claim-check image transfer."""
+
+import base64
+
+import pytest
+
+import claimcheck
+
+
+def test_small_images_travel_inline(tmp_path):
+    sender = claimcheck.Sender(claimcheck.LocalStore(str(tmp_path)), threshold=4)
+    payload = sender.attach({'img_name': 'img0.jpg'}, b'jpeg')
+    assert base64.b64decode(payload['img_data']) == b'jpeg'
+    assert 'img_ref' not in payload
+    assert claimcheck.Fetcher().load(payload) == b'jpeg'
+
+
+def test_large_images_are_stored_once_and_fetched(tmp_path):
+    store = claimcheck.LocalStore(str(tmp_path))
+    sender = claimcheck.Sender(store, threshold=4)
+    first = sender.attach({}, b'a larger jpeg')
+    second = sender.attach({}, b'a larger jpeg')
+    assert first == second
+    assert 'img_data' not in first
+    assert len(list(tmp_path.iterdir())) == 1
+    assert claimcheck.Fetcher().load(first) == b'a larger jpeg'
+
+
+def test_fetched_image_must_match_its_key(tmp_path):
+    store = claimcheck.LocalStore(str(tmp_path))
+    key = claimcheck.content_key(b'a larger jpeg')
+    store.put(key, b'tampered')
+    with pytest.raises(claimcheck.ClaimCheckError):
+        claimcheck.Fetcher().load({'img_ref': store.url(key)})
+    with pytest.raises(claimcheck.ClaimCheckError):
+        claimcheck.Fetcher().load({'img_ref': store.url('0' * 64)})
+
+
+def test_s3_location():
+    ref = 's3://bucket/images/' + '0' * 64
+    assert claimcheck.s3_location(ref) == ('bucket', 'images/' + '0' * 64)
+    assert claimcheck.s3_location('file:///tmp/' + '0' * 64) is None
+    assert claimcheck.s3_location(None) is None
@@ -40,14 +40,16 @@ With a single server, you can run multiple instances of the device with
 different device ids, and the server will distinguish them. Try creating a few
 devices and running them all at the same time.
 """
-from web3 import Web3, HTTPProvider
 import argparse
 import datetime
 import json
+import logging
 import os
 import ssl
+import sys
 import time
-from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
 
 import jwt
 import paho.mqtt.client as mqtt
@@ -60,6 +62,17 @@ from google.cloud import pubsub
 from google.cloud import pubsub_v1
 from google.oauth2 import service_account
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+
+import chain
+import logutil
+import metrics
+import payindex
+import routing
+import sessions
+import sharding
+import tracing
+import transport
 
 
 v_count = 0
@@ -69,6 +82,29 @@ API_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
 API_VERSION = 'v1'
 DISCOVERY_API = 'https://cloudiot.googleapis.com/$discovery/rest'
 SERVICE_NAME = 'cloudiot'
+# Threads and queue for the busy replies to rejected auth requests. Each
+# reply sleeps out the config delay, so beyond these the reply is dropped
+# and the device retries after its --auth_timeout.
+BUSY_REPLY_WORKERS = 2
+BUSY_REPLY_QUEUE = 8
+
+log = logging.getLogger('dappserver')
+message_log = logutil.message_logger('dappserver')
+
+AUTH_REQUESTS = metrics.counter(
+    'auth_requests_total',
+    'Auth requests by outcome: token, indexed, paid, unauthorized or busy.',
+    ['result'])
+AUTH_SECONDS = metrics.histogram(
+    'auth_seconds', 'Time to authorize a device and send it the result.')
+PAYMENT_SECONDS = metrics.histogram(
+    'payment_seconds', 'Time to send a payment and wait for its receipt.')
+AUTH_POOL = metrics.gauge(
+    'auth_pool_requests', 'Auth requests running or waiting in the auth pool.')
+CONFIG_UPDATES = metrics.counter(
+    'config_updates_total', 'Device config updates, by HTTP status.', ['status'])
+CONFIG_UPDATE_SECONDS = metrics.histogram(
+    'config_update_seconds', 'Latency of the ModifyCloudToDeviceConfig call.')
 
 def create_jwt(project_id, private_key_file, algorithm):
     """Create a JWT (https://jwt.io) to establish an MQTT connection."""
@@ -79,8 +115,8 @@ def create_jwt(project_id, private_key_file, algorithm):
     }
     with open(private_key_file, 'r') as f:
         private_key = f.read()
-    print('Creating JWT using {} from private key file {}'.format(
-        algorithm, private_key_file))
+    log.info('Creating JWT using %s from private key file %s',
+             algorithm, private_key_file)
     return jwt.encode(token, private_key, algorithm=algorithm)
 
 
@@ -92,7 +128,7 @@ def error_str(rc):
 class Device(object):
     """Represents the state of a single device."""
 
-    def __init__(self, dev_id, service_account_json, project_id, registry_id, region):
+    def __init__(self, dev_id, service_account_json, project_id, registry_id, region, session_secret, session_ttl, payment, auth_pool, payment_index=None, min_payment=1):
         self.temperature = 0
         self.fan_on = False
         self.connected = False
@@ -100,21 +136,32 @@ class Device(object):
         self.project_id = project_id
         self.registry_id = registry_id
         self.cloud_region = region
+        self.session_secret = session_secret
+        self.session_ttl = session_ttl
+        self.payment = payment
+        self.auth_pool = auth_pool
+        self.busy_pool = AuthPool(BUSY_REPLY_WORKERS, BUSY_REPLY_QUEUE)
+        self.payment_index = payment_index
+        self.min_payment = min_payment
         self.central_topic = 'projects/project2-277316/topics/my-topic'  
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_json).with_scopes(API_SCOPES)
-        if not credentials:
-            sys.exit('Could not load service account credential '
-                     'from {}'.format(service_account_json))
+        if transport.is_local():
+            # The local broker stands in for the Cloud IoT admin API.
+            self._service = transport.cloudiot_service()
+        else:
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_json).with_scopes(API_SCOPES)
+            if not credentials:
+                sys.exit('Could not load service account credential '
+                         'from {}'.format(service_account_json))
 
-        discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
+            discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
 
-        self._service = discovery.build(
-            SERVICE_NAME,
-            API_VERSION,
-            discoveryServiceUrl=discovery_url,
-            credentials=credentials,
-            cache_discovery=False)
+            self._service = discovery.build(
+                SERVICE_NAME,
+                API_VERSION,
+                discoveryServiceUrl=discovery_url,
+                credentials=credentials,
+                cache_discovery=False)
 
         # Used to serialize the calls to the
         # modifyCloudToDeviceConfig REST method. This is needed
@@ -145,15 +192,20 @@ class Device(object):
         # httplib2 library, which is not thread-safe.
         self._update_config_mutex.acquire()
         try:
-            request.execute()
-            time.sleep(5)
+            with CONFIG_UPDATE_SECONDS.time(), tracing.span(
+                    'ModifyCloudToDeviceConfig', kind=tracing.CLIENT, device=device_id):
+                request.execute()
+            CONFIG_UPDATES.labels(200).inc()
         except HttpError as e:
             # If the server responds with a HtppError, log it here, but
             # continue so that the message does not stay NACK'ed on the
             # pubsub channel.
-            print('Error executing ModifyCloudToDeviceConfig: {}'.format(e))
+            CONFIG_UPDATES.labels(e.resp.status).inc()
+            log.warning('Error executing ModifyCloudToDeviceConfig: %s', e)
         finally:
             self._update_config_mutex.release()
+        # Sleep outside the lock so concurrent replies are not serialized.
+        time.sleep(5)
 
     def get_id(self):
         return self.id
@@ -180,29 +232,29 @@ class Device(object):
 
     def on_connect(self, unused_client, unused_userdata, unused_flags, rc):
         """Callback for when a device connects."""
-        print('Connection Result:', error_str(rc))
+        log.info('Connection Result: %s', error_str(rc))
         self.connected = True
 
     def on_disconnect(self, unused_client, unused_userdata, rc):
         """Callback for when a device disconnects."""
-        print('Disconnected:', error_str(rc))
+        log.warning('Disconnected: %s', error_str(rc))
         self.connected = False
 
     def on_publish(self, unused_client, unused_userdata, unused_mid):
         """Callback when the device receives a PUBACK from the MQTT bridge."""
-        print('Published message acked.')
+        message_log.debug('Published message acked.')
 
     def on_subscribe(self, unused_client, unused_userdata, unused_mid, granted_qos):
         """Callback when the device receives a SUBACK from the MQTT bridge."""
-        print('Subscribed: ', granted_qos)
+        log.info('Subscribed: %s', granted_qos)
         if granted_qos[0] == 128:
-            print('Subscription failed.')
+            log.error('Subscription failed.')
 
     def on_message(self, unused_client, unused_userdata, message):
         """Callback when the device receives a message on a subscription."""
         payload = message.payload.decode('utf-8')
-        # print('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-        #     payload, message.topic, str(message.qos)))
+        message_log.debug('Received message \'%s\' on topic \'%s\' with Qos %s',
+                          logutil.truncate(payload), message.topic, message.qos)
 
         # The device will receive its latest config when it subscribes to the
         # config topic. If there is no configuration for the device, the device
@@ -212,53 +264,143 @@ class Device(object):
         # The config is passed in the payload of the message. In this example,
         # the server sends a serialized JSON string.
         try:
-            try:
-                data = json.loads(payload)
-            except ValueError as e:
-                print('Loading Payload ({}) threw an Exception: {}.'.format(
-                    message.data, e))
-                message.ack()
-                return
+            data = json.loads(payload)
+        except ValueError as e:
+            log.warning('Loading Payload (%s) threw an Exception: %s.',
+                        logutil.truncate(payload), e)
+            return
+        # The payment and the reply to the device take many seconds, so they
+        # run on the auth pool and this MQTT network thread stays free.
+        if not self.auth_pool.submit(self.handle_auth_request, data):
+            AUTH_REQUESTS.labels('busy').inc()
+            log.warning("Auth pool is full, rejecting device %s", data['id'])
+            if not self.busy_pool.submit(self._reply, data['id'], tracing.inject(
+                    {'status': 'busy'}, tracing.extract(data))):
+                message_log.info("Dropping busy reply to device %s", data['id'])
+
+    def on_auth_message(self, message):
+        """Pub/Sub callback for an auth request on the auth subscription.
+
+        Unlike the config channel, every request is delivered: a message is
+        only acked once the device has been answered, and is nacked for
+        redelivery when the pool is full or the request fails.
+        """
+        if not routing.accepts(message.attributes, 'dapp', self.id):
+            message.ack()
+            return
+        try:
+            data = json.loads(message.data.decode('utf-8'))
+        except ValueError as e:
+            log.warning('Loading Payload (%s) threw an Exception: %s.',
+                        logutil.truncate(message.data), e)
+            message.ack()
+            return
+        if not self.auth_pool.submit(self._handle_auth_message, message, data):
+            AUTH_REQUESTS.labels('busy').inc()
+            message.nack()
+
+    def _handle_auth_message(self, message, data):
+        try:
+            self.handle_auth_request(data)
+        except Exception:
+            message.nack()
+            raise
+        message.ack()
+
+    def handle_auth_request(self, data):
+        """Authorize a device and send it the result as configuration."""
+        with tracing.span('handle AUTH', parent=tracing.extract(data),
+                          kind=tracing.CONSUMER, device=data.get('id')):
+            started = time.time()
             dev_id = data['id']
             key = data['key']
             addr = data['address']
-            if(authenticate(addr, key)):
-                mqtt_config_topic = '/devices/{}/config/'.format(dev_id)
-                payload_json = {'status':'authorized', 'topic': self.central_topic}
-                payload = json.dumps(payload_json)
-                device_project_id = self.project_id
-                device_registry_id = self.registry_id
-                device_id = dev_id
-                device_region = self.cloud_region
-                print("Device " + dev_id + "authorized" + "\n\n\n")
-                # Send the config to the device.
-                self._update_device_config(
-                  device_project_id,
-                  device_region,
-                  device_registry_id,
-                  device_id,
-                  payload)
-                time.sleep(1)
+            # A device that already paid presents its session token, which is
+            # checked locally instead of sending another payment.
+            token = data.get('session_token')
+            if token and sessions.verify_token(self.session_secret, token, dev_id):
+                message_log.info("Device %s presented a valid session token", dev_id)
+                authorized = True
+                result = 'token'
+            else:
+                if self.has_paid(addr, key):
+                    message_log.info("Device %s already paid from %s", dev_id, addr)
+                    authorized = True
+                    result = 'indexed'
+                else:
+                    with PAYMENT_SECONDS.time(), tracing.span(
+                            'payment', kind=tracing.CLIENT, address=addr):
+                        authorized = authenticate(addr, key, self.payment)
+                    result = 'paid' if authorized else 'unauthorized'
+                if authorized:
+                    token = sessions.issue_token(
+                        self.session_secret, dev_id, addr, self.session_ttl)
+            if(authorized):
+                payload_json = {'status':'authorized', 'topic': self.central_topic, 'session_token': token}
+                message_log.info("Device %s authorized", dev_id)
             else:
-                mqtt_config_topic = '/devices/{}/config/'.format(dev_id)
                 payload_json = {'status':'unauthorized'}
-                payload = json.dumps(payload_json)
-                device_project_id = self.project_id
-                device_registry_id = self.registry_id
-                device_id = dev_id
-                device_region = self.cloud_region
-                print("Device " + dev_id + "not authorized" + "\n\n\n")
-                # Send the config to the device.
-                self._update_device_config(
-                  device_project_id,
-                  device_region,
-                  device_registry_id,
-                  device_id,
-                  payload)
-                time.sleep(1)
-                message.ack()
-        except binascii.Error:
-            message.ack()  # To move forward if a message can't be processed
+                message_log.info("Device %s not authorized", dev_id)
+            tracing.inject(payload_json)
+            self._reply(dev_id, payload_json)
+            AUTH_REQUESTS.labels(result).inc()
+            AUTH_SECONDS.observe(time.time() - started)
+
+    def has_paid(self, addr, key):
+        """Look the address up in the local payment index, if there is one.
+
+        The key is only checked against the address, so a device cannot
+        claim a payment made from an address it does not own.
+        """
+        if self.payment_index is None:
+            return False
+        return (self.payment_index.has_paid(addr, self.min_payment)
+                and self.payment.owns(addr, key))
+
+    def _reply(self, dev_id, payload_json):
+        payload = json.dumps(payload_json)
+        # Send the config to the device.
+        self._update_device_config(
+          self.project_id,
+          self.cloud_region,
+          self.registry_id,
+          dev_id,
+          payload)
+
+
+class AuthPool(object):
+    """A bounded pool of worker threads for authentication requests.
+
+    At most `workers` requests run at once and `max_pending` more may wait;
+    submit() refuses anything beyond that instead of blocking the caller.
+    """
+
+    def __init__(self, workers, max_pending):
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._slots = BoundedSemaphore(workers + max_pending)
+        self._pending = 0
+        self._mutex = Lock()
+
+    @property
+    def pending(self):
+        """Requests running or waiting for a worker."""
+        return self._pending
+
+    def submit(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            return False
+        with self._mutex:
+            self._pending += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, future):
+        with self._mutex:
+            self._pending -= 1
+        self._slots.release()
+        if future.exception() is not None:
+            log.error('Authentication request failed: %s', future.exception())
 
 
 def parse_command_line_args():
@@ -309,69 +451,177 @@ def parse_command_line_args():
         '--service_account_json',
         required=True,
         help='Path to service account json file.')
+    parser.add_argument(
+        '--provider_url',
+        default=chain.PROVIDER_URL,
+        help='HTTP JSON-RPC endpoint of the Ethereum node.')
+    parser.add_argument(
+        '--contract_address',
+        default=chain.CONTRACT_ADDRESS,
+        help='Address of the payment contract.')
+    parser.add_argument(
+        '--chain_id',
+        type=int,
+        default=chain.CHAIN_ID,
+        help='Chain id payments are signed for.')
+    parser.add_argument(
+        '--auth_workers',
+        type=int,
+        default=16,
+        help='Authentication requests processed concurrently.')
+    parser.add_argument(
+        '--auth_queue',
+        type=int,
+        default=256,
+        help='Authentication requests that may wait for a worker.')
+    parser.add_argument(
+        '--batch_window',
+        type=float,
+        default=0,
+        help=('Seconds to collect concurrent payments into one JSON-RPC '
+              'batch; 0 sends each payment on its own.'))
+    parser.add_argument(
+        '--auth_mode',
+        choices=('pay', 'index'),
+        default='pay',
+        help=('pay sends a payment for every new device; index first looks '
+              'the address up in a local index of the contract\'s payment '
+              'events and only sends a payment if it has not paid yet.'))
+    parser.add_argument(
+        '--payment_index',
+        default='payments.db',
+        help='SQLite file holding the payment event index.')
+    parser.add_argument(
+        '--index_from_block',
+        type=int,
+        default=0,
+        help='Block to start indexing payment events from on first run.')
+    parser.add_argument(
+        '--index_confirmations',
+        type=int,
+        default=12,
+        help='Blocks a payment needs on top of it before it is indexed.')
+    parser.add_argument(
+        '--session_secret',
+        default=os.environ.get('DAPP_SESSION_SECRET'),
+        help=('Secret used to sign session tokens. Defaults to a random one, '
+              'which invalidates all tokens when the server restarts. '
+              'Required with --replicas.'))
+    parser.add_argument(
+        '--replicas',
+        default='',
+        help=('Comma separated device ids of all DApp server replicas, the '
+              'list given to the devices\' --dapp_id. With more than one, '
+              'the replicas must share --session_secret.'))
+    parser.add_argument(
+        '--session_ttl',
+        type=int,
+        default=24 * 60 * 60,
+        help='Seconds a session token stays valid.')
+    parser.add_argument(
+        '--auth_subscription',
+        help=('Pub/Sub subscription to consume device auth requests from, in '
+              'addition to the requests written to this device\'s config.'))
+    parser.add_argument(
+        '--auth_topic',
+        help=('Pub/Sub topic devices publish auth requests to; used to create '
+              '--auth_subscription if it does not exist.'))
 
+    parser.add_argument(
+        '--transport',
+        choices=transport.TRANSPORTS,
+        default=transport.GOOGLE,
+        help=('google talks to Cloud IoT Core and Pub/Sub; local talks to the '
+              'broker started with localbus.py.'))
+    parser.add_argument(
+        '--local_broker',
+        default='localhost:50000',
+        help='host:port of the local broker for --transport=local.')
+    logutil.add_arguments(parser)
+    metrics.add_arguments(parser)
+    tracing.add_arguments(parser)
     return parser.parse_args()
 #Added code to encode image
 
-def authenticate(addr, cred):
-    print("address and credential is")
-    print(addr)
-    print(cred)
-    with open('paymentABI.json') as f:
-        paymentabi = json.load(f)
-
-    w3 = Web3(HTTPProvider("https://ropsten.infura.io/v3/f9c884008XXXXXXXXX6e5"))
-    unicorns = w3.eth.contract(address="0xfB6916095ca1dXXXXXXXXXXXXXXX74c37c5d359", abi=paymentabi)
-    nonce = w3.eth.getTransactionCount(addr) 
-    # user account  
-
-    # Build a transaction that invokes this contract's function, called transfer
-    unicorn_txn = unicorns.functions.pay().buildTransaction({
-        'chainId': 3,
-        'gas': 70000,
-        'gasPrice': w3.toWei('1', 'gwei'),
-        'nonce': nonce,
-        'value': w3.toWei('0.02', 'ether')
-        })
-    
-    # user private key
-    private_key = cred
-    
-    signed_txn = w3.eth.account.sign_transaction(unicorn_txn, private_key=private_key)
+def authenticate(addr, cred, payment=None):
+    # Never log the credential; it is the private key of the address.
+    message_log.debug("Paying from address %s", addr)
+    if payment is None:
+        payment = chain.PaymentContract()
+    w3 = payment.w3
 
     try:
-        w3.eth.sendRawTransaction(signed_txn.rawTransaction)
-        # w3.toHex(w3.keccak(signed_txn.rawTransaction))
+        tx_hash = payment.pay(addr, cred, w3.toWei('0.02', 'ether'))
+        # Sending only means the node accepted the transaction; the device
+        # has paid once it is mined without reverting.
+        if not payment.confirm(tx_hash):
+            log.warning('Transaction from %s reverted', addr)
+            return False
     except Exception as e:
-        print('Transaction failed', e)
+        log.warning('Transaction from %s failed: %s', addr, e)
         return False
     return True
 
 def main():
     args = parse_command_line_args()
-
-    # subscriber = pubsub.SubscriberClient()
+    transport.configure(args.transport, args.local_broker)
+    logutil.configure(args.device_id, args.log_level, args.log_format,
+                      args.log_sample_rate, args.log_payload_chars)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    tracing.configure(args.device_id, args.span_file)
+
+    # subscriber = transport.subscriber_client()
     # subscription_path = subscriber.subscription_path(
     #                           args.project_id,
     #                           args.pubsub_subscription)
 
-    # publisher = pubsub_v1.PublisherClient()
+    # publisher = transport.publisher_client()
     # Create the MQTT client and connect to Cloud IoT.
-    client = mqtt.Client(
+    client = transport.mqtt_client(
         client_id='projects/{}/locations/{}/registries/{}/devices/{}'.format(
             args.project_id,
             args.cloud_region,
             args.registry_id,
             args.device_id))
-    client.username_pw_set(
-        username='unused',
-        password=create_jwt(
-            args.project_id,
-            args.private_key_file,
-            args.algorithm))
-    client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
-
-    device = Device(args.device_id, args.service_account_json, args.project_id, args.registry_id, args.cloud_region)
+    if not transport.is_local():
+        client.username_pw_set(
+            username='unused',
+            password=create_jwt(
+                args.project_id,
+                args.private_key_file,
+                args.algorithm))
+        client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+
+    session_secret = args.session_secret
+    replicas = sharding.parse_replicas(args.replicas)
+    if len(replicas) > 1 and not session_secret:
+        # A device fails over to the next replica with the token it has.
+        sys.exit('--replicas needs a --session_secret shared by all replicas')
+    if not session_secret:
+        log.warning('No --session_secret given, session tokens will not survive '
+                    'a restart or a failover to another replica')
+        session_secret = base64.b64encode(os.urandom(32)).decode('ascii')
+    # One contract object and connection pool serve every authentication.
+    payment = chain.PaymentContract(
+        args.provider_url, args.contract_address, pool_size=args.auth_workers,
+        chain_id=args.chain_id)
+    auth_pool = AuthPool(args.auth_workers, args.auth_queue)
+    AUTH_POOL.set_function(lambda: auth_pool.pending)
+    payment_index = None
+    min_payment = 1
+    if args.auth_mode == 'index':
+        payment_index = payindex.PaymentIndex(args.payment_index, args.index_from_block)
+        # The index catches up in the background; lookups never wait for it.
+        payindex.PaymentIndexer(
+            payment.w3,
+            args.contract_address,
+            payment_index,
+            confirmations=args.index_confirmations).start()
+        min_payment = payment.contract.functions.minPayment().call()
+    if args.batch_window > 0:
+        payment = chain.BatchedPayments(payment, args.batch_window)
+    device = Device(args.device_id, args.service_account_json, args.project_id, args.registry_id, args.cloud_region, session_secret, args.session_ttl, payment, auth_pool, payment_index, min_payment)
     
     client.on_connect = device.on_connect
     client.on_publish = device.on_publish
@@ -392,10 +642,31 @@ def main():
     client.subscribe(mqtt_config_topic, qos=1)
     
     
+    if args.auth_subscription:
+        subscriber = transport.subscriber_client()
+        subscription_path = subscriber.subscription_path(
+                                  args.project_id,
+                                  args.auth_subscription)
+        if args.auth_topic:
+            routing.ensure_subscription(
+                subscriber,
+                subscription_path,
+                'projects/{}/topics/{}'.format(args.project_id, args.auth_topic),
+                'dapp',
+                args.device_id)
+        # Lease no more requests than the auth pool can hold, so the rest
+        # wait in the subscription instead of being nacked.
+        flow_control = pubsub_v1.types.FlowControl(
+            max_messages=args.auth_workers + args.auth_queue)
+        subscriber.subscribe(
+            subscription_path,
+            callback=device.on_auth_message,
+            flow_control=flow_control)
+
     time.sleep(2000000)
     client.disconnect()
     client.loop_stop()
-    print('Finished loop successfully. Goodbye!')
+    log.info('Finished loop successfully. Goodbye!')
 
 
 if __name__ == '__main__':
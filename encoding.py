@@ -0,0 +1,98 @@
+"""Pick the Polly output encoding that fits a device's payload budget.
+
+Devices declare a class when they request audio. Each class has a payload
+budget and the formats its players understand. The polly node estimates how
+long the caption will be spoken from its length and picks the best quality
+encoding whose expected size fits the budget, falling back to the smallest
+one when none does. When the synthesized audio turns out larger than
+expected, its real size gives the duration for a second choice.
+"""
+
+import io
+import wave
+
+# Device class -> (payload budget in bytes or None for no limit, formats).
+DEVICE_CLASSES = {
+    'standard': (256 * 1024, ('mp3', 'ogg_vorbis')),
+    'constrained': (48 * 1024, ('mp3', 'ogg_vorbis')),
+    'pcm': (512 * 1024, ('pcm',)),
+    'unlimited': (None, ('mp3', 'ogg_vorbis')),
+}
+
+# (output format, sample rate, approximate bytes per second of speech),
+# best quality first.
+ENCODINGS = (
+    ('mp3', '22050', 6000),
+    ('ogg_vorbis', '22050', 5000),
+    ('pcm', '16000', 32000),
+    ('mp3', '16000', 4000),
+    ('ogg_vorbis', '16000', 3500),
+    ('pcm', '8000', 16000),
+    ('ogg_vorbis', '8000', 2000),
+    ('mp3', '8000', 2000),
+)
+
+# File extension the device stores each format under.
+EXTENSIONS = {'mp3': 'mp3', 'ogg_vorbis': 'ogg', 'pcm': 'wav'}
+
+# Used to estimate the length of the last word and when there are no marks.
+MS_PER_CHAR = 70
+TRAILING_SILENCE = 0.3
+
+
+def parse_budgets(values):
+    """Parse CLASS=BYTES overrides into a copy of DEVICE_CLASSES."""
+    classes = dict(DEVICE_CLASSES)
+    for value in values or ():
+        name, _, budget = value.partition('=')
+        formats = classes.get(name, DEVICE_CLASSES['standard'])[1]
+        classes[name] = (int(budget) if budget else None, formats)
+    return classes
+
+
+def estimate_duration(marks, text):
+    """Estimate in seconds how long Polly takes to speak `text`.
+
+    `marks` are Polly speech marks for the text; the last word mark tells
+    when the final word starts, and its length approximates the rest.
+    """
+    words = [mark for mark in marks if mark.get('type') == 'word']
+    if not words:
+        return len(text) * MS_PER_CHAR / 1000.0 + TRAILING_SILENCE
+    last = words[-1]
+    end = last['time'] + len(last.get('value', '')) * MS_PER_CHAR
+    return end / 1000.0 + TRAILING_SILENCE
+
+
+def audio_duration(size, output_format, sample_rate):
+    """Estimate in seconds the speech in `size` bytes of audio."""
+    for encoding_format, encoding_rate, bytes_per_second in ENCODINGS:
+        if (encoding_format, encoding_rate) == (output_format, sample_rate):
+            return float(size) / bytes_per_second
+    raise ValueError('Unknown encoding {} at {} Hz'.format(output_format, sample_rate))
+
+
+def choose_encoding(duration, budget, formats):
+    """Return (output format, sample rate) for speech of `duration` seconds."""
+    smallest = None
+    for output_format, sample_rate, bytes_per_second in ENCODINGS:
+        if output_format not in formats:
+            continue
+        size = duration * bytes_per_second
+        if budget is None or size <= budget:
+            return output_format, sample_rate
+        if smallest is None or size < smallest[2]:
+            smallest = (output_format, sample_rate, size)
+    return smallest[0], smallest[1]
+
+
+def pcm_to_wav(data, sample_rate):
+    """Wrap Polly's raw 16-bit mono PCM in a WAV container."""
+    out = io.BytesIO()
+    wav = wave.open(out, 'wb')
+    wav.setnchannels(1)
+    wav.setsampwidth(2)
+    wav.setframerate(int(sample_rate))
+    wav.writeframes(data)
+    wav.close()
+    return out.getvalue()
@@ -0,0 +1,59 @@
+"""Tests for the choice of Polly output encoding."""
+
+import io
+import wave
+
+import pytest
+
+import encoding
+
+
+def test_estimate_without_marks_uses_text_length():
+    duration = encoding.estimate_duration([], 'a' * 100)
+    assert abs(duration - (7.0 + encoding.TRAILING_SILENCE)) < 1e-9
+
+
+def test_estimate_ends_after_the_last_word():
+    marks = [
+        {'type': 'sentence', 'time': 0, 'value': 'a dog on grass'},
+        {'type': 'word', 'time': 0, 'value': 'a'},
+        {'type': 'word', 'time': 1000, 'value': 'grass'},
+    ]
+    duration = encoding.estimate_duration(marks, 'a dog on grass')
+    assert abs(duration - (1.35 + encoding.TRAILING_SILENCE)) < 1e-9
+
+
+def test_best_quality_encoding_within_budget():
+    assert encoding.choose_encoding(2.0, None, ('mp3', 'ogg_vorbis')) == ('mp3', '22050')
+    # 10 s of 22050 Hz mp3 is 60000 bytes; ogg at 22050 Hz is 50000.
+    assert encoding.choose_encoding(10.0, 55000, ('mp3', 'ogg_vorbis')) == ('ogg_vorbis', '22050')
+    assert encoding.choose_encoding(10.0, 40000, ('mp3', 'ogg_vorbis')) == ('mp3', '16000')
+    assert encoding.choose_encoding(10.0, 400000, ('pcm',)) == ('pcm', '16000')
+
+
+def test_falls_back_to_the_smallest_encoding():
+    assert encoding.choose_encoding(1000.0, 1024, ('mp3', 'ogg_vorbis')) == ('ogg_vorbis', '8000')
+    assert encoding.choose_encoding(1000.0, 1024, ('pcm',)) == ('pcm', '8000')
+
+
+def test_parse_budgets_overrides_and_adds_classes():
+    classes = encoding.parse_budgets(['constrained=1000', 'speaker=2000', 'pcm='])
+    assert classes['constrained'] == (1000, ('mp3', 'ogg_vorbis'))
+    assert classes['speaker'] == (2000, encoding.DEVICE_CLASSES['standard'][1])
+    assert classes['pcm'] == (None, ('pcm',))
+    assert classes['standard'] == encoding.DEVICE_CLASSES['standard']
+    assert encoding.DEVICE_CLASSES['constrained'][0] == 48 * 1024
+    assert encoding.parse_budgets(None) == encoding.DEVICE_CLASSES
+
+
+def test_pcm_is_wrapped_in_wav():
+    data = encoding.pcm_to_wav(b'\x00\x01' * 80, '8000')
+    wav = wave.open(io.BytesIO(data), 'rb')
+    assert wav.getframerate() == 8000
+    assert wav.getnframes() == 80
+
+
+def test_audio_duration_from_size():
+    assert encoding.audio_duration(12000, 'mp3', '22050') == 2.0
+    with pytest.raises(ValueError):
+        encoding.audio_duration(12000, 'mp3', '44100')
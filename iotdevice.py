@@ -44,8 +44,10 @@ devices and running them all at the same time.
 import argparse
 import datetime
 import json
+import logging
 import os
 import ssl
+import sys
 import time
 from threading import Lock
 from distutils.dir_util import copy_tree
@@ -56,10 +58,25 @@ from PIL import Image
 import glob
 import random
 import base64
+import binascii
 import io
-from google.cloud import pubsub_v1
 from google.oauth2 import service_account
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+
+import batching
+import bidding
+import captions
+import chunking
+import claimcheck
+import encoding
+import logutil
+import metrics
+import routing
+import sessions
+import sharding
+import tracing
+import transport
 
 image_dict = dict()
 send_rek_ack = list()
@@ -68,6 +85,10 @@ send_rek = list()
 send_pol = list()
 send_pol_ack = list()
 sound_dict = dict()
+caption_dict = dict()
+caption_text = dict()
+# Images of each batch sent as one request, by batch id.
+batch_dict = dict()
 authorized = False
 
 API_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
@@ -75,6 +96,39 @@ API_VERSION = 'v1'
 DISCOVERY_API = 'https://cloudiot.googleapis.com/$discovery/rest'
 SERVICE_NAME = 'cloudiot'
 
+log = logging.getLogger('iotdevice')
+message_log = logutil.message_logger('iotdevice')
+
+MESSAGES = metrics.counter(
+    'messages_received_total', 'Config messages handled, by type.', ['type'])
+PUBLISHED = metrics.counter(
+    'messages_published_total', 'Requests published, by type.', ['type'])
+SEND_QUEUE = metrics.gauge(
+    'send_queue_depth', 'Requests waiting to be published, by queue.', ['queue'])
+BIDS_OPEN = metrics.gauge(
+    'bids_open', 'Images whose bid window is open, by service.', ['service'])
+IN_FLIGHT = metrics.gauge(
+    'images_in_flight', 'Images admitted into a stage, by service.', ['service'])
+CREDITS = metrics.gauge(
+    'credits_granted', 'Free credits the nodes advertised, by service.', ['service'])
+AUDIO_TRANSFERS = metrics.gauge(
+    'audio_transfers_open', 'Audio transfers still waiting for chunks.')
+AUTHORIZED = metrics.gauge(
+    'authorized', '1 once a DApp server authorized the device.')
+AUTH_SECONDS = metrics.histogram(
+    'auth_seconds', 'Time from the auth request to the authorization.')
+IMAGE_SECONDS = metrics.histogram(
+    'image_seconds', 'Time from the REK request to the last audio chunk.')
+CONFIG_UPDATES = metrics.counter(
+    'config_updates_total', 'Device config updates, by HTTP status.', ['status'])
+CONFIG_UPDATE_SECONDS = metrics.histogram(
+    'config_update_seconds', 'Latency of the ModifyCloudToDeviceConfig call.')
+
+# The root span of each image's trace, from its REK request to the last
+# audio chunk, and of the authentication.
+image_spans = dict()
+auth_span = None
+
 def create_jwt(project_id, private_key_file, algorithm):
     """Create a JWT (https://jwt.io) to establish an MQTT connection."""
     token = {
@@ -84,8 +138,8 @@ def create_jwt(project_id, private_key_file, algorithm):
     }
     with open(private_key_file, 'r') as f:
         private_key = f.read()
-    print('Creating JWT using {} from private key file {}'.format(
-        algorithm, private_key_file))
+    log.info('Creating JWT using %s from private key file %s',
+             algorithm, private_key_file)
     return jwt.encode(token, private_key, algorithm=algorithm)
 
 def error_str(rc):
@@ -95,28 +149,43 @@ def error_str(rc):
 class Device(object):
     """Represents the state of a single device."""
 
-    def __init__(self, dev_id, service_account_json):
+    def __init__(self, dev_id, service_account_json, bid_window=3,
+                 credit_window=2, credit_timeout=600):
         self.temperature = 0
         self.fan_on = False
         self.connected = False
         self.id = dev_id
+        # Bids from rekognition and polly nodes, collected per image until
+        # the bid window closes and the least loaded node is picked.
+        self.rek_bids = bidding.BidBook(bid_window)
+        self.pol_bids = bidding.BidBook(bid_window)
+        # Images in flight in each stage, limited by the credits the nodes
+        # advertise.
+        self.rek_credits = bidding.CreditWindow(credit_window, credit_timeout)
+        self.pol_credits = bidding.CreditWindow(credit_window, credit_timeout)
+        # A transfer gets as long as the image it belongs to.
+        self.audio_transfers = chunking.Reassembler(credit_timeout)
         global image_dict
         image_dict.clear()
         self.mutex = Lock()
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_json).with_scopes(API_SCOPES)
-        if not credentials:
-            sys.exit('Could not load service account credential '
-                     'from {}'.format(service_account_json))
-
-        discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
-
-        self._service = discovery.build(
-            SERVICE_NAME,
-            API_VERSION,
-            discoveryServiceUrl=discovery_url,
-            credentials=credentials,
-            cache_discovery=False)
+        if transport.is_local():
+            # The local broker stands in for the Cloud IoT admin API.
+            self._service = transport.cloudiot_service()
+        else:
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_json).with_scopes(API_SCOPES)
+            if not credentials:
+                sys.exit('Could not load service account credential '
+                         'from {}'.format(service_account_json))
+
+            discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
+
+            self._service = discovery.build(
+                SERVICE_NAME,
+                API_VERSION,
+                discoveryServiceUrl=discovery_url,
+                credentials=credentials,
+                cache_discovery=False)
         self._update_config_mutex = Lock()
 
     def _update_device_config(self, project_id, region, registry_id, device_id, data):
@@ -140,13 +209,17 @@ class Device(object):
         # httplib2 library, which is not thread-safe.
         self._update_config_mutex.acquire()
         try:
-            request.execute()
+            with CONFIG_UPDATE_SECONDS.time(), tracing.span(
+                    'ModifyCloudToDeviceConfig', kind=tracing.CLIENT, device=device_id):
+                request.execute()
+            CONFIG_UPDATES.labels(200).inc()
             time.sleep(5)
         except HttpError as e:
             # If the server responds with a HtppError, log it here, but
             # continue so that the message does not stay NACK'ed on the
             # pubsub channel.
-            print('Error executing ModifyCloudToDeviceConfig: {}'.format(e))
+            CONFIG_UPDATES.labels(e.resp.status).inc()
+            log.warning('Error executing ModifyCloudToDeviceConfig: %s', e)
         finally:
             self._update_config_mutex.release()
 
@@ -178,29 +251,29 @@ class Device(object):
 
     def on_connect(self, unused_client, unused_userdata, unused_flags, rc):
         """Callback for when a device connects."""
-        print('Connection Result:', error_str(rc))
+        log.info('Connection Result: %s', error_str(rc))
         self.connected = True
 
     def on_disconnect(self, unused_client, unused_userdata, rc):
         """Callback for when a device disconnects."""
-        print('Disconnected:', error_str(rc))
+        log.warning('Disconnected: %s', error_str(rc))
         self.connected = False
 
     def on_publish(self, unused_client, unused_userdata, unused_mid):
         """Callback when the device receives a PUBACK from the MQTT bridge."""
-        print('Published message acked.')
+        message_log.debug('Published message acked.')
 
     def on_subscribe(self, unused_client, unused_userdata, unused_mid, granted_qos):
         """Callback when the device receives a SUBACK from the MQTT bridge."""
-        print('Subscribed: ', granted_qos)
+        log.info('Subscribed: %s', granted_qos)
         if granted_qos[0] == 128:
-            print('Subscription failed.')
+            log.error('Subscription failed.')
 
     def on_message(self, unused_client, unused_userdata, message):
         """Callback when the device receives a message on a subscription."""
         payload = message.payload.decode('utf-8')
-        # print('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-        #     payload, message.topic, str(message.qos)))
+        message_log.debug('Received message \'%s\' on topic \'%s\' with Qos %s',
+                          logutil.truncate(payload), message.topic, message.qos)
 
         # The device will receive its latest config when it subscribes to the
         # config topic. If there is no configuration for the device, the device
@@ -222,69 +295,98 @@ class Device(object):
             try:
                 data = json.loads(payload)
             except ValueError as e:
-                print('Loading Payload ({}) threw an Exception: {}.'.format(
-                    message.data, e))
-                message.ack()
+                MESSAGES.labels('invalid').inc()
+                log.warning('Loading Payload (%s) threw an Exception: %s.',
+                            logutil.truncate(payload), e)
                 return
+            MESSAGES.labels(data.get('type', 'status')).inc()
+            context = tracing.extract(data)
+            if context is not None:
+                tracing.span('receive ' + data.get('type', 'status'), context,
+                             tracing.CONSUMER).end()
             if 'status' in data:
                 if data['status'] == 'authorized':
-                    print("Authorization done")
+                    log.info("Authorization done")
+                    if not authorized and auth_span is not None:
+                        auth_span.end()
+                        AUTH_SECONDS.observe(auth_span.ended - auth_span.started)
                     authorized = True
+                    if data.get('session_token'):
+                        sessions.save_token(session_token_path(self.id), data['session_token'])
                 else:
-                    print("Could not be authorized, try again!!")
-                message.ack()
-            if authorized:
+                    log.warning("Could not be authorized, try again!!")
+            elif authorized:
                 if data['type'] == 'REKSYM':
                     node_id = data['node_id']
                     img = data['img_name']
-                    print("Recieved acknowledgement from rekognition device " + node_id + " for image " +  img + "\n\n\n\n\n")
-                    if(img not in image_dict):
-                        image_dict[img] = node_id
-                        # self.mutex.acquire()
-                        # ack_sent.pop(img)
-                        # self.mutex.release()
-                        send_rek_ack.append((img, node_id))
-                    message.ack()
+                    message_log.info("Received acknowledgement from rekognition device %s for image %s", node_id, img)
+                    self.rek_credits.grant(node_id, data.get('credits'))
+                    for image in batch_dict.get(img, [img]):
+                        self.rek_credits.answered(image)
+                    self.rek_bids.offer(img, node_id, data)
                 elif data['type'] == 'REKRES':
                     node_id = data['node_id']
-                    labels = data['labels']
-                    image = data['img_name']
-                    print("Recieved rekognition result from device " + node_id + " for image "+  image)
-                    if(data['is_success']):
-                        # self.mutex.acquire()
-                        # ack_sent.pop(image)
-                        # self.mutex.release()
-                        st = ''
-                        st = st + "The labels in image " + image.split('/')[-1] + " are "
-                        print("The labels in image " + image + "are : ")
-                        for l in labels:
-                            st = st + l + " "
-                            print(l)
-                        print("\n\n\n\n")
-                        send_pol.append((image, st))
-                    else:
-                        print("Error  in uploading to AWS")
-                    message.ack()
+                    self.rek_credits.grant(node_id, data.get('credits'))
+                    # A batch is answered with one result per image.
+                    for result in batching.expand(data, 'results'):
+                        labels = result['labels']
+                        image = result['img_name']
+                        message_log.info("Received rekognition result from device %s for image %s", node_id, image)
+                        if not result.get('chained'):
+                            # A chained image stays in the window until its
+                            # audio arrives.
+                            self.rek_credits.release(image)
+                        if result.get('unchained'):
+                            log.warning("Rekognition node %s did not chain image %s (%s), requesting its audio from the polly nodes", node_id, image, result['unchained'])
+                        if result.get('chained'):
+                            # The rekognition node already sent the caption on
+                            # to the polly nodes; these are just the labels.
+                            message_log.info("The labels in image %s are: %s", image, labels)
+                        elif(result['is_success']):
+                            # self.mutex.acquire()
+                            # ack_sent.pop(image)
+                            # self.mutex.release()
+                            st = captions.build_caption(image, labels)
+                            message_log.info("The labels in image %s are: %s", image, labels)
+                            caption_dict[image] = captions.caption_segments(image, labels)
+                            caption_text[image] = st
+                            send_pol.append((image, st))
+                        else:
+                            log.warning("Rekognition node %s could not upload image %s to AWS", node_id, image)
                 elif data['type'] == 'POLSYM':
                     node_id = data['node_id']
                     img = data['img_name']
-                    print("Recieved acknowledgement from polly device " + node_id + " for image " +  img + "\n\n\n\n\n")
-                    if(img not in sound_dict):
-                        sound_dict[img] = node_id
-                        temp = (node_id, data['labels'])
-                        send_pol_ack.append((img, temp))
-                    message.ack()
+                    message_log.info("Received acknowledgement from polly device %s for image %s", node_id, img)
+                    self.pol_credits.grant(node_id, data.get('credits'))
+                    for image in batch_dict.get(img, [img]):
+                        self.pol_credits.answered(image)
+                    self.pol_bids.offer(img, node_id, data)
                 elif data['type'] == 'POLRES':
-                    node_id = data['node_id']
-                    sound = base64.b64decode(data['audio'])
-                    image = data['img_name'][:-4].split('/')[-1]
-                    print("Recieved polly result from device " + node_id + " for image "+  image)
-                    f = open("../" + self.id + "/sounds/" + image + ".mp3", 'wb')
-                    # f.write(base64.b64decode(sound))
-                    f.write(sound)
-                    message.ack()
+                    # The audio arrives as a manifest followed by numbered
+                    # chunks that are appended straight to the sound file.
+                    if data['part'] == 'manifest':
+                        image = data['img_name'][:-4].split('/')[-1]
+                        message_log.info("Receiving polly result from device %s for image %s in %s chunks", data['node_id'], image, data['chunks'])
+                        self.pol_credits.grant(data['node_id'], data.get('credits'))
+                        manifest = self.audio_transfers.start(
+                            data, "../" + self.id + "/sounds/" + image + "." + data.get('extension', 'mp3'))
+                    else:
+                        try:
+                            manifest = self.audio_transfers.add_chunk(data)
+                        except ValueError as e:
+                            log.warning("Dropping polly result: %s", e)
+                            manifest = None
+                    if manifest is not None:
+                        message_log.info("Received polly result from device %s for image %s", manifest['node_id'], manifest['img_name'])
+                        self.pol_credits.release(manifest['img_name'])
+                        self.rek_credits.release(manifest['img_name'])
+                        image_span = image_spans.pop(manifest['img_name'], None)
+                        if image_span is not None:
+                            image_span.end()
+                            IMAGE_SECONDS.observe(image_span.ended - image_span.started)
         except binascii.Error:
-            message.ack()  # To move forward if a message can't be processed
+            # Skip a config that cannot be decoded and wait for the next one.
+            log.warning("Dropping undecodable config message")
 
 def parse_command_line_args():
     """Parse command line arguments."""
@@ -347,14 +449,90 @@ def parse_command_line_args():
         '--pubsub_subscription',
         required=True,
         help='Google Cloud Pub/Sub subscription name.')
+    parser.add_argument(
+        '--dispatch',
+        choices=routing.DISPATCH_MODES,
+        default=routing.BID,
+        help=('bid lets the nodes bid for every image; direct publishes each '
+              'job once to the nodes\' shared subscriptions.'))
+    parser.add_argument(
+        '--chain',
+        action='store_true',
+        help=('Have the rekognition node send the caption straight to the '
+              'polly nodes, which must run with --dispatch=direct.'))
+    parser.add_argument(
+        '--chain_labels',
+        action='store_true',
+        help='With --chain, still receive the labels from the rekognition node.')
+    parser.add_argument(
+        '--bid_window',
+        type=float,
+        default=3,
+        help=('Seconds to collect node bids for an image before handing it '
+              'to the least loaded node.'))
+    parser.add_argument(
+        '--credit_window',
+        type=int,
+        default=2,
+        help=('Images the device keeps in flight in each stage beyond the '
+              'credits the nodes advertised.'))
+    parser.add_argument(
+        '--credit_timeout',
+        type=float,
+        default=600,
+        help='Seconds after which an image in flight is given up on.')
+    parser.add_argument(
+        '--request_timeout',
+        type=float,
+        default=10,
+        help=('Seconds without a bid after which a REK or POL request is '
+              'withdrawn and queued again.'))
+    parser.add_argument(
+        '--batch_size',
+        type=int,
+        default=1,
+        help=('Images sent together in one REK or POL request. Batches are '
+              'cut from the images the credit window admits at once, so '
+              'raise --credit_window along with it.'))
+    parser.add_argument(
+        '--device_class',
+        choices=sorted(encoding.DEVICE_CLASSES),
+        default='standard',
+        help=('Class of the device, which sets the audio payload budget and '
+              'the formats polly nodes may send.'))
     parser.add_argument(
         '--dapp_id',
         required=True,
-        help='Device Id of dapp server node.')
+        help=('Device Id of dapp server node, or a comma separated list of '
+              'the ids of all dapp server replicas.'))
+    parser.add_argument(
+        '--auth_topic',
+        help=('Pub/Sub topic the DApp server consumes auth requests from. '
+              'Without it the request is written to the DApp node\'s config.'))
+    parser.add_argument(
+        '--auth_timeout',
+        type=float,
+        default=120,
+        help=('Seconds to wait for a DApp server to answer before sending the '
+              'auth request to the next replica.'))
     parser.add_argument(
         '--service_account_json',
         required=True,
         help='Path to service account json file.')
+    parser.add_argument(
+        '--transport',
+        choices=transport.TRANSPORTS,
+        default=transport.GOOGLE,
+        help=('google talks to Cloud IoT Core and Pub/Sub; local talks to the '
+              'broker started with localbus.py.'))
+    parser.add_argument(
+        '--local_broker',
+        default='localhost:50000',
+        help='host:port of the local broker for --transport=local.')
+    claimcheck.add_arguments(parser)
+    logutil.add_arguments(parser)
+    metrics.add_arguments(parser)
+    tracing.add_arguments(parser)
     return parser.parse_args()
 #Added code to encode image
 
@@ -363,21 +541,48 @@ def convertImageToByteArray(image_path):
         image_data = base64.b64encode(image_file.read()).decode('utf-8')
     return image_data
 
+def readImage(image_path):
+    with io.open(image_path, 'rb') as image_file:
+        return image_file.read()
+
 def getJSONForEncodedImage(image_path):
     imgStr = convertImageToByteArray(image_path)
     payload_json = {'temperature': 0,'image_data' : imgStr}
     #payload_json = {'temperature': 0}
     return imgStr
 
-def check_authentication(dapp_id, dapp_key, dapp_addr, dev_id, project_id, registry_id, region, device):
+def session_token_path(dev_id):
+    return "../" + dev_id + "/session_token"
+
+def check_authentication(dapp_id, dapp_key, dapp_addr, dev_id, project_id, registry_id, region, device, publisher=None, auth_topic_path=None):
     mqtt_config_topic = '/devices/{}/config/'.format(dapp_id)
     payload_json = {'id': dev_id, 'key': dapp_key, 'address': dapp_addr}
+    # A session token from an earlier payment lets the DApp server authorize
+    # the device without another transaction.
+    token = sessions.load_token(session_token_path(dev_id))
+    if token:
+        payload_json['session_token'] = token
+    log.info("Authenticating with DApp server %s", dapp_id)
+    global auth_span
+    if auth_span is None:
+        auth_span = tracing.span('authenticate', device=dev_id)
+    if auth_topic_path:
+        # The auth topic queues every request, while the DApp node's config
+        # only keeps the last one written.
+        payload_json['type'] = 'AUTH'
+        with tracing.span('publish AUTH', auth_span, tracing.PRODUCER, dapp=dapp_id):
+            tracing.inject(payload_json)
+            payload = json.dumps(payload_json)
+            publisher.publish(
+                auth_topic_path, payload.encode('utf-8'),
+                **routing.message_attributes('AUTH', dev_id, dapp_id)).result()
+        return
+    tracing.inject(payload_json, auth_span)
     payload = json.dumps(payload_json)
     device_project_id = project_id
     device_registry_id = registry_id
     device_id = dapp_id
     device_region = region
-    print("Authenticating.....")
     # Send the config to the device.
     device._update_device_config(
         device_project_id,
@@ -389,34 +594,50 @@ def check_authentication(dapp_id, dapp_key, dapp_addr, dev_id, project_id, regis
     
 def main():
     args = parse_command_line_args()
+    transport.configure(args.transport, args.local_broker)
+    logutil.configure(args.device_id, args.log_level, args.log_format,
+                      args.log_sample_rate, args.log_payload_chars)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    tracing.configure(args.device_id, args.span_file)
     global image_dict
     # Create the MQTT client and connect to Cloud IoT.
-    client = mqtt.Client(
+    client = transport.mqtt_client(
         client_id='projects/{}/locations/{}/registries/{}/devices/{}'.format(
             args.project_id,
             args.cloud_region,
             args.registry_id,
             args.device_id))
-    client.username_pw_set(
-        username='unused',
-        password=create_jwt(
-            args.project_id,
-            args.private_key_file,
-            args.algorithm))
-    client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
-
-    device = Device(args.device_id, args.service_account_json)
+    if not transport.is_local():
+        client.username_pw_set(
+            username='unused',
+            password=create_jwt(
+                args.project_id,
+                args.private_key_file,
+                args.algorithm))
+        client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+
+    device = Device(args.device_id, args.service_account_json, args.bid_window,
+                    args.credit_window, args.credit_timeout)
     
-    dapp_id = args.dapp_id
+    publisher = transport.publisher_client()
+    topic_path = publisher.topic_path(args.project_id, args.pubsub_subscription)
+
+    # Each device is served by the DApp replica that owns its id on the hash
+    # ring; the other replicas follow in the order to fail over to.
+    dapp_ids = sharding.HashRing(sharding.parse_replicas(args.dapp_id)).preference(device.get_id())
+    dapp_id = dapp_ids[0]
     dapp_key = args.dapp_key
     dapp_addr = args.dapp_addr
-    check_authentication(dapp_id, dapp_key, dapp_addr, device.get_id(), args.project_id, args.registry_id, args.cloud_region, device)
+    auth_topic_path = None
+    if args.auth_topic:
+        auth_topic_path = publisher.topic_path(args.project_id, args.auth_topic)
+    check_authentication(dapp_id, dapp_key, dapp_addr, device.get_id(), args.project_id, args.registry_id, args.cloud_region, device, publisher, auth_topic_path)
+    auth_attempts = 1
+    auth_sent = time.time()
     
     os.system("rm -rf ../" + device.get_id() + "/sounds")
-    os.system("mkdir ../" + device.get_id() + "/sounds")
-
-    publisher = pubsub_v1.PublisherClient()
-    topic_path = publisher.topic_path(args.project_id, args.pubsub_subscription)
+    os.system("mkdir -p ../" + device.get_id() + "/sounds")
 
     client.on_connect = device.on_connect
     client.on_publish = device.on_publish
@@ -448,6 +669,17 @@ def main():
     global send_pol
     global authorized
 
+    for name, queue in (('rek', send_rek), ('rek_ack', send_rek_ack),
+                        ('pol', send_pol), ('pol_ack', send_pol_ack)):
+        SEND_QUEUE.labels(name).set_function(lambda queue=queue: len(queue))
+    BIDS_OPEN.labels('rek').set_function(lambda: len(device.rek_bids))
+    BIDS_OPEN.labels('pol').set_function(lambda: len(device.pol_bids))
+    for name, window in (('rek', device.rek_credits), ('pol', device.pol_credits)):
+        IN_FLIGHT.labels(name).set_function(lambda window=window: len(window))
+        CREDITS.labels(name).set_function(lambda window=window: window.granted)
+    AUDIO_TRANSFERS.set_function(lambda: len(device.audio_transfers))
+    AUTHORIZED.set_function(lambda: int(authorized))
+
     for filename in glob.glob(path): #assuming gif
         im=Image.open(filename)
         send_rek.append(im.filename)
@@ -455,24 +687,111 @@ def main():
     def get_callback(f, data):
         def callback(f):
             try:
-                print(f.result())
+                message_log.debug('Published message %s', f.result())
                 futures.pop(data)
             except:  # noqa
                 # print("Please handle {} for {}.".format(f.exception(), data))
-                print("\n")
+                pass
 
         return callback
     i=0
 
+    # Large images go to the claim-check store once and only their
+    # reference is published.
+    store = None
+    if args.claim_check_store:
+        store = claimcheck.open_store(args.claim_check_store)
+    image_sender = claimcheck.Sender(store, args.inline_threshold)
+
+    # Asks the rekognition node to pass the caption on to the polly nodes
+    # itself instead of returning the labels for a POL request.
+    chain_fields = dict()
+    if args.chain:
+        chain_fields = {'chain': True, 'send_labels': args.chain_labels,
+                        'device_class': args.device_class}
+
     while True:
         if authorized:
-            while(send_rek):
+            for image_name, node_id, bid in device.rek_bids.ready():
+                for name in batch_dict.get(image_name, [image_name]):
+                    device.rek_credits.consume(node_id)
+                    image_dict[name] = node_id
+                send_rek_ack.append((image_name, node_id))
+
+            for image_name, node_id, bid in device.pol_bids.ready():
+                for name in batch_dict.get(image_name, [image_name]):
+                    device.pol_credits.consume(node_id)
+                    sound_dict[name] = node_id
+                send_pol_ack.append((image_name, (node_id, bid.get('labels'))))
+
+            for image_name in device.rek_credits.expire():
+                if args.chain:
+                    # A chained POLJOB nobody subscribes to is dropped without
+                    # an error, so this is all the device gets to see of it.
+                    log.warning("Giving up on image %s after %s seconds without its audio; "
+                                "chained captions only reach polly nodes running with --dispatch=direct",
+                                image_name, args.credit_timeout)
+                else:
+                    log.warning("Giving up on image %s after %s seconds in flight", image_name, args.credit_timeout)
+            for image_name in device.pol_credits.expire():
+                log.warning("Giving up on image %s after %s seconds in flight", image_name, args.credit_timeout)
+            if args.dispatch == routing.BID:
+                # Every node declined these requests, so they go back to the
+                # end of the queue until the nodes grant credits again.
+                for image_name in device.rek_credits.unanswered(args.request_timeout):
+                    message_log.info("No bids for image %s, requeueing its rekognition request", image_name)
+                    send_rek.insert(0, image_name)
+                for item in device.pol_credits.unanswered(args.request_timeout):
+                    message_log.info("No bids for image %s, requeueing its polly request", item[0])
+                    send_pol.insert(0, item)
+
+            # The rest of the images wait here until the nodes grant credits.
+            admitted = list()
+            while send_rek and device.rek_credits.acquire(send_rek[-1], send_rek[-1]):
                 image_name = send_rek.pop()
-                payload_json = {'type' : 'REK', 'img_name':image_name, 'dev_id': device.get_id()}
-                payload = json.dumps(payload_json)
-                print("Publishing initial request for rekognition service for image " + image_name + "\n\n\n\n\n")
-                future = publisher.publish(topic_path, payload)
+                if image_name in image_dict:
+                    # A late bid for a requeued request won it a node after all.
+                    device.rek_credits.release(image_name)
+                    continue
+                admitted.append(image_name)
+            for group in batching.groups(admitted, args.batch_size):
+                image_name = group[0]
+                for name in group:
+                    if name not in image_spans:
+                        image_spans[name] = tracing.span('caption image', image=name)
+                if len(group) > 1:
+                    batch_id = batching.new_batch_id()
+                    batch_dict[batch_id] = group
+                    if args.dispatch == routing.DIRECT:
+                        msg_type = 'REKJOB'
+                        payload_json = {'type' : msg_type, 'batch_id': batch_id, 'img_name': batch_id, 'img_names': group, 'dev_id': device.get_id(),
+                                        'items': [image_sender.attach({'img_name': name}, readImage(name)) for name in group]}
+                        payload_json.update(chain_fields)
+                        message_log.info("Publishing rekognition job for images %s", group)
+                    else:
+                        msg_type = 'REKBATCH'
+                        payload_json = {'type' : msg_type, 'batch_id': batch_id, 'img_name': batch_id, 'img_names': group, 'dev_id': device.get_id()}
+                        message_log.info("Publishing initial request for rekognition service for images %s", group)
+                elif args.dispatch == routing.DIRECT:
+                    # The whole job goes out at once, and Pub/Sub hands it to
+                    # one of the nodes sharing the job subscription.
+                    msg_type = 'REKJOB'
+                    payload_json = {'type' : msg_type, 'img_name':image_name, 'dev_id': device.get_id()}
+                    image_sender.attach(payload_json, readImage(image_name))
+                    payload_json.update(chain_fields)
+                    message_log.info("Publishing rekognition job for image %s", image_name)
+                else:
+                    msg_type = 'REK'
+                    payload_json = {'type' : msg_type, 'img_name':image_name, 'dev_id': device.get_id()}
+                    message_log.info("Publishing initial request for rekognition service for image %s", image_name)
+                with tracing.span('publish ' + msg_type, image_spans.get(image_name), tracing.PRODUCER):
+                    tracing.inject(payload_json)
+                    payload = json.dumps(payload_json)
+                    future = publisher.publish(
+                        topic_path, payload.encode('utf-8'),
+                        **routing.message_attributes(msg_type, device.get_id()))
                 future.add_done_callback(get_callback(future, payload))
+                PUBLISHED.labels(msg_type).inc()
                 now = datetime.datetime.utcnow()
                 # device.get_mutex().acquire()
                 # ack_sent[image_name] = now
@@ -481,25 +800,67 @@ def main():
 
             while(send_rek_ack):
                 image_name, node_id = send_rek_ack.pop()
-                image_data = convertImageToByteArray(image_name)
-                payload_json = {'type' : 'REKACK', 'img_name':image_name, 'node_id':node_id, 'dev_id': device.get_id(), 'img_data':image_data}
-                payload = json.dumps(payload_json)
-                print("Publishing acknowledgement for rekognition service for image " + image_name + " to rekognition device " + node_id + "\n\n\n\n\n")
-                future = publisher.publish(topic_path, payload)
+                payload_json = {'type' : 'REKACK', 'img_name':image_name, 'node_id':node_id, 'dev_id': device.get_id()}
+                if image_name in batch_dict:
+                    group = batch_dict[image_name]
+                    payload_json['batch_id'] = image_name
+                    payload_json['items'] = [image_sender.attach({'img_name': name}, readImage(name)) for name in group]
+                else:
+                    group = [image_name]
+                    image_sender.attach(payload_json, readImage(image_name))
+                payload_json.update(chain_fields)
+                message_log.info("Publishing acknowledgement for rekognition service for image %s to rekognition device %s", image_name, node_id)
+                with tracing.span('publish REKACK', image_spans.get(group[0]), tracing.PRODUCER):
+                    tracing.inject(payload_json)
+                    payload = json.dumps(payload_json)
+                    future = publisher.publish(
+                        topic_path, payload.encode('utf-8'),
+                        **routing.message_attributes('REKACK', device.get_id(), node_id))
                 future.add_done_callback(get_callback(future, payload))
+                PUBLISHED.labels('REKACK').inc()
                 # now = datetime.datetime.utcnow()
                 # device.get_mutex().acquire()
                 # ack_sent[image_name] = now
                 # device.get_mutex().release()
                 time.sleep(1)
 
-            while(send_pol):
+            admitted = list()
+            while send_pol and device.pol_credits.acquire(send_pol[-1][0], send_pol[-1]):
                 image_name, labels = send_pol.pop()
-                payload_json = {'type' : 'POL', 'img_name':image_name, 'dev_id': device.get_id(), 'labels': labels}
-                payload = json.dumps(payload_json)
-                print("Publishing initial request for polly service for image " + image_name + "\n\n\n\n\n")
-                future = publisher.publish(topic_path, payload)
+                if image_name in sound_dict:
+                    device.pol_credits.release(image_name)
+                    continue
+                admitted.append((image_name, labels))
+            for group in batching.groups(admitted, args.batch_size):
+                image_name, labels = group[0]
+                if len(group) > 1:
+                    batch_id = batching.new_batch_id()
+                    batch_dict[batch_id] = [name for name, _ in group]
+                    if args.dispatch == routing.DIRECT:
+                        msg_type = 'POLJOB'
+                        payload_json = {'type' : msg_type, 'batch_id': batch_id, 'img_name': batch_id, 'img_names': batch_dict[batch_id], 'dev_id': device.get_id(), 'device_class': args.device_class,
+                                        'items': [{'img_name': name, 'img_data': caption, 'segments': caption_dict.get(name)} for name, caption in group]}
+                        message_log.info("Publishing polly job for images %s", batch_dict[batch_id])
+                    else:
+                        msg_type = 'POLBATCH'
+                        payload_json = {'type' : msg_type, 'batch_id': batch_id, 'img_name': batch_id, 'img_names': batch_dict[batch_id], 'dev_id': device.get_id()}
+                        message_log.info("Publishing initial request for polly service for images %s", batch_dict[batch_id])
+                elif args.dispatch == routing.DIRECT:
+                    msg_type = 'POLJOB'
+                    payload_json = {'type' : msg_type, 'img_name':image_name, 'dev_id': device.get_id(), 'img_data':labels, 'segments': caption_dict.get(image_name), 'device_class': args.device_class}
+                    message_log.info("Publishing polly job for image %s", image_name)
+                else:
+                    msg_type = 'POL'
+                    payload_json = {'type' : msg_type, 'img_name':image_name, 'dev_id': device.get_id(), 'labels': labels}
+                    message_log.info("Publishing initial request for polly service for image %s", image_name)
+                with tracing.span('publish ' + msg_type, image_spans.get(image_name), tracing.PRODUCER):
+                    tracing.inject(payload_json)
+                    payload = json.dumps(payload_json)
+                    future = publisher.publish(
+                        topic_path, payload.encode('utf-8'),
+                        **routing.message_attributes(msg_type, device.get_id()))
                 future.add_done_callback(get_callback(future, payload))
+                PUBLISHED.labels(msg_type).inc()
                 now = datetime.datetime.utcnow()
                 # device.get_mutex().acquire()
                 # ack_sent[image_name] = now
@@ -509,11 +870,22 @@ def main():
             while(send_pol_ack):
                 image_name, second = send_pol_ack.pop()
                 node_id, labels = second
-                payload_json = {'type' : 'POLACK', 'img_name':image_name, 'node_id':node_id, 'dev_id': device.get_id(), 'img_data':labels}
-                payload = json.dumps(payload_json)
-                print("Publishing acknowledgement for polly service for image " + image_name + " to polly device " + node_id + "\n\n\n\n\n")
-                future = publisher.publish(topic_path, payload)
+                if image_name in batch_dict:
+                    group = batch_dict[image_name]
+                    payload_json = {'type' : 'POLACK', 'batch_id': image_name, 'img_name':image_name, 'node_id':node_id, 'dev_id': device.get_id(), 'device_class': args.device_class,
+                                    'items': [{'img_name': name, 'img_data': caption_text.get(name), 'segments': caption_dict.get(name)} for name in group]}
+                else:
+                    group = [image_name]
+                    payload_json = {'type' : 'POLACK', 'img_name':image_name, 'node_id':node_id, 'dev_id': device.get_id(), 'img_data':labels, 'segments': caption_dict.get(image_name), 'device_class': args.device_class}
+                message_log.info("Publishing acknowledgement for polly service for image %s to polly device %s", image_name, node_id)
+                with tracing.span('publish POLACK', image_spans.get(group[0]), tracing.PRODUCER):
+                    tracing.inject(payload_json)
+                    payload = json.dumps(payload_json)
+                    future = publisher.publish(
+                        topic_path, payload.encode('utf-8'),
+                        **routing.message_attributes('POLACK', device.get_id(), node_id))
                 future.add_done_callback(get_callback(future, payload))
+                PUBLISHED.labels('POLACK').inc()
                 # now = datetime.datetime.utcnow()
                 # device.get_mutex().acquire()
                 # ack_sent[image_name] = now
@@ -531,6 +903,16 @@ def main():
             #             if key in image_dict:
             #                 image_dict.pop(key)
             #             send_rek.append(key)
+        elif time.time() - auth_sent > args.auth_timeout:
+            # The replica did not answer; it may be down, so move on to the
+            # next one on the ring.
+            dapp_id = dapp_ids[auth_attempts % len(dapp_ids)]
+            auth_attempts += 1
+            log.warning("No answer to auth request, retrying with DApp server %s", dapp_id)
+            check_authentication(dapp_id, dapp_key, dapp_addr, device.get_id(), args.project_id, args.registry_id, args.cloud_region, device, publisher, auth_topic_path)
+            auth_sent = time.time()
+        else:
+            time.sleep(0.5)
 
         # for key in keys_to_rem:
         #     ack_sent.pop(key)
@@ -538,7 +920,7 @@ def main():
     time.sleep(1000)
     client.disconnect()
     client.loop_stop()
-    print('Finished loop successfully. Goodbye!')
+    log.info('Finished loop successfully. Goodbye!')
 
 
 if __name__ == '__main__':
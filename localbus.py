@@ -0,0 +1,519 @@
+"""A local stand-in for Cloud IoT Core and Pub/Sub.
+
+The broker keeps Pub/Sub topics and subscriptions and the configuration of
+every device, and enforces the limits the scripts meet in the cloud:
+
+- Subscriptions deliver at least once. A pulled message is leased for the
+  ack deadline and redelivered if it is nacked or its lease runs out.
+  Subscription filters in the Pub/Sub filter syntax are applied on publish.
+- A device config is limited to 64 KiB and to one update per second per
+  device; updates beyond that fail like the Cloud IoT admin API does.
+- A device only receives the latest config. Versions written while it is
+  still processing the previous one are skipped, and the device acks the
+  version it received. The last ten versions are listed with their ack
+  time, as configVersions.list does.
+
+With --trace the broker appends a JSON line for every publish, config
+update and config ack to a file, which the pipeline benchmark reads to time
+each stage of the flow.
+
+Run it in its own process and start the scripts with --transport=local:
+
+  $ python localbus.py --port=50000
+
+Every process connects to it through a multiprocessing manager; see
+transport.py for the clients the scripts use.
+"""
+
+import argparse
+import base64
+import datetime
+import itertools
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from multiprocessing.managers import BaseManager
+
+DEFAULT_ADDRESS = ('localhost', 50000)
+DEFAULT_AUTHKEY = 'localbus'
+
+MAX_CONFIG_BYTES = 64 * 1024
+CONFIG_UPDATES_PER_SECOND = 1.0
+# Config versions the admin API lists per device.
+CONFIG_HISTORY = 10
+MAX_MESSAGE_BYTES = 10 * 1000 * 1000
+ACK_DEADLINE = 10
+
+# Payload fields copied into trace records.
+TRACE_FIELDS = ('type', 'img_name', 'img_names', 'dev_id', 'node_id', 'part',
+                'transfer_id', 'seq', 'chunks')
+
+
+class BusError(Exception):
+    """A request the cloud service would reject, with its HTTP status."""
+
+    def __init__(self, status, message):
+        # Both go in args so the error survives the trip to the client.
+        super(BusError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return '{} {}'.format(self.status, self.message)
+
+
+def _timestamp(seconds):
+    return datetime.datetime.utcfromtimestamp(seconds).isoformat() + 'Z'
+
+
+def _trace_fields(data):
+    """Return the TRACE_FIELDS of a JSON payload, or {} for other payloads."""
+    try:
+        payload = json.loads(data.decode('utf-8'))
+    except ValueError:
+        return {}
+    if not isinstance(payload, dict):
+        return {}
+    return dict((k, payload[k]) for k in TRACE_FIELDS if k in payload)
+
+
+_TOKEN = re.compile(r'\s*(\(|\)|!=|=|:|,|"(?:[^"\\]|\\.)*"|[A-Za-z_][\w.]*|-)')
+
+
+def _tokenize(expression):
+    tokens = list()
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _TOKEN.match(expression, position)
+        if not match:
+            raise BusError(400, 'Invalid filter: {}'.format(expression))
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+
+class MessageFilter(object):
+    """A Pub/Sub subscription filter over message attributes.
+
+    Supports attributes.KEY = "v", != "v", attributes:KEY,
+    hasPrefix(attributes.KEY, "p"), NOT / -, AND, OR and parentheses.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        self._tokens = _tokenize(expression)
+        self._position = 0
+        self._tree = self._parse_or()
+        if self._position != len(self._tokens):
+            raise BusError(400, 'Invalid filter: {}'.format(expression))
+
+    def _peek(self):
+        if self._position < len(self._tokens):
+            return self._tokens[self._position]
+        return None
+
+    def _take(self, expected=None):
+        token = self._peek()
+        if token is None or (expected is not None and token != expected):
+            raise BusError(400, 'Invalid filter: {}'.format(self.expression))
+        self._position += 1
+        return token
+
+    def _parse_or(self):
+        clauses = [self._parse_and()]
+        while self._peek() == 'OR':
+            self._take()
+            clauses.append(self._parse_and())
+        return ('or', clauses) if len(clauses) > 1 else clauses[0]
+
+    def _parse_and(self):
+        clauses = [self._parse_not()]
+        while self._peek() == 'AND':
+            self._take()
+            clauses.append(self._parse_not())
+        return ('and', clauses) if len(clauses) > 1 else clauses[0]
+
+    def _parse_not(self):
+        if self._peek() in ('NOT', '-'):
+            self._take()
+            return ('not', self._parse_not())
+        return self._parse_term()
+
+    def _parse_term(self):
+        token = self._take()
+        if token == '(':
+            tree = self._parse_or()
+            self._take(')')
+            return tree
+        if token == 'hasPrefix':
+            self._take('(')
+            key = self._attribute(self._take())
+            self._take(',')
+            prefix = self._string(self._take())
+            self._take(')')
+            return ('prefix', key, prefix)
+        if token == 'attributes' and self._peek() == ':':
+            self._take()
+            return ('has', self._take())
+        key = self._attribute(token)
+        operator = self._take()
+        if operator not in ('=', '!='):
+            raise BusError(400, 'Invalid filter: {}'.format(self.expression))
+        return (operator, key, self._string(self._take()))
+
+    def _attribute(self, token):
+        if not token.startswith('attributes.'):
+            raise BusError(400, 'Invalid filter: {}'.format(self.expression))
+        return token[len('attributes.'):]
+
+    def _string(self, token):
+        if len(token) < 2 or token[0] != '"' or token[-1] != '"':
+            raise BusError(400, 'Invalid filter: {}'.format(self.expression))
+        return re.sub(r'\\(.)', r'\1', token[1:-1])
+
+    def matches(self, attributes):
+        return self._evaluate(self._tree, attributes)
+
+    def _evaluate(self, tree, attributes):
+        kind = tree[0]
+        if kind == 'or':
+            return any(self._evaluate(t, attributes) for t in tree[1])
+        if kind == 'and':
+            return all(self._evaluate(t, attributes) for t in tree[1])
+        if kind == 'not':
+            return not self._evaluate(tree[1], attributes)
+        if kind == 'has':
+            return tree[1] in attributes
+        if kind == 'prefix':
+            return attributes.get(tree[1], '').startswith(tree[2])
+        if kind == '=':
+            return attributes.get(tree[1]) == tree[2]
+        return attributes.get(tree[1]) != tree[2]
+
+
+class _Subscription(object):
+
+    def __init__(self, name, topic, message_filter, ack_deadline):
+        self.name = name
+        self.topic = topic
+        self.filter = message_filter
+        self.ack_deadline = ack_deadline
+        self.ready = deque()
+        # ack id -> (message, delivery attempts, lease expiry)
+        self.leased = dict()
+
+
+class _DeviceConfig(object):
+
+    def __init__(self):
+        self.version = 0
+        self.data = b''
+        self.cloud_update_time = None
+        self.device_ack_time = None
+        self.last_update = 0.0
+        # Earlier versions, newest last, with the time the device acked each.
+        self.history = deque(maxlen=CONFIG_HISTORY - 1)
+
+
+class LocalBroker(object):
+    """Topics, subscriptions and device configs shared by all processes."""
+
+    def __init__(self, config_rate=CONFIG_UPDATES_PER_SECOND,
+                 max_config_bytes=MAX_CONFIG_BYTES, latency=0.0, trace=None):
+        self.config_rate = config_rate
+        self.max_config_bytes = max_config_bytes
+        self.latency = latency
+        self._subscriptions = dict()
+        self._configs = dict()
+        self._ids = itertools.count(1)
+        self._changed = threading.Condition()
+        # A file the trace records are appended to, or None.
+        self._trace = trace
+        self._trace_mutex = threading.Lock()
+
+    def _record(self, event, name, when, data=None, **fields):
+        if self._trace is None:
+            return
+        record = {'time': when, 'event': event, 'name': name}
+        record.update(fields)
+        if data is not None:
+            record['fields'] = _trace_fields(data)
+        line = json.dumps(record) + '\n'
+        with self._trace_mutex:
+            self._trace.write(line)
+            self._trace.flush()
+
+    # Pub/Sub
+
+    def create_subscription(self, name, topic, filter_=None,
+                            ack_deadline=ACK_DEADLINE):
+        with self._changed:
+            if name in self._subscriptions:
+                raise BusError(409, 'Subscription already exists: {}'.format(name))
+            message_filter = MessageFilter(filter_) if filter_ else None
+            self._subscriptions[name] = _Subscription(
+                name, topic, message_filter, ack_deadline)
+
+    def delete_subscription(self, name):
+        with self._changed:
+            self._subscriptions.pop(name, None)
+
+    def has_subscription(self, name):
+        with self._changed:
+            return name in self._subscriptions
+
+    def publish(self, topic, data, attributes=None):
+        """Deliver a message to every matching subscription of `topic`."""
+        attributes = dict(attributes or {})
+        if len(data) > MAX_MESSAGE_BYTES:
+            raise BusError(400, 'Message is larger than {} bytes'.format(
+                MAX_MESSAGE_BYTES))
+        now = time.time()
+        with self._changed:
+            message_id = str(next(self._ids))
+            message = (message_id, data, attributes, now)
+            deliveries = 0
+            for subscription in self._subscriptions.values():
+                if subscription.topic != topic:
+                    continue
+                if subscription.filter and not subscription.filter.matches(attributes):
+                    continue
+                subscription.ready.append((now + self.latency, message, 0))
+                deliveries += 1
+            self._changed.notify_all()
+        self._record('publish', topic, now, data, message_id=message_id,
+                     attributes=attributes, size=len(data),
+                     deliveries=deliveries)
+        return message_id
+
+    def pull(self, name, max_messages, timeout=1.0):
+        """Lease up to `max_messages` messages, waiting up to `timeout`.
+
+        Returns (ack_id, message_id, data, attributes, publish_time,
+        delivery_attempt) tuples.
+        """
+        deadline = time.time() + timeout
+        with self._changed:
+            while True:
+                subscription = self._subscriptions.get(name)
+                if subscription is None:
+                    raise BusError(404, 'Subscription does not exist: {}'.format(name))
+                now = time.time()
+                self._expire(subscription, now)
+                pulled = list()
+                wait = deadline - now
+                while subscription.ready and len(pulled) < max_messages:
+                    visible, message, attempts = subscription.ready[0]
+                    if visible > now:
+                        wait = min(wait, visible - now)
+                        break
+                    subscription.ready.popleft()
+                    ack_id = str(next(self._ids))
+                    subscription.leased[ack_id] = (
+                        message, attempts + 1, now + subscription.ack_deadline)
+                    pulled.append((ack_id,) + message + (attempts + 1,))
+                if pulled or wait <= 0:
+                    return pulled
+                self._changed.wait(min(wait, 1.0))
+
+    def ack(self, name, ack_ids):
+        with self._changed:
+            subscription = self._subscriptions.get(name)
+            if subscription is not None:
+                for ack_id in ack_ids:
+                    subscription.leased.pop(ack_id, None)
+
+    def modify_ack_deadline(self, name, ack_ids, seconds):
+        """Extend the leases of `ack_ids`; a deadline of 0 nacks them."""
+        with self._changed:
+            subscription = self._subscriptions.get(name)
+            if subscription is None:
+                return
+            now = time.time()
+            for ack_id in ack_ids:
+                lease = subscription.leased.get(ack_id)
+                if lease is None:
+                    continue
+                if seconds <= 0:
+                    del subscription.leased[ack_id]
+                    subscription.ready.append((now, lease[0], lease[1]))
+                else:
+                    subscription.leased[ack_id] = (lease[0], lease[1], now + seconds)
+            self._changed.notify_all()
+
+    def _expire(self, subscription, now):
+        for ack_id, (message, attempts, expiry) in list(subscription.leased.items()):
+            if expiry <= now:
+                del subscription.leased[ack_id]
+                subscription.ready.append((now, message, attempts))
+
+    # Cloud IoT device configs
+
+    def update_config(self, device, data, version_to_update=0):
+        """Set the config of `device` and return it as the admin API does."""
+        if len(data) > self.max_config_bytes:
+            raise BusError(400, 'Config is larger than {} bytes'.format(
+                self.max_config_bytes))
+        now = time.time()
+        with self._changed:
+            config = self._configs.setdefault(device, _DeviceConfig())
+            if version_to_update and version_to_update != config.version:
+                raise BusError(409, 'Config version {} is not current'.format(
+                    version_to_update))
+            if now - config.last_update < 1.0 / self.config_rate:
+                raise BusError(429, 'Rate limit exceeded for config updates '
+                               'of device {}'.format(device))
+            if config.version:
+                config.history.append((config.version, config.data,
+                                       config.cloud_update_time,
+                                       config.device_ack_time))
+            config.version += 1
+            config.data = data
+            config.cloud_update_time = now
+            config.device_ack_time = None
+            config.last_update = now
+            self._changed.notify_all()
+            description = self._describe(config)
+        self._record('config', device, now, data,
+                     version=int(description['version']))
+        return description
+
+    def get_config(self, device):
+        with self._changed:
+            return self._describe(self._configs.setdefault(device, _DeviceConfig()))
+
+    def wait_config(self, device, known_version, timeout=1.0):
+        """Return (version, data) once the config is newer than `known_version`.
+
+        Returns None if nothing newer arrived within `timeout`. Like the MQTT
+        bridge, only the latest version is delivered.
+        """
+        deadline = time.time() + timeout
+        with self._changed:
+            while True:
+                config = self._configs.setdefault(device, _DeviceConfig())
+                now = time.time()
+                visible = (config.cloud_update_time or 0) + self.latency
+                if config.version > known_version and visible <= now:
+                    return config.version, config.data
+                wait = deadline - now
+                if config.version > known_version:
+                    wait = min(wait, visible - now)
+                if wait <= 0:
+                    return None
+                self._changed.wait(min(wait, 1.0))
+
+    def ack_config(self, device, version):
+        with self._changed:
+            config = self._configs.setdefault(device, _DeviceConfig())
+            now = time.time()
+            if version == config.version:
+                config.device_ack_time = now
+            else:
+                # The device received a version that has been replaced
+                # since.
+                for i, entry in enumerate(config.history):
+                    if entry[0] == version and entry[3] is None:
+                        config.history[i] = entry[:3] + (now,)
+        self._record('config_ack', device, now, version=version)
+
+    def config_versions(self, device, count=CONFIG_HISTORY):
+        """Return the latest `count` configs of `device`, newest first."""
+        with self._changed:
+            config = self._configs.setdefault(device, _DeviceConfig())
+            versions = [self._describe(config)]
+            for entry in reversed(config.history):
+                versions.append(_describe_version(*entry))
+            return versions[:count]
+
+    def _describe(self, config):
+        return _describe_version(config.version, config.data,
+                                 config.cloud_update_time,
+                                 config.device_ack_time)
+
+
+def _describe_version(version, data, cloud_update_time, device_ack_time):
+    description = {
+        'version': str(version),
+        'binaryData': base64.b64encode(data).decode('ascii'),
+    }
+    if cloud_update_time is not None:
+        description['cloudUpdateTime'] = _timestamp(cloud_update_time)
+    if device_ack_time is not None:
+        description['deviceAckTime'] = _timestamp(device_ack_time)
+    return description
+
+
+class BusManager(BaseManager):
+    pass
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def connect(address=DEFAULT_ADDRESS, authkey=None):
+    """Return a proxy of the broker served at `address`."""
+    if authkey is None:
+        authkey = os.environ.get('LOCALBUS_AUTHKEY', DEFAULT_AUTHKEY)
+    BusManager.register('get_broker')
+    manager = BusManager(address=address, authkey=authkey.encode('utf-8'))
+    manager.connect()
+    return manager.get_broker()
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for Cloud IoT Core and Pub/Sub.')
+    parser.add_argument(
+        '--port', type=int, default=DEFAULT_ADDRESS[1], help='Port to listen on.')
+    parser.add_argument(
+        '--authkey',
+        default=os.environ.get('LOCALBUS_AUTHKEY', DEFAULT_AUTHKEY),
+        help='Key clients authenticate with; also read from LOCALBUS_AUTHKEY.')
+    parser.add_argument(
+        '--config_rate',
+        type=float,
+        default=CONFIG_UPDATES_PER_SECOND,
+        help='Config updates allowed per second for each device.')
+    parser.add_argument(
+        '--max_config_bytes',
+        type=int,
+        default=MAX_CONFIG_BYTES,
+        help='Largest config a device can be sent.')
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.0,
+        help='Seconds before a message or config becomes visible to receivers.')
+    parser.add_argument(
+        '--trace',
+        default=None,
+        help='Append a JSON line for every publish, config and config ack '
+             'to this file.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    trace = open(args.trace, 'a') if args.trace else None
+    broker = LocalBroker(
+        args.config_rate, args.max_config_bytes, args.latency, trace)
+    BusManager.register('get_broker', callable=lambda: broker)
+    manager = BusManager(
+        address=('localhost', args.port), authkey=args.authkey.encode('utf-8'))
+    server = manager.get_server()
+    print('Local broker listening on localhost:{}'.format(args.port))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    # Errors are pickled to the clients, who import them from `localbus`,
+    # not from `__main__`.
+    import localbus
+    localbus.main()
@@ -0,0 +1,249 @@
+"""Leveled logging that keeps log I/O off the message threads.
+
+configure() sends every record through a queue to a listener thread, which
+formats and writes it. The paho loop and the Pub/Sub callback threads only
+pay for the level check and a queue put; when the queue is full records are
+dropped rather than blocking them.
+
+Events logged once per message go to a message logger, which passes only
+--log_sample_rate of its records below WARNING, deciding before a record
+is built. Payloads are logged through truncate() and expensive summaries
+through lazy(), so neither is built unless the record is written:
+
+  log = logutil.message_logger('reknode')
+  log.debug('Received %s', logutil.truncate(payload))
+
+Records carry the node id, and --log_format=json writes one JSON object per
+line for log collectors.
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+import time
+
+LEVELS = ('DEBUG', 'INFO', 'WARNING', 'ERROR')
+FORMATS = ('text', 'json')
+
+QUEUE_SIZE = 10000
+PAYLOAD_CHARS = 200
+
+_payload_chars = PAYLOAD_CHARS
+_listener = None
+
+
+class Truncated(object):
+    """Formats as the first characters of `value` when it is logged."""
+
+    __slots__ = ('value', 'limit')
+
+    def __init__(self, value, limit=None):
+        self.value = value
+        self.limit = limit
+
+    def __str__(self):
+        limit = self.limit or _payload_chars
+        value = self.value
+        if isinstance(value, (bytes, bytearray)):
+            size = len(value)
+            text = bytes(value[:limit]).decode('utf-8', 'replace')
+            if size > limit:
+                return '{}... ({} bytes)'.format(text, size)
+            return text
+        text = str(value)
+        if len(text) > limit:
+            return '{}... ({} characters)'.format(text[:limit], len(text))
+        return text
+
+
+class Lazy(object):
+    """Formats as the result of calling `fn` when it is logged."""
+
+    __slots__ = ('fn', 'args')
+
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+
+    def __str__(self):
+        return str(self.fn(*self.args))
+
+
+def truncate(value, limit=None):
+    return Truncated(value, limit)
+
+
+def lazy(fn, *args):
+    return Lazy(fn, *args)
+
+
+class Sampler(object):
+    """Picks an evenly spaced `rate` of the events it is asked about."""
+
+    def __init__(self, rate=1.0):
+        self.rate = rate
+        self._credit = 1.0
+        self._mutex = threading.Lock()
+
+    def sample(self):
+        if self.rate >= 1:
+            return True
+        with self._mutex:
+            self._credit += self.rate
+            if self._credit >= 1:
+                self._credit -= 1
+                return True
+        return False
+
+
+_sampler = Sampler()
+
+
+class MessageLogger(logging.LoggerAdapter):
+    """A logger that samples its records below WARNING.
+
+    The sample is taken in the level check, so a skipped event costs no
+    more than a disabled level and never builds a log record.
+    """
+
+    def isEnabledFor(self, level):
+        if not self.logger.isEnabledFor(level):
+            return False
+        return level >= logging.WARNING or _sampler.sample()
+
+
+def message_logger(name):
+    """Return the sampled logger for per-message events of `name`."""
+    return MessageLogger(logging.getLogger(name + '.messages'), {})
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, records):
+        super(_QueueHandler, self).__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # The listener runs in this process, so the record is queued as it
+        # is and its message is formatted on the listener thread.
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+
+    def __init__(self, node_id):
+        super(TextFormatter, self).__init__(
+            '%(asctime)s %(levelname)s ' + (node_id or '-') +
+            ' %(name)s: %(message)s')
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record."""
+
+    def __init__(self, node_id):
+        super(JsonFormatter, self).__init__()
+        self.node_id = node_id
+
+    def format(self, record):
+        entry = {
+            'time': record.created,
+            'level': record.levelname,
+            'node': self.node_id,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class _DropReporter(logging.Handler):
+    """Reports records the queue handler dropped, on the listener thread."""
+
+    def __init__(self, queue_handler, stream_handler):
+        super(_DropReporter, self).__init__()
+        self._queue_handler = queue_handler
+        self._stream_handler = stream_handler
+        self._reported = 0
+
+    def emit(self, record):
+        dropped = self._queue_handler.dropped
+        if dropped > self._reported:
+            self._stream_handler.handle(logging.makeLogRecord({
+                'name': __name__, 'levelno': logging.WARNING,
+                'levelname': 'WARNING', 'created': time.time(),
+                'msg': 'Log queue was full, dropped %d records',
+                'args': (dropped - self._reported,)}))
+            self._reported = dropped
+        self._stream_handler.handle(record)
+
+
+def configure(node_id=None, level='INFO', log_format='text', sample_rate=1.0,
+              payload_chars=PAYLOAD_CHARS, stream=None):
+    """Route all logging of this process through the queue listener."""
+    global _listener, _payload_chars
+    _payload_chars = payload_chars
+    _sampler.rate = sample_rate
+    if _listener is not None:
+        _listener.stop()
+    output = logging.StreamHandler(stream or sys.stderr)
+    if log_format == 'json':
+        output.setFormatter(JsonFormatter(node_id))
+    else:
+        output.setFormatter(TextFormatter(node_id))
+    handler = _QueueHandler(queue.Queue(QUEUE_SIZE))
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(
+        handler.queue, _DropReporter(handler, output))
+    _listener.start()
+
+
+def shutdown():
+    """Write out the queued records."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(shutdown)
+
+
+def add_arguments(parser):
+    """Add the logging flags shared by the scripts to an argparse parser."""
+    parser.add_argument(
+        '--log_level',
+        choices=LEVELS,
+        default='INFO',
+        help='Lowest level that is logged.')
+    parser.add_argument(
+        '--log_format',
+        choices=FORMATS,
+        default='text',
+        help='text for people, json for one object per line.')
+    parser.add_argument(
+        '--log_sample_rate',
+        type=float,
+        default=1.0,
+        help=('Fraction of the per-message events below WARNING that are '
+              'logged, e.g. 0.01 in production.'))
+    parser.add_argument(
+        '--log_payload_chars',
+        type=int,
+        default=PAYLOAD_CHARS,
+        help='Characters of a payload that are logged.')
@@ -0,0 +1,83 @@
+"""Tests for the queued, sampled logging."""
+
+import io
+import json
+import logging
+
+import pytest
+
+import logutil
+
+
+@pytest.fixture
+def root_logging():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    logutil.shutdown()
+    logutil._sampler.rate = 1.0
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def _record(msg, *args, **kwargs):
+    return logging.LogRecord(
+        'reknode.messages', kwargs.get('level', logging.INFO), __file__, 1,
+        msg, args, None)
+
+
+def test_text_format_carries_the_node_id():
+    line = logutil.TextFormatter('rek-0').format(_record('Labelled %s', 'img0'))
+    assert line.endswith(' INFO rek-0 reknode.messages: Labelled img0')
+    line = logutil.TextFormatter(None).format(_record('Labelled'))
+    assert ' INFO - reknode.messages: ' in line
+
+
+def test_json_format_has_one_object_with_the_context_fields():
+    entry = json.loads(logutil.JsonFormatter('pol-1').format(
+        _record('Sent %d chunks', 3, level=logging.WARNING)))
+    assert entry['node'] == 'pol-1'
+    assert entry['level'] == 'WARNING'
+    assert entry['logger'] == 'reknode.messages'
+    assert entry['message'] == 'Sent 3 chunks'
+    assert 'time' in entry and 'thread' in entry
+
+
+def test_payloads_are_truncated_when_formatted():
+    assert str(logutil.truncate('abcdef', 3)) == 'abc... (6 characters)'
+    assert str(logutil.truncate(b'abcdef', 3)) == 'abc... (6 bytes)'
+    assert str(logutil.truncate('abc', 3)) == 'abc'
+    calls = list()
+    lazy = logutil.lazy(lambda x: calls.append(x) or x * 2, 21)
+    assert calls == []
+    assert str(lazy) == '42'
+
+
+def test_sampler_passes_an_even_share():
+    sampler = logutil.Sampler(0.25)
+    assert [sampler.sample() for _ in range(8)] == [
+        True, False, False, True, False, False, False, True]
+    assert all(logutil.Sampler(1.0).sample() for _ in range(3))
+
+
+def test_configure_writes_through_the_queue(root_logging):
+    stream = io.StringIO()
+    logutil.configure('dapp-0', 'INFO', 'json', sample_rate=0.5, stream=stream)
+    log = logging.getLogger('dappserver')
+    message_log = logutil.message_logger('dappserver')
+    log.debug('Not written')
+    for i in range(4):
+        message_log.info('Message %d', i)
+    message_log.warning('Always written')
+    logutil.shutdown()
+
+    entries = [json.loads(line) for line in stream.getvalue().splitlines()]
+    messages = [entry['message'] for entry in entries]
+    # Half of them, give or take the one the sampler starts with.
+    assert 2 <= len([m for m in messages if m.startswith('Message')]) <= 3
+    assert messages[-1] == 'Always written'
+    assert set(entry['node'] for entry in entries) == {'dapp-0'}
+    assert entries[-1]['logger'] == 'dappserver.messages'
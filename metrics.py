@@ -0,0 +1,303 @@
+"""Counters, gauges and histograms served in the Prometheus text format.
+
+Every script records into the module's registry and, when started with
+--metrics_port, serves it at http://<metrics_host>:<port>/metrics:
+
+  JOBS = metrics.gauge('jobs_in_flight', 'Jobs being processed.')
+  JOBS.set_function(lambda: load.in_flight)
+
+Updating a metric takes one lock and a few additions, so it is cheap enough
+for the message threads. Values that are already kept elsewhere, such as
+the length of a queue, are read through set_function() when the endpoint
+is scraped instead of being updated on every change.
+
+Histograms use log-linear buckets as HDR histograms do: every power of two
+between `lowest` and `highest` is split into `sub_buckets` buckets, so any
+value is counted within a fixed relative error (19% with the default of 4)
+whatever its magnitude, from milliseconds of a config update to minutes of
+a Polly job.
+"""
+
+import bisect
+import resource
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + '}'
+
+
+class _Value(object):
+    """A counter or gauge value, or a function read when it is scraped."""
+
+    def __init__(self):
+        self._value = 0
+        self._function = None
+        self._mutex = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._mutex:
+            self._value += amount
+
+    def set_function(self, function):
+        self._function = function
+
+    def get(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+
+class _GaugeValue(_Value):
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self._mutex:
+            self._value = value
+
+
+class _HistogramValue(object):
+
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self._sum = 0.0
+        self._mutex = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._bounds, value)
+        with self._mutex:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        """Context manager observing the seconds its block takes."""
+        return _Timer(self)
+
+    def get(self):
+        with self._mutex:
+            return list(self._counts), self._sum
+
+
+class _Timer(object):
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._started = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.time() - self._started)
+
+
+class _Metric(object):
+    """A metric family; without label names it is its own only child."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = dict()
+        self._mutex = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._child()
+
+    def labels(self, *values, **kwargs):
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._mutex:
+                child = self._children.setdefault(key, self._child())
+        return child
+
+    def __getattr__(self, name):
+        # Unlabelled metrics are used directly, e.g. counter.inc().
+        if name.startswith('_') or self.labelnames:
+            raise AttributeError(name)
+        return getattr(self._children[()], name)
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for key, child in sorted(self._children.items()):
+            lines.extend(self._samples(key, child))
+        return lines
+
+    def _samples(self, key, child):
+        return ['{}{} {}'.format(
+            self.name, _labels(self.labelnames, key), _number(child.get()))]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _child(self):
+        return _Value()
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _child(self):
+        return _GaugeValue()
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), lowest=0.001,
+                 highest=3600.0, sub_buckets=4):
+        bounds = list()
+        bound = lowest
+        step = 0
+        while bound < highest:
+            bound = lowest * 2 ** (step / float(sub_buckets))
+            bounds.append(float('{:.4g}'.format(bound)))
+            step += 1
+        self.bounds = bounds
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _child(self):
+        return _HistogramValue(self.bounds)
+
+    def _samples(self, key, child):
+        counts, total = child.get()
+        lines = list()
+        cumulative = 0
+        for bound, count in zip(self.bounds + [float('inf')], counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                self.name,
+                _labels(self.labelnames, key, [('le', _number(bound))]),
+                cumulative))
+        labels = _labels(self.labelnames, key)
+        lines.append('{}_sum{} {}'.format(self.name, labels, _number(total)))
+        lines.append('{}_count{} {}'.format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self._metrics = dict()
+        self._mutex = threading.Lock()
+
+    def register(self, metric):
+        with self._mutex:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Modules imported twice (e.g. as __main__) share the metric.
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def expose(self):
+        with self._mutex:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = list()
+        for metric in metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), **kwargs):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, **kwargs))
+
+
+def _cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+counter('process_cpu_seconds_total',
+        'User and system CPU time of the process.').set_function(_cpu_seconds)
+gauge('process_max_resident_memory_bytes',
+      'Peak resident set size of the process.').set_function(_max_rss_bytes)
+gauge('process_threads', 'Threads of the process.').set_function(
+    threading.active_count)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port, host='localhost', registry=REGISTRY):
+    """Serve `registry` at /metrics on a background thread."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def add_arguments(parser):
+    """Add the metrics flags shared by the scripts to an argparse parser."""
+    parser.add_argument(
+        '--metrics_port',
+        type=int,
+        default=0,
+        help='Serve Prometheus metrics at /metrics on this port; 0 disables.')
+    parser.add_argument(
+        '--metrics_host',
+        default='localhost',
+        help='Address the metrics endpoint listens on.')
@@ -0,0 +1,75 @@
+"""Tests for the Prometheus metrics."""
+
+import urllib.request
+
+import metrics
+
+
+def test_counter_exposition_with_labels():
+    counter = metrics.Counter('bids_total', 'Bids sent.', ['result'])
+    counter.labels('sent').inc()
+    counter.labels(result='sent').inc(2)
+    counter.labels('declined "full"').inc()
+
+    assert counter.expose() == [
+        '# HELP bids_total Bids sent.',
+        '# TYPE bids_total counter',
+        'bids_total{result="declined \\"full\\""} 1',
+        'bids_total{result="sent"} 3',
+    ]
+
+
+def test_unlabelled_gauge_reads_its_function():
+    gauge = metrics.Gauge('jobs_in_flight', 'Jobs being processed.')
+    gauge.inc(3)
+    gauge.dec()
+    assert gauge.expose()[-1] == 'jobs_in_flight 2'
+    gauge.set_function(lambda: 0.5)
+    assert gauge.get() == 0.5
+    assert gauge.expose()[-1] == 'jobs_in_flight 0.5'
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram(
+        'job_seconds', 'Job time.', lowest=1.0, highest=4.0, sub_buckets=1)
+    assert histogram.bounds == [1.0, 2.0, 4.0]
+    for value in (0.5, 1.0, 3.0, 10.0):
+        histogram.observe(value)
+
+    assert histogram.expose()[2:] == [
+        'job_seconds_bucket{le="1.0"} 2',
+        'job_seconds_bucket{le="2.0"} 2',
+        'job_seconds_bucket{le="4.0"} 3',
+        'job_seconds_bucket{le="+Inf"} 4',
+        'job_seconds_sum 14.5',
+        'job_seconds_count 4',
+    ]
+
+
+def test_histogram_buckets_bound_the_relative_error():
+    bounds = metrics.Histogram('latency_seconds', 'Latency.').bounds
+    assert bounds[0] == 0.001 and bounds[-1] >= 3600
+    assert all(b / a < 1.2 for a, b in zip(bounds, bounds[1:]))
+
+
+def test_registry_shares_a_metric_registered_twice():
+    registry = metrics.Registry()
+    first = registry.register(metrics.Counter('messages_total', 'Messages.'))
+    second = registry.register(metrics.Counter('messages_total', 'Messages.'))
+    assert first is second
+    registry.register(metrics.Gauge('a_gauge', 'First by name.'))
+    assert registry.expose().splitlines()[0] == '# HELP a_gauge First by name.'
+
+
+def test_endpoint_serves_the_registry():
+    registry = metrics.Registry()
+    registry.register(metrics.Counter('served_total', 'Served.')).inc()
+    server = metrics.serve(0, registry=registry)
+    try:
+        url = 'http://localhost:{}/metrics'.format(server.server_port)
+        response = urllib.request.urlopen(url, timeout=5)
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        assert 'served_total 1' in response.read().decode('utf-8').splitlines()
+    finally:
+        server.shutdown()
+        server.server_close()
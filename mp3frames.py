@@ -0,0 +1,122 @@
+"""Split and join MPEG audio layer III streams at frame boundaries.
+
+Polly returns constant bitrate MP3, so separately synthesized snippets can
+be joined without re-encoding by concatenating their audio frames. Tags and
+Xing/Info/VBRI header frames are dropped, since they describe the length of
+the original snippet rather than the joined stream.
+
+A layer III frame may start its audio data in the bit reservoir, the unused
+bytes of the frames before it, as its main_data_begin back-pointer says. At
+a join those bytes belong to the previous snippet, so the leading frames of
+a later snippet that point back are dropped; the first few milliseconds of
+the snippet are lost instead of being decoded from the wrong bytes.
+"""
+
+# Bitrates in kbit/s for layer III, indexed by the header's bitrate index.
+_BITRATES = {
+    1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+
+_SAMPLE_RATES = {
+    1: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    2.5: (11025, 12000, 8000),
+}
+
+# Header version bits to MPEG version; 0b01 is reserved.
+_VERSIONS = {0b00: 2.5, 0b10: 2, 0b11: 1}
+
+
+def _skip_id3v2(data):
+    if data[:3] != b'ID3' or len(data) < 10:
+        return 0
+    size = 0
+    for byte in bytearray(data[6:10]):
+        size = (size << 7) | (byte & 0x7f)
+    footer = 10 if bytearray(data[5:6])[0] & 0x10 else 0
+    return 10 + size + footer
+
+
+def parse_header(header):
+    """Return (version, sample_rate, channel_mode, frame_length) of a frame."""
+    b0, b1, b2, b3 = bytearray(header[:4])
+    if b0 != 0xff or (b1 & 0xe0) != 0xe0:
+        raise ValueError('Lost frame sync')
+    version = _VERSIONS.get((b1 >> 3) & 0x03)
+    if version is None or (b1 >> 1) & 0x03 != 0b01:
+        raise ValueError('Not an MPEG layer III frame')
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0x03
+    if bitrate_index in (0, 15) or sample_rate_index == 3:
+        raise ValueError('Unsupported bitrate or sample rate')
+    bitrate = _BITRATES[1 if version == 1 else 2][bitrate_index] * 1000
+    sample_rate = _SAMPLE_RATES[version][sample_rate_index]
+    padding = (b2 >> 1) & 0x01
+    coefficient = 144 if version == 1 else 72
+    frame_length = coefficient * bitrate // sample_rate + padding
+    return version, sample_rate, b3 >> 6, frame_length
+
+
+def main_data_begin(frame):
+    """Return how many bytes back in the reservoir the frame's data starts."""
+    version = parse_header(frame)[0]
+    # The side info follows the header and its optional 16 bit CRC.
+    offset = 4 if bytearray(frame[1:2])[0] & 0x01 else 6
+    first, second = bytearray(frame[offset:offset + 2])
+    if version == 1:
+        return (first << 1) | (second >> 7)
+    return first
+
+
+def _is_info_frame(frame):
+    head = frame[:64]
+    return b'Xing' in head or b'Info' in head or frame[36:40] == b'VBRI'
+
+
+def frames(data):
+    """Yield the audio frames of an MP3 stream as byte strings."""
+    offset = _skip_id3v2(data)
+    first = True
+    while offset + 4 <= len(data):
+        if data[offset:offset + 3] == b'TAG':
+            # ID3v1 trailer.
+            break
+        frame_length = parse_header(data[offset:offset + 4])[3]
+        frame = data[offset:offset + frame_length]
+        if len(frame) < frame_length:
+            raise ValueError('Truncated frame at offset {}'.format(offset))
+        offset += frame_length
+        if first and _is_info_frame(frame):
+            first = False
+            continue
+        first = False
+        yield frame
+
+
+def concatenate(streams):
+    """Join MP3 streams into one without re-encoding.
+
+    Leading frames of every stream after the first are skipped while they
+    refer to the bit reservoir. Raises ValueError when a stream cannot be
+    parsed, has no frame that starts without the reservoir, or the streams
+    do not share the same MPEG version, sample rate and channel mode.
+    """
+    out = list()
+    layout = None
+    for stream in streams:
+        synced = layout is None
+        for frame in frames(stream):
+            if not synced:
+                if main_data_begin(frame):
+                    continue
+                synced = True
+            version, sample_rate, channel_mode, _ = parse_header(frame)
+            if layout is None:
+                layout = (version, sample_rate, channel_mode)
+            elif layout != (version, sample_rate, channel_mode):
+                raise ValueError('Streams do not share the same layout')
+            out.append(frame)
+        if not synced:
+            raise ValueError('No frame to join the stream at')
+    return b''.join(out)
@@ -0,0 +1,49 @@
+"""Tests for joining MP3 streams at frame boundaries."""
+
+import pytest
+
+import mp3frames
+
+# MPEG 1 layer III, 128 kbit/s, 44.1 kHz, joint stereo, no CRC.
+HEADER = b'\xff\xfb\x90\x44'
+FRAME_LENGTH = 417
+
+
+def _frame(reservoir=0, fill=b'\x00'):
+    side_info = bytes(bytearray([reservoir >> 1, (reservoir & 1) << 7]))
+    frame = HEADER + side_info
+    return frame + fill * (FRAME_LENGTH - len(frame))
+
+
+def test_main_data_begin():
+    assert mp3frames.main_data_begin(_frame()) == 0
+    assert mp3frames.main_data_begin(_frame(300)) == 300
+
+
+def test_frames_split_the_stream():
+    stream = _frame(fill=b'a') + _frame(fill=b'b')
+    assert list(mp3frames.frames(stream)) == [_frame(fill=b'a'), _frame(fill=b'b')]
+
+
+def test_later_streams_start_at_a_frame_without_reservoir():
+    first = _frame(fill=b'a') + _frame(40, fill=b'b')
+    second = _frame(12, fill=b'c') + _frame(fill=b'd') + _frame(7, fill=b'e')
+
+    joined = mp3frames.concatenate([first, second])
+
+    assert list(mp3frames.frames(joined)) == [
+        _frame(fill=b'a'), _frame(40, fill=b'b'),
+        _frame(fill=b'd'), _frame(7, fill=b'e')]
+
+
+def test_stream_that_only_uses_the_reservoir_cannot_be_joined():
+    with pytest.raises(ValueError):
+        mp3frames.concatenate([_frame(), _frame(5)])
+
+
+def test_streams_must_share_the_layout():
+    mono_22k = b'\xff\xf3\x90\xc4'
+    other = mono_22k + b'\x00' * 2
+    other += b'\x00' * (mp3frames.parse_header(mono_22k)[3] - len(other))
+    with pytest.raises(ValueError):
+        mp3frames.concatenate([_frame(), other])
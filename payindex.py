@@ -0,0 +1,122 @@
+"""Local index of the payment contract's PaymentReceived events.
+
+Instead of sending a new payment for every authorization, the DApp server
+can ask whether an address has already paid. A background thread scans the
+chain for PaymentReceived logs in block ranges, starting from the checkpoint
+it stored last time, and records the total paid per address in SQLite. The
+totals are mirrored in memory, so a lookup is a dictionary access and never
+waits for the chain.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from web3 import Web3
+
+PAYMENT_EVENT = 'PaymentReceived(address,uint256)'
+
+log = logging.getLogger(__name__)
+
+
+def _hex(value):
+    return value.hex() if hasattr(value, 'hex') else value
+
+
+class PaymentIndex(object):
+    """Totals paid per address, persisted with a block checkpoint."""
+
+    def __init__(self, db_path, start_block=0):
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._mutex = threading.Lock()
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS payments ('
+                'payer BLOB PRIMARY KEY, total TEXT NOT NULL) WITHOUT ROWID')
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoint ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), block INTEGER NOT NULL)')
+            self._db.execute(
+                'INSERT OR IGNORE INTO checkpoint VALUES (0, ?)',
+                (start_block - 1,))
+        self.checkpoint = self._db.execute(
+            'SELECT block FROM checkpoint').fetchone()[0]
+        self._totals = dict(
+            (bytes(payer), int(total, 16))
+            for payer, total in self._db.execute('SELECT payer, total FROM payments'))
+
+    def paid(self, addr):
+        """Return the total wei `addr` paid in the indexed blocks."""
+        try:
+            payer = bytes.fromhex(addr[2:] if addr.startswith('0x') else addr)
+        except ValueError:
+            return 0
+        return self._totals.get(payer, 0)
+
+    def has_paid(self, addr, min_amount=1):
+        return self.paid(addr) >= min_amount
+
+    def record(self, payments, last_block):
+        """Add (payer, amount) pairs seen up to `last_block` and move the checkpoint."""
+        with self._mutex:
+            totals = dict()
+            for payer, amount in payments:
+                totals[payer] = totals.get(payer, self._totals.get(payer, 0)) + amount
+            with self._db:
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO payments VALUES (?, ?)',
+                    [(payer, '{:x}'.format(total)) for payer, total in totals.items()])
+                self._db.execute(
+                    'UPDATE checkpoint SET block = ? WHERE id = 0', (last_block,))
+            self._totals.update(totals)
+            self.checkpoint = last_block
+
+
+class PaymentIndexer(threading.Thread):
+    """Keeps a PaymentIndex caught up with the chain in the background."""
+
+    def __init__(self, w3, contract_address, index, batch_size=2000,
+                 confirmations=12, poll_interval=15):
+        super(PaymentIndexer, self).__init__()
+        self.daemon = True
+        self.w3 = w3
+        self.contract_address = contract_address
+        self.index = index
+        self.batch_size = batch_size
+        self.confirmations = confirmations
+        self.poll_interval = poll_interval
+        self.topic = Web3.toHex(Web3.keccak(text=PAYMENT_EVENT))
+
+    def scan(self, from_block, to_block):
+        """Return (payer, amount) for the payments logged in the block range."""
+        logs = self.w3.eth.getLogs({
+            'fromBlock': from_block,
+            'toBlock': to_block,
+            'address': self.contract_address,
+            'topics': [self.topic],
+        })
+        payments = list()
+        for log in logs:
+            # Both event arguments are indexed, so they are read straight from
+            # the topics without decoding the log against the ABI.
+            payer = bytes.fromhex(_hex(log['topics'][1])[-40:])
+            amount = int(_hex(log['topics'][2]), 16)
+            payments.append((payer, amount))
+        return payments
+
+    def catch_up(self):
+        """Index every confirmed block after the checkpoint."""
+        head = self.w3.eth.blockNumber - self.confirmations
+        while self.index.checkpoint < head:
+            start = self.index.checkpoint + 1
+            end = min(start + self.batch_size - 1, head)
+            self.index.record(self.scan(start, end), end)
+
+    def run(self):
+        while True:
+            try:
+                self.catch_up()
+            except Exception as e:
+                log.warning('Payment index scan failed: %s', e)
+            time.sleep(self.poll_interval)
@@ -0,0 +1,74 @@
+"""Tests for the local index of payments."""
+
+import payindex
+
+PAYER = bytes.fromhex('00000000000000000000000000000000000000aa')
+OTHER = bytes.fromhex('00000000000000000000000000000000000000bb')
+
+
+def test_record_adds_up_totals_per_payer(tmp_path):
+    index = payindex.PaymentIndex(str(tmp_path / 'payments.db'))
+    assert index.checkpoint == -1
+    index.record([(PAYER, 5), (OTHER, 1), (PAYER, 7)], 10)
+    index.record([(PAYER, 3)], 20)
+
+    assert index.paid('0x' + PAYER.hex()) == 15
+    assert index.paid(OTHER.hex().upper()) == 1
+    assert index.paid('0xnot-an-address') == 0
+    assert index.has_paid('0x' + OTHER.hex())
+    assert not index.has_paid('0x' + OTHER.hex(), min_amount=2)
+    assert index.checkpoint == 20
+
+
+def test_totals_and_checkpoint_survive_a_reopen(tmp_path):
+    path = str(tmp_path / 'payments.db')
+    index = payindex.PaymentIndex(path, start_block=100)
+    assert index.checkpoint == 99
+    index.record([(PAYER, 2 ** 80)], 150)
+
+    # The start block only applies to a new index.
+    index = payindex.PaymentIndex(path, start_block=500)
+    assert index.checkpoint == 150
+    assert index.paid('0x' + PAYER.hex()) == 2 ** 80
+
+
+class _Eth(object):
+    """A chain with `blockNumber` blocks and payments at given blocks."""
+
+    def __init__(self, block_number, payments):
+        self.blockNumber = block_number
+        self.payments = payments
+        self.ranges = list()
+
+    def getLogs(self, query):
+        self.ranges.append((query['fromBlock'], query['toBlock']))
+        return [
+            {'topics': [query['topics'][0],
+                        '0x' + '00' * 12 + payer.hex(),
+                        '0x{:064x}'.format(amount)]}
+            for block, payer, amount in self.payments
+            if query['fromBlock'] <= block <= query['toBlock']]
+
+
+class _Web3(object):
+    def __init__(self, eth):
+        self.eth = eth
+
+
+def test_catch_up_scans_confirmed_blocks_in_ranges(tmp_path):
+    eth = _Eth(block_number=30, payments=[(3, PAYER, 4), (12, OTHER, 1), (25, PAYER, 9)])
+    index = payindex.PaymentIndex(str(tmp_path / 'payments.db'), start_block=1)
+    indexer = payindex.PaymentIndexer(
+        _Web3(eth), '0xcontract', index, batch_size=10, confirmations=6)
+
+    indexer.catch_up()
+    assert eth.ranges == [(1, 10), (11, 20), (21, 24)]
+    assert index.checkpoint == 24
+    # The payment in block 25 needs more blocks on top of it.
+    assert index.paid('0x' + PAYER.hex()) == 4
+    assert index.paid('0x' + OTHER.hex()) == 1
+
+    eth.blockNumber = 31
+    indexer.catch_up()
+    assert eth.ranges[-1] == (25, 25)
+    assert index.paid('0x' + PAYER.hex()) == 13
@@ -3,21 +3,30 @@
 
 from web3 import Web3
 import json
+import logging
 
-def authenticate(addr, cred):
+log = logging.getLogger(__name__)
+
+PROVIDER_URL = "https://ropsten.infura.io/v3/f9c889dXXXXXXXXXXX186e5"
+CONTRACT_ADDRESS = "0xfB6916095XXXXXXXXX74c37c5d359"
+
+def authenticate(addr, cred, provider=None, contract_address=CONTRACT_ADDRESS, chain_id=3):
     
     with open('paymentABI.json') as f:
         paymentabi = json.load(f)
 
-    w3 = Web3(Web3.WebsocketProvider("https://ropsten.infura.io/v3/f9c889dXXXXXXXXXXX186e5"))
-    unicorns = w3.eth.contract(address="0xfB6916095XXXXXXXXX74c37c5d359", abi=paymentabi)
+    # Another provider and contract can be passed in, e.g. a local test chain.
+    if provider is None:
+        provider = Web3.WebsocketProvider(PROVIDER_URL)
+    w3 = Web3(provider)
+    unicorns = w3.eth.contract(address=contract_address, abi=paymentabi)
 
     nonce = w3.eth.getTransactionCount(addr) 
     # user account  
 
     # Build a transaction that invokes this contract's function, called transfer
     unicorn_txn = unicorns.functions.pay().buildTransaction({
-        'chainId': 3,
+        'chainId': chain_id,
         'gas': 70000,
         'gasPrice': w3.toWei('1', 'gwei'),
         'nonce': nonce,
@@ -33,7 +42,7 @@ def authenticate(addr, cred):
         w3.eth.sendRawTransaction(signed_txn.rawTransaction)
         # w3.toHex(w3.keccak(signed_txn.rawTransaction))
     except Exception as e:
+        log.warning('Transaction from %s failed: %s', addr, e)
         return False
-        print('Transaction failed', e)
     return True
     # When you run sendRawTransaction, you get the same result as the hash of the transaction:
@@ -43,9 +43,12 @@ devices and running them all at the same time.
 
 import argparse
 import datetime
+import functools
 import json
+import logging
 import os
 import ssl
+import sys
 import time
 from threading import Lock
 
@@ -54,15 +57,32 @@ import paho.mqtt.client as mqtt
 import glob
 import random
 import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
 import io
 import boto3
 from google.cloud import pubsub
 from google.cloud import pubsub_v1
 from google.oauth2 import service_account
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+
+import audiocache
+import batching
+import bidding
+import chunking
+import encoding
+import logutil
+import metrics
+import mp3frames
+import routing
+import tracing
+import transport
 
 
 v_count = 0
+# Set from --aws_endpoint_url; None talks to AWS itself.
+aws_endpoint_url = None
 image_dict = dict()
 send_rek_ack = list()
 send_rek = list()
@@ -72,6 +92,42 @@ API_VERSION = 'v1'
 DISCOVERY_API = 'https://cloudiot.googleapis.com/$discovery/rest'
 SERVICE_NAME = 'cloudiot'
 
+log = logging.getLogger('pollyNode')
+message_log = logutil.message_logger('pollyNode')
+
+MESSAGES = metrics.counter(
+    'messages_received_total', 'Pub/Sub messages handled, by type.', ['type'])
+BIDS = metrics.counter(
+    'bids_total', 'POL requests bid on or declined at capacity.', ['result'])
+JOBS_IN_FLIGHT = metrics.gauge(
+    'jobs_in_flight', 'Captions being synthesized or sent.')
+JOB_SECONDS = metrics.histogram(
+    'job_seconds', 'Time from a POLACK to the last audio chunk being acked.')
+CONFIG_UPDATES = metrics.counter(
+    'config_updates_total', 'Device config updates, by HTTP status.', ['status'])
+CONFIG_UPDATES_WAITING = metrics.gauge(
+    'config_updates_waiting',
+    'Config updates sleeping out the config delay or waiting for the API.')
+CONFIG_UPDATE_SECONDS = metrics.histogram(
+    'config_update_seconds', 'Latency of the ModifyCloudToDeviceConfig call.')
+CONFIG_ACK_SECONDS = metrics.histogram(
+    'config_ack_seconds', 'Time for a device to acknowledge an audio chunk.')
+AUDIO_CHUNKS = metrics.counter(
+    'audio_chunks_total', 'POLRES manifests and chunks, by outcome.', ['result'])
+AWS_SECONDS = metrics.histogram(
+    'aws_request_seconds', 'Latency of AWS calls.', ['operation'])
+
+# Outcomes of waiting for a device to acknowledge a config version.
+ACKED = 'acked'
+SUPERSEDED = 'superseded'
+UNACKED = 'unacked'
+# Times an audio chunk is pushed again after other configs replaced it.
+CHUNK_ATTEMPTS = 5
+# Seconds between polls for a config ack, doubling from the first up to the
+# last; devices fetch configs about as fast as they may be updated, 1/s.
+ACK_POLL_INITIAL = 1.0
+ACK_POLL_MAX = 8.0
+
 def create_jwt(project_id, private_key_file, algorithm):
     """Create a JWT (https://jwt.io) to establish an MQTT connection."""
     token = {
@@ -81,8 +137,8 @@ def create_jwt(project_id, private_key_file, algorithm):
     }
     with open(private_key_file, 'r') as f:
         private_key = f.read()
-    print('Creating JWT using {} from private key file {}'.format(
-        algorithm, private_key_file))
+    log.info('Creating JWT using %s from private key file %s',
+             algorithm, private_key_file)
     return jwt.encode(token, private_key, algorithm=algorithm)
 
 
@@ -99,20 +155,33 @@ class Device(object):
         self.fan_on = False
         self.connected = False
         self.id = dev_id
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_json).with_scopes(API_SCOPES)
-        if not credentials:
-            sys.exit('Could not load service account credential '
-                     'from {}'.format(service_account_json))
-
-        discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
-
-        self._service = discovery.build(
-            SERVICE_NAME,
-            API_VERSION,
-            discoveryServiceUrl=discovery_url,
-            credentials=credentials,
-            cache_discovery=False)
+        if transport.is_local():
+            # The local broker stands in for the Cloud IoT admin API.
+            self._service = transport.cloudiot_service()
+            self._ack_service = transport.cloudiot_service()
+        else:
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_json).with_scopes(API_SCOPES)
+            if not credentials:
+                sys.exit('Could not load service account credential '
+                         'from {}'.format(service_account_json))
+
+            discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
+
+            self._service = discovery.build(
+                SERVICE_NAME,
+                API_VERSION,
+                discoveryServiceUrl=discovery_url,
+                credentials=credentials,
+                cache_discovery=False)
+            # Config acks are polled over a client of their own, so the
+            # polls do not queue behind the paced config updates.
+            self._ack_service = discovery.build(
+                SERVICE_NAME,
+                API_VERSION,
+                discoveryServiceUrl=discovery_url,
+                credentials=credentials,
+                cache_discovery=False)
 
         # Used to serialize the calls to the
         # modifyCloudToDeviceConfig REST method. This is needed
@@ -121,8 +190,10 @@ class Device(object):
         # details, see: https://developers.google.com/
         #     api-client-library/python/guide/thread_safety
         self._update_config_mutex = Lock()
+        # Serializes the config ack polls on their own client.
+        self._ack_mutex = Lock()
 
-    def _update_device_config(self, project_id, region, registry_id, device_id, data):
+    def _update_device_config(self, project_id, region, registry_id, device_id, data, delay=20):
         """Push the data to the given device as configuration."""
         body = {
             'version_to_update': 0,
@@ -137,17 +208,56 @@ class Device(object):
                            device_id))
         request = self._service.projects().locations().registries().devices(
         ).modifyCloudToDeviceConfig(name=device_name, body=body)
-        time.sleep(20)
+        CONFIG_UPDATES_WAITING.inc()
+        time.sleep(delay)
         self._update_config_mutex.acquire()
         try:
-            request.execute()
-            time.sleep(20)
-        except Error as e:
-        	print(e)
+            with CONFIG_UPDATE_SECONDS.time(), tracing.span(
+                    'ModifyCloudToDeviceConfig', kind=tracing.CLIENT, device=device_id):
+                config = request.execute()
+            CONFIG_UPDATES.labels(200).inc()
+            time.sleep(delay)
+            return config
         except HttpError as e:
-            print('Error executing ModifyCloudToDeviceConfig: {}'.format(e))
+            CONFIG_UPDATES.labels(e.resp.status).inc()
+            log.warning('Error executing ModifyCloudToDeviceConfig: %s', e)
         finally:
             self._update_config_mutex.release()
+            CONFIG_UPDATES_WAITING.dec()
+
+    def _wait_for_config_ack(self, project_id, region, registry_id, device_id, version, timeout=60):
+        """Wait until the device acknowledged the given config version.
+
+        Returns ACKED once that version has a deviceAckTime, SUPERSEDED if
+        a newer config replaced it before the device fetched it, and UNACKED
+        after `timeout` seconds. Device configs are last-write-wins, and the
+        other nodes push bids and results to the same device, so a newer
+        version says nothing about this one. Polls back off exponentially
+        from ACK_POLL_INITIAL seconds.
+        """
+        device_name = ('projects/{}/locations/{}/registries/{}/'
+                       'devices/{}'.format(
+                           project_id,
+                           region,
+                           registry_id,
+                           device_id))
+        deadline = time.time() + timeout
+        interval = ACK_POLL_INITIAL
+        while True:
+            request = self._ack_service.projects().locations().registries().devices(
+            ).configVersions().list(name=device_name)
+            with self._ack_mutex:
+                configs = request.execute().get('deviceConfigs', [])
+            versions = dict((int(config.get('version', 0)), config) for config in configs)
+            if versions.get(version, {}).get('deviceAckTime'):
+                return ACKED
+            if versions and max(versions) > version:
+                return SUPERSEDED
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return UNACKED
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, ACK_POLL_MAX)
 
     def get_id(self):
         return self.id
@@ -174,29 +284,29 @@ class Device(object):
 
     def on_connect(self, unused_client, unused_userdata, unused_flags, rc):
         """Callback for when a device connects."""
-        print('Connection Result:', error_str(rc))
+        log.info('Connection Result: %s', error_str(rc))
         self.connected = True
 
     def on_disconnect(self, unused_client, unused_userdata, rc):
         """Callback for when a device disconnects."""
-        print('Disconnected:', error_str(rc))
+        log.warning('Disconnected: %s', error_str(rc))
         self.connected = False
 
     def on_publish(self, unused_client, unused_userdata, unused_mid):
         """Callback when the device receives a PUBACK from the MQTT bridge."""
-        print('Published message acked.')
+        message_log.debug('Published message acked.')
 
     def on_subscribe(self, unused_client, unused_userdata, unused_mid, granted_qos):
         """Callback when the device receives a SUBACK from the MQTT bridge."""
-        print('Subscribed: ', granted_qos)
+        log.info('Subscribed: %s', granted_qos)
         if granted_qos[0] == 128:
-            print('Subscription failed.')
+            log.error('Subscription failed.')
 
     def on_message(self, unused_client, unused_userdata, message):
         """Callback when the device receives a message on a subscription."""
         payload = message.payload.decode('utf-8')
-        print('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-            payload, message.topic, str(message.qos)))
+        message_log.debug('Received message \'%s\' on topic \'%s\' with Qos %s',
+                          logutil.truncate(payload), message.topic, message.qos)
 
         # The device will receive its latest config when it subscribes to the
         # config topic. If there is no configuration for the device, the device
@@ -261,62 +371,237 @@ def parse_command_line_args():
         '--pubsub_subscription',
         required=True,
         help='Google Cloud Pub/Sub subscription name.')
+    parser.add_argument(
+        '--capacity',
+        type=int,
+        default=4,
+        help='Jobs this node works on at once before it declines new requests.')
+    parser.add_argument(
+        '--audio_cache_dir',
+        default='audio_cache',
+        help='Directory for cached Polly audio. Empty to disable the cache.')
+    parser.add_argument(
+        '--audio_cache_mb',
+        type=int,
+        default=256,
+        help='Size limit of the audio cache in megabytes.')
+    parser.add_argument(
+        '--whole_captions',
+        action='store_true',
+        help=('Synthesize every caption in one Polly call instead of joining '
+              'cached per-label snippets.'))
+    parser.add_argument(
+        '--audio_budget',
+        action='append',
+        metavar='CLASS=BYTES',
+        help=('Payload budget for a device class, e.g. constrained=32768. '
+              'May be given several times; an empty value removes the limit.'))
+    parser.add_argument(
+        '--dispatch',
+        choices=routing.DISPATCH_MODES,
+        default=routing.BID,
+        help=('bid answers POL requests with bids; direct takes POLJOB jobs '
+              'from --pubsub_subscription, shared by all polly nodes. Devices '
+              'started with --chain need direct.'))
+    parser.add_argument(
+        '--bulk_subscription',
+        default=None,
+        help=('With bid dispatch, take the POLACK jobs from this subscription '
+              'and only the POL requests from --pubsub_subscription, each '
+              'with its own workers, so bids are not queued behind jobs.'))
+    parser.add_argument(
+        '--control_workers',
+        type=int,
+        default=transport.CALLBACK_THREADS,
+        help='Threads handling POL requests when --bulk_subscription is set.')
+    parser.add_argument(
+        '--pubsub_topic',
+        default=None,
+        help=('Central Pub/Sub topic name. When given, the subscription is '
+              'created with a filter that only delivers this node\'s traffic.'))
 
     parser.add_argument(
         '--service_account_json',
         required=True,
         help='Path to service account json file.')
 
+    parser.add_argument(
+        '--transport',
+        choices=transport.TRANSPORTS,
+        default=transport.GOOGLE,
+        help=('google talks to Cloud IoT Core and Pub/Sub; local talks to the '
+              'broker started with localbus.py.'))
+    parser.add_argument(
+        '--local_broker',
+        default='localhost:50000',
+        help='host:port of the local broker for --transport=local.')
+    logutil.add_arguments(parser)
+    metrics.add_arguments(parser)
+    tracing.add_arguments(parser)
+    parser.add_argument(
+        '--aws_endpoint_url',
+        default=None,
+        help=('Send the Polly calls to this endpoint instead of AWS, e.g. the '
+              'fake services of benchmarks/fakeaws.py.'))
+    parser.add_argument(
+        '--config_delay',
+        type=float,
+        default=20,
+        help=('Seconds to wait before and after a bid or the first audio '
+              'chunk is pushed to a device.'))
     return parser.parse_args()
 #Added code to encode image
 
-def convertAudioToByteArray(audio):
-    image_data = base64.b64encode(audio).decode('utf-8').encode('ascii')
-    return image_data
-
 def getJSONForEncodedImage(image_path):
     imgStr = convertImageToByteArray(image_path)
     payload_json = {'temperature': 0,'image_data' : imgStr}
     #payload_json = {'temperature': 0}
     return imgStr
 
-def getAudio(text):
-	polly_client = boto3.Session(
-	                aws_access_key_id='',                     
-	    aws_secret_access_key='',
-	    region_name='us-west-2').client('polly')
-
-	response = polly_client.synthesize_speech(VoiceId='Joanna',
-	                OutputFormat='mp3', 
-	                Text = text)
-
-	return response['AudioStream'].read()
+def getPollyClient():
+    return boto3.Session(
+                    aws_access_key_id='',                     
+        aws_secret_access_key='',
+        region_name='us-west-2').client('polly', endpoint_url=aws_endpoint_url)
+
+def getAudio(text, cache=None, voice='Joanna', output_format='mp3', sample_rate=None):
+    key = audiocache.cache_key(voice, output_format, text, sample_rate)
+    if cache is not None:
+        path = cache.get(key)
+        if path is not None:
+            with io.open(path, 'rb') as f:
+                return f.read()
+
+    options = dict()
+    if sample_rate is not None:
+        options['SampleRate'] = sample_rate
+    with AWS_SECONDS.labels('synthesize_speech').time(), tracing.span(
+            'SynthesizeSpeech', kind=tracing.CLIENT, format=output_format):
+        response = getPollyClient().synthesize_speech(VoiceId=voice,
+                        OutputFormat=output_format, 
+                        Text = text,
+                        **options)
+        audio = response['AudioStream'].read()
+    if cache is not None:
+        cache.put(key, audio)
+    return audio
+
+def getCaptionAudio(segments, cache=None, voice='Joanna', sample_rate=None):
+    """Speak a caption by joining the cached audio of its segments.
+
+    Every template part and label is synthesized once and then served from
+    the cache, so a new caption usually costs at most one Polly call for the
+    image title. Falls back to synthesizing the whole caption when the
+    snippets cannot be joined frame by frame.
+    """
+    snippets = [getAudio(segment, cache, voice, 'mp3', sample_rate) for segment in segments]
+    try:
+        return mp3frames.concatenate(snippets)
+    except ValueError as e:
+        log.warning('Could not join caption snippets (%s), synthesizing the whole caption', e)
+        return getAudio(' '.join(segments), cache, voice, 'mp3', sample_rate)
+
+def synthesizeCaption(data, cache, device_classes, whole_captions=False):
+    """Return (audio, output format) for a POLACK request.
+
+    The encoding is the best one expected to fit the payload budget of the
+    requesting device's class. The duration is estimated from the length of
+    the caption; only when the audio comes out over the budget is it
+    synthesized again, in an encoding chosen from its actual size.
+    """
+    budget, formats = device_classes.get(
+        data.get('device_class'), device_classes['standard'])
+    segments = data.get('segments')
+    use_snippets = bool(segments) and cache is not None and not whole_captions
+    parts = segments if use_snippets else [data['img_data']]
+
+    def speak(output_format, sample_rate):
+        if output_format == 'mp3' and use_snippets:
+            return getCaptionAudio(segments, cache, sample_rate=sample_rate)
+        return getAudio(data['img_data'], cache, output_format=output_format,
+                        sample_rate=sample_rate)
+
+    duration = sum(encoding.estimate_duration([], part) for part in parts)
+    output_format, sample_rate = encoding.choose_encoding(duration, budget, formats)
+    sound = speak(output_format, sample_rate)
+    if budget is not None and len(sound) > budget:
+        duration = encoding.audio_duration(len(sound), output_format, sample_rate)
+        choice = encoding.choose_encoding(duration, budget, formats)
+        if choice != (output_format, sample_rate):
+            output_format, sample_rate = choice
+            sound = speak(output_format, sample_rate)
+    if output_format == 'pcm':
+        sound = encoding.pcm_to_wav(sound, sample_rate)
+    return sound, output_format
 
 def main():
     args = parse_command_line_args()
-
-    subscriber = pubsub.SubscriberClient()
+    transport.configure(args.transport, args.local_broker)
+    logutil.configure(args.device_id, args.log_level, args.log_format,
+                      args.log_sample_rate, args.log_payload_chars)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    tracing.configure(args.device_id, args.span_file)
+    global aws_endpoint_url
+    aws_endpoint_url = args.aws_endpoint_url
+
+    subscriber = transport.subscriber_client()
     subscription_path = subscriber.subscription_path(
                               args.project_id,
                               args.pubsub_subscription)
-
-    publisher = pubsub_v1.PublisherClient()
+    # Each lane is a subscription with its own flow control and workers;
+    # without --bulk_subscription one subscription carries both.
+    lanes = [(subscription_path, None)]
+    if args.bulk_subscription and args.dispatch == routing.BID:
+        lanes = [
+            (subscription_path, routing.CONTROL),
+            (subscriber.subscription_path(args.project_id, args.bulk_subscription),
+             routing.BULK),
+        ]
+    elif args.bulk_subscription:
+        log.warning('Ignoring --bulk_subscription, direct dispatch takes every job from %s', subscription_path)
+
+    publisher = transport.publisher_client()
+    if args.pubsub_topic:
+        for path, lane in lanes:
+            routing.ensure_subscription(
+                subscriber,
+                path,
+                publisher.topic_path(args.project_id, args.pubsub_topic),
+                'pol',
+                args.device_id,
+                args.dispatch,
+                lane)
     global count
     count = 0
+    load = bidding.LoadTracker(args.capacity)
+    JOBS_IN_FLIGHT.set_function(lambda: load.in_flight)
+    device_classes = encoding.parse_budgets(args.audio_budget)
+    cache = None
+    if args.audio_cache_dir:
+        cache = audiocache.AudioCache(
+            args.audio_cache_dir, args.audio_cache_mb * 1024 * 1024)
+        metrics.counter('audio_cache_hits_total', 'Audio cache hits.').set_function(
+            lambda: cache.hits)
+        metrics.counter('audio_cache_misses_total', 'Audio cache misses.').set_function(
+            lambda: cache.misses)
+        metrics.gauge('audio_cache_bytes', 'Size of the cached audio.').set_function(
+            lambda: cache.stats()['bytes'])
     # Create the MQTT client and connect to Cloud IoT.
-    client = mqtt.Client(
+    client = transport.mqtt_client(
         client_id='projects/{}/locations/{}/registries/{}/devices/{}'.format(
             args.project_id,
             args.cloud_region,
             args.registry_id,
             args.device_id))
-    client.username_pw_set(
-        username='unused',
-        password=create_jwt(
-            args.project_id,
-            args.private_key_file,
-            args.algorithm))
-    client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+    if not transport.is_local():
+        client.username_pw_set(
+            username='unused',
+            password=create_jwt(
+                args.project_id,
+                args.private_key_file,
+                args.algorithm))
+        client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
 
     device = Device(args.device_id, args.service_account_json)
     os.system("rm -rf sounds" + device.get_id())
@@ -338,7 +623,77 @@ def main():
     # Wait up to 5 seconds for the device to connect.
     device.wait_for_connection(5)
     
-    def callback(message):
+    count_mutex = Lock()
+
+    def synthesize(data, parent=None):
+        """Synthesize the caption of one job; returns its file and extension."""
+        global count
+        with count_mutex:
+            count = count + 1
+            number = count
+        with tracing.span('synthesize', parent=parent, image=data['img_name']):
+            sound, output_format = synthesizeCaption(
+                data, cache, device_classes, args.whole_captions)
+        extension = encoding.EXTENSIONS[output_format]
+        sound_path = "sounds" + device.get_id() + "/speech" + str(number) + "." + extension
+        with io.open(sound_path, 'wb') as f:
+            f.write(sound)
+            if cache is not None:
+                message_log.info('%s', logutil.lazy(cache.report))
+        return sound_path, extension
+
+    def send_audio(data, sound_path, extension):
+        """Deliver the audio of one job to its device, chunk by chunk."""
+        device_project_id = args.project_id
+        device_registry_id = args.registry_id
+        device_id = data['dev_id']
+        device_region = args.cloud_region
+        message_log.info("Publishing Polly results to device %s for image %s", data['dev_id'], data['img_name'])
+        # The audio goes out as a manifest followed by numbered chunks, each
+        # small enough for one device config.
+        delay = args.config_delay
+        for payload_json in chunking.transfer_messages(
+                'POLRES', sound_path,
+                img_name=data['img_name'], node_id=device.get_id(),
+                extension=extension, credits=load.credits):
+            tracing.inject(payload_json)
+            payload = json.dumps(payload_json)
+            for attempt in range(CHUNK_ATTEMPTS):
+                # Send the config to the device.
+                config = device._update_device_config(
+                  device_project_id,
+                  device_region,
+                  device_registry_id,
+                  device_id,
+                  payload,
+                  delay)
+                # Chunks only need to respect the per-device limit of one
+                # config update per second.
+                delay = 1
+                if config is None:
+                    outcome = UNACKED
+                    break
+                with CONFIG_ACK_SECONDS.time(), tracing.span(
+                        'wait for config ack', device=device_id):
+                    outcome = device._wait_for_config_ack(
+                        device_project_id,
+                        device_region,
+                        device_registry_id,
+                        device_id,
+                        int(config['version']))
+                if outcome != SUPERSEDED:
+                    break
+                # Another config replaced the chunk before the device got
+                # it; the device drops repeated chunks, so push it again.
+                AUDIO_CHUNKS.labels(SUPERSEDED).inc()
+                message_log.info("Audio for image %s was replaced on device %s, sending it again", data['img_name'], device_id)
+            if outcome != ACKED:
+                AUDIO_CHUNKS.labels(UNACKED).inc()
+                log.warning("Device %s did not acknowledge audio for image %s, giving up", data['dev_id'], data['img_name'])
+                break
+            AUDIO_CHUNKS.labels(ACKED).inc()
+
+    def callback(message, lane=None):
         """Logic executed when a message is received from
         subscribed topic.
         """
@@ -351,76 +706,115 @@ def main():
             message.ack()
             return
         '''
-        global count
+        # Traffic for other roles or other nodes is dropped on its attributes
+        # alone, without decoding the (possibly multi-megabyte) body.
+        if not routing.accepts(message.attributes, 'pol', device.get_id(), lane):
+            MESSAGES.labels('other').inc()
+            message.ack()
+            return
         try:
             try:
                 data = json.loads(message.data.decode('utf-8'))
             except ValueError as e:
-                print('Loading Payload ({}) threw an Exception: {}.'.format(
-                    message.data, e))
+                MESSAGES.labels('invalid').inc()
+                log.warning('Loading Payload (%s) threw an Exception: %s.',
+                            logutil.truncate(message.data), e)
                 message.ack()
                 return
-            if data['type'] == 'POL':
-                dev_id = data['dev_id']
-                img = data['img_name']
-                print("Recieved initial request from device " + dev_id + " for image " + img + "\n\n\n")
-                message.ack()
-                mqtt_config_topic = '/devices/{}/config/'.format(dev_id)
-                payload_json = {'type' : 'POLSYM', 'img_name':img, 'node_id': device.get_id(), 'labels': data['labels']}
-                payload = json.dumps(payload_json)
-                device_project_id = args.project_id
-                device_registry_id = args.registry_id
-                device_id = dev_id
-                device_region = args.cloud_region
-                print("Sending acknowledgement to device " + dev_id + "for image " + img + "\n\n\n")
-                # Send the config to the device.
-                device._update_device_config(
-                  device_project_id,
-                  device_region,
-                  device_registry_id,
-                  device_id,
-                  payload)
-                time.sleep(1)
-                
-            elif data['type'] == 'POLACK':
-                if(data['node_id'] == device.get_id()):
-                	print("Recieved acknowledgement from device " + data['dev_id'] + " for image " + data['img_name'] + "\n\n\n")
-                	message.ack()
-                	count = count + 1
-                	with io.open("sounds" + device.get_id() + "/speech" + str(count) + ".mp3", 'wb') as f:
-						sound = getAudio(data['img_data'])
-						f.write(sound)
-						# converted_sound = convertImageToByteArray("sounds" + device.get_id() + "/speech" + str(count) + ".mp3")
-						converted_sound = convertAudioToByteArray(("sounds" + device.get_id() + "/speech" + str(count) + ".mp3"))
-						payload_json = {'type': 'POLRES', 'img_name':data['img_name'], 'audio': converted_sound, 'node_id': device.get_id()}
-						payload = json.dumps(payload_json)
-						device_project_id = args.project_id
-						device_registry_id = args.registry_id
-						device_id = data['dev_id']
-						device_region = args.cloud_region
-						print("Publishing Polly results to device " + data['dev_id'] + "for image " + data['img_name'])
-						# Send the config to the device.
-						device._update_device_config(
-						  device_project_id,
-						  device_region,
-						  device_registry_id,
-						  device_id,
-						  payload)
-						time.sleep(1)
-                        # Signal to the main thread that we can exit.
-                        #job_done.set()
-                else:
+            MESSAGES.labels(data['type']).inc()
+            with tracing.span('handle ' + data['type'], parent=tracing.extract(data),
+                              kind=tracing.CONSUMER, image=data.get('img_name')):
+                if data['type'] in ('POL', 'POLBATCH'):
+                    dev_id = data['dev_id']
+                    img = data['img_name']
+                    message_log.info("Received initial request from device %s for image %s", dev_id, img)
                     message.ack()
+                    # A batch is bid on as a whole, with a credit per caption.
+                    bid = load.bid((dev_id, img), len(data.get('img_names', [img])))
+                    if bid is None:
+                        BIDS.labels('declined').inc()
+                        message_log.info("Declining request from device %s for image %s, node is at capacity", dev_id, img)
+                        return
+                    BIDS.labels('bid').inc()
+                    mqtt_config_topic = '/devices/{}/config/'.format(dev_id)
+                    payload_json = {'type' : 'POLSYM', 'img_name':img, 'node_id': device.get_id()}
+                    if 'batch_id' in data:
+                        payload_json['batch_id'] = data['batch_id']
+                    else:
+                        payload_json['labels'] = data['labels']
+                    payload_json.update(bid)
+                    tracing.inject(payload_json)
+                    payload = json.dumps(payload_json)
+                    device_project_id = args.project_id
+                    device_registry_id = args.registry_id
+                    device_id = dev_id
+                    device_region = args.cloud_region
+                    message_log.info("Sending acknowledgement to device %s for image %s", dev_id, img)
+                    # Send the config to the device.
+                    device._update_device_config(
+                      device_project_id,
+                      device_region,
+                      device_registry_id,
+                      device_id,
+                      payload,
+                      args.config_delay)
+                    time.sleep(1)
+                
+                elif data['type'] in ('POLACK', 'POLJOB'):
+                    if data['type'] == 'POLJOB' or data['node_id'] == device.get_id():
+                        message_log.info("Received %s from device %s for image %s", data['type'], data['dev_id'], data['img_name'])
+                        if data['type'] == 'POLACK':
+                            message.ack()
+                        jobs = batching.expand(data, 'items')
+                        started = [load.start((job['dev_id'], job.get('batch_id', job['img_name'])))
+                                   for job in jobs]
+                        try:
+                            if len(jobs) == 1:
+                                sounds = [synthesize(jobs[0])]
+                            else:
+                                # The captions of a batch are synthesized in
+                                # parallel; the audio then goes out one file
+                                # at a time, as the device has one config.
+                                parent = tracing.current()
+                                with ThreadPoolExecutor(max_workers=min(len(jobs), args.capacity)) as executor:
+                                    sounds = list(executor.map(
+                                        lambda job: synthesize(job, parent), jobs))
+                            for job, (sound_path, extension) in zip(jobs, sounds):
+                                send_audio(job, sound_path, extension)
+                        finally:
+                            for job_started in started:
+                                load.finish(job_started)
+                                JOB_SECONDS.observe(time.time() - job_started)
+                        if data['type'] == 'POLJOB':
+                            # A job from the shared subscription is acked once
+                            # its audio went out, so if this node dies first
+                            # Pub/Sub hands it to another node.
+                            message.ack()
+                    else:
+                        message.ack()
         
         except binascii.Error:
             message.ack()  # To move forward if a message can't be processed
 
-    print('Listening for messages on {}'.format(subscription_path))  
-    subscriber.subscribe(subscription_path, callback=callback)      
+    for path, lane in lanes:
+        flow_control = pubsub_v1.types.FlowControl()
+        scheduler = None
+        if args.dispatch == routing.DIRECT or lane == routing.BULK:
+            # Lease no more jobs than this node works on at once, so the
+            # rest stay in the subscription, shared with idle nodes when
+            # dispatch is direct.
+            flow_control = pubsub_v1.types.FlowControl(max_messages=args.capacity)
+        if lane == routing.BULK:
+            scheduler = transport.scheduler(args.capacity)
+        elif lane == routing.CONTROL:
+            scheduler = transport.scheduler(args.control_workers)
+        log.info('Listening for %s messages on %s', lane or 'all', path)
+        subscriber.subscribe(path, callback=functools.partial(callback, lane=lane),
+                             flow_control=flow_control, scheduler=scheduler)
     time.sleep(3000)
     client.disconnect()
     client.loop_stop()
-    print('Finished loop successfully. Goodbye!')
+    log.info('Finished loop successfully. Goodbye!')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,147 @@
+"""Tests for the polly node."""
+
+import io
+from threading import Lock
+
+import encoding
+import localbus
+import pollyNode
+import transport
+
+
+class _RejectingService(object):
+    """A Cloud IoT admin API whose config updates hit the rate limit."""
+
+    def projects(self):
+        return self
+
+    def locations(self):
+        return self
+
+    def registries(self):
+        return self
+
+    def devices(self):
+        return self
+
+    def modifyCloudToDeviceConfig(self, name, body):
+        return self
+
+    def execute(self):
+        raise transport._http_error(localbus.BusError(429, 'Rate limit exceeded'))
+
+
+DEVICE = 'projects/project/locations/region/registries/registry/devices/dev-0'
+
+
+def _device(service=None):
+    device = pollyNode.Device.__new__(pollyNode.Device)
+    device.id = 'pol-test'
+    device._service = service or _RejectingService()
+    device._ack_service = device._service
+    device._update_config_mutex = Lock()
+    device._ack_mutex = Lock()
+    return device
+
+
+def _wait(device, version):
+    return device._wait_for_config_ack(
+        'project', 'region', 'registry', 'dev-0', version, timeout=1)
+
+
+def test_update_device_config_returns_none_on_http_error():
+    rejected = pollyNode.CONFIG_UPDATES.labels(429)
+    before = rejected.get()
+
+    device = _device()
+    config = device._update_device_config(
+        'project', 'region', 'registry', 'dev-0', '{}', delay=0)
+
+    assert config is None
+    assert rejected.get() == before + 1
+    # The mutex is released for the next update.
+    assert device._update_config_mutex.acquire(False)
+
+
+def test_wait_for_config_ack_needs_the_ack_of_its_own_version():
+    broker = localbus.LocalBroker(config_rate=float('inf'))
+    device = _device(transport.LocalCloudIot(broker))
+    chunk = int(broker.update_config(DEVICE, b'chunk 0')['version'])
+    assert _wait(device, chunk) == pollyNode.UNACKED
+
+    broker.ack_config(DEVICE, chunk)
+    assert _wait(device, chunk) == pollyNode.ACKED
+
+
+def test_wait_for_config_ack_backs_off_without_the_update_mutex(monkeypatch):
+    broker = localbus.LocalBroker(config_rate=float('inf'))
+    device = _device(transport.LocalCloudIot(broker))
+    chunk = int(broker.update_config(DEVICE, b'chunk 0')['version'])
+    now = [1000.0]
+    sleeps = list()
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(pollyNode.time, 'time', lambda: now[0])
+    monkeypatch.setattr(pollyNode.time, 'sleep', sleep)
+    # An update sleeping out its rate limit does not hold up the polls.
+    with device._update_config_mutex:
+        outcome = device._wait_for_config_ack(
+            'project', 'region', 'registry', 'dev-0', chunk, timeout=20)
+    assert outcome == pollyNode.UNACKED
+    assert sleeps == [1.0, 2.0, 4.0, 8.0, 5.0]
+
+
+def test_wait_for_config_ack_reports_a_replaced_chunk():
+    broker = localbus.LocalBroker(config_rate=float('inf'))
+    device = _device(transport.LocalCloudIot(broker))
+    chunk = int(broker.update_config(DEVICE, b'chunk 0')['version'])
+    # A bid from another node lands before the device fetched the chunk.
+    bid = int(broker.update_config(DEVICE, b'POLSYM')['version'])
+    broker.ack_config(DEVICE, bid)
+    assert _wait(device, chunk) == pollyNode.SUPERSEDED
+
+    # A chunk the device did get before it was replaced still counts.
+    broker.ack_config(DEVICE, chunk)
+    assert _wait(device, chunk) == pollyNode.ACKED
+
+
+class _Polly(object):
+    """Polly speaking `seconds` of audio at the encoding's nominal rate."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.calls = list()
+
+    def synthesize_speech(self, **kwargs):
+        self.calls.append((kwargs['OutputFormat'], kwargs.get('SampleRate')))
+        size = 0
+        for output_format, sample_rate, bytes_per_second in encoding.ENCODINGS:
+            if (output_format, sample_rate) == self.calls[-1]:
+                size = int(self.seconds * bytes_per_second)
+        return {'AudioStream': io.BytesIO(b'\0' * size)}
+
+
+def test_caption_within_budget_takes_one_polly_call(monkeypatch):
+    polly = _Polly(seconds=2)
+    monkeypatch.setattr(pollyNode, 'getPollyClient', lambda: polly)
+    data = {'img_data': 'A dog on grass.', 'device_class': 'constrained'}
+
+    sound, output_format = pollyNode.synthesizeCaption(
+        data, None, encoding.DEVICE_CLASSES)
+    assert (output_format, polly.calls) == ('mp3', [('mp3', '22050')])
+    assert len(sound) == 12000
+
+
+def test_caption_over_budget_is_synthesized_again_smaller(monkeypatch):
+    # The text suggests a second of speech, but Polly speaks for ten.
+    polly = _Polly(seconds=10)
+    monkeypatch.setattr(pollyNode, 'getPollyClient', lambda: polly)
+    data = {'img_data': 'A dog on grass.', 'device_class': 'constrained'}
+
+    sound, output_format = pollyNode.synthesizeCaption(
+        data, None, encoding.parse_budgets(['constrained=45000']))
+    assert polly.calls == [('mp3', '22050'), ('mp3', '16000')]
+    assert len(sound) == 40000
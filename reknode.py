@@ -43,10 +43,14 @@ devices and running them all at the same time.
 
 import argparse
 import datetime
+import functools
 import json
+import logging
 import os
 import ssl
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
 from threading import Lock
 
 import jwt
@@ -54,15 +58,30 @@ import paho.mqtt.client as mqtt
 import glob
 import random
 import base64
+import binascii
 import io
 import boto3
+from botocore.exceptions import NoCredentialsError
 from google.cloud import pubsub
 from google.cloud import pubsub_v1
 from google.oauth2 import service_account
 from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+
+import bidding
+import batching
+import captions
+import claimcheck
+import logutil
+import metrics
+import routing
+import tracing
+import transport
 
 
 v_count = 0
+# Set from --aws_endpoint_url; None talks to AWS itself.
+aws_endpoint_url = None
 image_dict = dict()
 send_rek_ack = list()
 send_rek = list()
@@ -72,6 +91,29 @@ API_VERSION = 'v1'
 DISCOVERY_API = 'https://cloudiot.googleapis.com/$discovery/rest'
 SERVICE_NAME = 'cloudiot'
 
+log = logging.getLogger('reknode')
+message_log = logutil.message_logger('reknode')
+
+MESSAGES = metrics.counter(
+    'messages_received_total', 'Pub/Sub messages handled, by type.', ['type'])
+BIDS = metrics.counter(
+    'bids_total', 'REK requests bid on or declined at capacity.', ['result'])
+JOBS_IN_FLIGHT = metrics.gauge(
+    'jobs_in_flight', 'Images being uploaded and labelled.')
+JOB_SECONDS = metrics.histogram(
+    'job_seconds', 'Time from a REKACK to its REKRES config update.')
+CONFIG_UPDATES = metrics.counter(
+    'config_updates_total', 'Device config updates, by HTTP status.', ['status'])
+CONFIG_UPDATES_WAITING = metrics.gauge(
+    'config_updates_waiting',
+    'Config updates sleeping out the config delay or waiting for the API.')
+CONFIG_UPDATE_SECONDS = metrics.histogram(
+    'config_update_seconds', 'Latency of the ModifyCloudToDeviceConfig call.')
+AWS_SECONDS = metrics.histogram(
+    'aws_request_seconds', 'Latency of AWS calls.', ['operation'])
+PUBLISHED = metrics.counter(
+    'messages_published_total', 'Chained jobs published, by type.', ['type'])
+
 def create_jwt(project_id, private_key_file, algorithm):
     """Create a JWT (https://jwt.io) to establish an MQTT connection."""
     token = {
@@ -81,8 +123,8 @@ def create_jwt(project_id, private_key_file, algorithm):
     }
     with open(private_key_file, 'r') as f:
         private_key = f.read()
-    print('Creating JWT using {} from private key file {}'.format(
-        algorithm, private_key_file))
+    log.info('Creating JWT using %s from private key file %s',
+             algorithm, private_key_file)
     return jwt.encode(token, private_key, algorithm=algorithm)
 
 
@@ -94,25 +136,30 @@ def error_str(rc):
 class Device(object):
     """Represents the state of a single device."""
 
-    def __init__(self, dev_id, service_account_json):
+    def __init__(self, dev_id, service_account_json, config_delay=20):
         self.temperature = 0
         self.fan_on = False
         self.connected = False
         self.id = dev_id
-        credentials = service_account.Credentials.from_service_account_file(
-            service_account_json).with_scopes(API_SCOPES)
-        if not credentials:
-            sys.exit('Could not load service account credential '
-                     'from {}'.format(service_account_json))
+        self.config_delay = config_delay
+        if transport.is_local():
+            # The local broker stands in for the Cloud IoT admin API.
+            self._service = transport.cloudiot_service()
+        else:
+            credentials = service_account.Credentials.from_service_account_file(
+                service_account_json).with_scopes(API_SCOPES)
+            if not credentials:
+                sys.exit('Could not load service account credential '
+                         'from {}'.format(service_account_json))
 
-        discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
+            discovery_url = '{}?version={}'.format(DISCOVERY_API, API_VERSION)
 
-        self._service = discovery.build(
-            SERVICE_NAME,
-            API_VERSION,
-            discoveryServiceUrl=discovery_url,
-            credentials=credentials,
-            cache_discovery=False)
+            self._service = discovery.build(
+                SERVICE_NAME,
+                API_VERSION,
+                discoveryServiceUrl=discovery_url,
+                credentials=credentials,
+                cache_discovery=False)
 
         # Used to serialize the calls to the
         # modifyCloudToDeviceConfig REST method. This is needed
@@ -137,21 +184,27 @@ class Device(object):
                            device_id))
         request = self._service.projects().locations().registries().devices(
         ).modifyCloudToDeviceConfig(name=device_name, body=body)
-        time.sleep(20)
+        CONFIG_UPDATES_WAITING.inc()
+        time.sleep(self.config_delay)
         # The http call for the device config change is thread-locked so
         # that there aren't competing threads simultaneously using the
         # httplib2 library, which is not thread-safe.
         self._update_config_mutex.acquire()
         try:
-            request.execute()
-            time.sleep(5)
+            with CONFIG_UPDATE_SECONDS.time(), tracing.span(
+                    'ModifyCloudToDeviceConfig', kind=tracing.CLIENT, device=device_id):
+                request.execute()
+            CONFIG_UPDATES.labels(200).inc()
+            time.sleep(self.config_delay / 4.0)
         except HttpError as e:
             # If the server responds with a HtppError, log it here, but
             # continue so that the message does not stay NACK'ed on the
             # pubsub channel.
-            print('Error executing ModifyCloudToDeviceConfig: {}'.format(e))
+            CONFIG_UPDATES.labels(e.resp.status).inc()
+            log.warning('Error executing ModifyCloudToDeviceConfig: %s', e)
         finally:
             self._update_config_mutex.release()
+            CONFIG_UPDATES_WAITING.dec()
 
     def get_id(self):
         return self.id
@@ -178,29 +231,29 @@ class Device(object):
 
     def on_connect(self, unused_client, unused_userdata, unused_flags, rc):
         """Callback for when a device connects."""
-        print('Connection Result:', error_str(rc))
+        log.info('Connection Result: %s', error_str(rc))
         self.connected = True
 
     def on_disconnect(self, unused_client, unused_userdata, rc):
         """Callback for when a device disconnects."""
-        print('Disconnected:', error_str(rc))
+        log.warning('Disconnected: %s', error_str(rc))
         self.connected = False
 
     def on_publish(self, unused_client, unused_userdata, unused_mid):
         """Callback when the device receives a PUBACK from the MQTT bridge."""
-        print('Published message acked.')
+        message_log.debug('Published message acked.')
 
     def on_subscribe(self, unused_client, unused_userdata, unused_mid, granted_qos):
         """Callback when the device receives a SUBACK from the MQTT bridge."""
-        print('Subscribed: ', granted_qos)
+        log.info('Subscribed: %s', granted_qos)
         if granted_qos[0] == 128:
-            print('Subscription failed.')
+            log.error('Subscription failed.')
 
     def on_message(self, unused_client, unused_userdata, message):
         """Callback when the device receives a message on a subscription."""
         payload = message.payload.decode('utf-8')
-        print('Received message \'{}\' on topic \'{}\' with Qos {}'.format(
-            payload, message.topic, str(message.qos)))
+        message_log.debug('Received message \'%s\' on topic \'%s\' with Qos %s',
+                          logutil.truncate(payload), message.topic, message.qos)
 
         # The device will receive its latest config when it subscribes to the
         # config topic. If there is no configuration for the device, the device
@@ -265,12 +318,63 @@ def parse_command_line_args():
         '--pubsub_subscription',
         required=True,
         help='Google Cloud Pub/Sub subscription name.')
+    parser.add_argument(
+        '--capacity',
+        type=int,
+        default=4,
+        help='Jobs this node works on at once before it declines new requests.')
+    parser.add_argument(
+        '--dispatch',
+        choices=routing.DISPATCH_MODES,
+        default=routing.BID,
+        help=('bid answers REK requests with bids; direct takes REKJOB jobs '
+              'from --pubsub_subscription, shared by all rekognition nodes.'))
+    parser.add_argument(
+        '--bulk_subscription',
+        default=None,
+        help=('With bid dispatch, take the REKACK jobs from this subscription '
+              'and only the REK requests from --pubsub_subscription, each '
+              'with its own workers, so bids are not queued behind jobs.'))
+    parser.add_argument(
+        '--control_workers',
+        type=int,
+        default=transport.CALLBACK_THREADS,
+        help='Threads handling REK requests when --bulk_subscription is set.')
+    parser.add_argument(
+        '--pubsub_topic',
+        default=None,
+        help=('Central Pub/Sub topic name. When given, the subscription is '
+              'created with a filter that only delivers this node\'s traffic.'))
 
     parser.add_argument(
         '--service_account_json',
         required=True,
         help='Path to service account json file.')
 
+    parser.add_argument(
+        '--transport',
+        choices=transport.TRANSPORTS,
+        default=transport.GOOGLE,
+        help=('google talks to Cloud IoT Core and Pub/Sub; local talks to the '
+              'broker started with localbus.py.'))
+    parser.add_argument(
+        '--local_broker',
+        default='localhost:50000',
+        help='host:port of the local broker for --transport=local.')
+    logutil.add_arguments(parser)
+    metrics.add_arguments(parser)
+    tracing.add_arguments(parser)
+    parser.add_argument(
+        '--aws_endpoint_url',
+        default=None,
+        help=('Send the S3 and Rekognition calls to this endpoint instead of '
+              'AWS, e.g. the fake services of benchmarks/fakeaws.py.'))
+    parser.add_argument(
+        '--config_delay',
+        type=float,
+        default=20,
+        help=('Seconds to wait before each device config update; a quarter '
+              'of it is waited after the update.'))
     return parser.parse_args()
 #Added code to encode image
 
@@ -286,24 +390,28 @@ def getJSONForEncodedImage(image_path):
     return imgStr
 
 def upload_to_aws(local_file, bucket, s3_file):
-    s3 = boto3.client('s3',region_name='us-east-1')
+    s3 = boto3.client('s3',region_name='us-east-1', endpoint_url=aws_endpoint_url)
     try:
-        s3.upload_file(local_file, bucket, s3_file)
-        print("Upload Successful")
+        with AWS_SECONDS.labels('s3_upload').time(), tracing.span(
+                'S3 upload', kind=tracing.CLIENT, bucket=bucket):
+            s3.upload_file(local_file, bucket, s3_file)
+        message_log.debug("Uploaded %s to %s", s3_file, bucket)
         return True
     except FileNotFoundError:
-        print("The file was not found")
+        log.error("The file %s was not found", local_file)
         return False
     except NoCredentialsError:
-        print("Credentials not available")
+        log.error("AWS credentials not available")
         return False
 
 def detect_labels(photo, bucket):
 
-    client=boto3.client('rekognition', region_name='us-east-1')
+    client=boto3.client('rekognition', region_name='us-east-1', endpoint_url=aws_endpoint_url)
 
-    response = client.detect_labels(Image={'S3Object':{'Bucket':bucket,'Name':photo}},
-        MaxLabels=10)
+    with AWS_SECONDS.labels('detect_labels').time(), tracing.span(
+            'DetectLabels', kind=tracing.CLIENT):
+        response = client.detect_labels(Image={'S3Object':{'Bucket':bucket,'Name':photo}},
+            MaxLabels=10)
     labels = list()
     for label in response['Labels']:
         labels.append(label['Name'])
@@ -312,31 +420,69 @@ def detect_labels(photo, bucket):
 
 def main():
     args = parse_command_line_args()
-
-    subscriber = pubsub.SubscriberClient()
+    transport.configure(args.transport, args.local_broker)
+    logutil.configure(args.device_id, args.log_level, args.log_format,
+                      args.log_sample_rate, args.log_payload_chars)
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    tracing.configure(args.device_id, args.span_file)
+    global aws_endpoint_url
+    aws_endpoint_url = args.aws_endpoint_url
+    fetcher = claimcheck.Fetcher(aws_endpoint_url)
+
+    subscriber = transport.subscriber_client()
     subscription_path = subscriber.subscription_path(
                               args.project_id,
                               args.pubsub_subscription)
-
-    publisher = pubsub_v1.PublisherClient()
+    # Each lane is a subscription with its own flow control and workers;
+    # without --bulk_subscription one subscription carries both.
+    lanes = [(subscription_path, None)]
+    if args.bulk_subscription and args.dispatch == routing.BID:
+        lanes = [
+            (subscription_path, routing.CONTROL),
+            (subscriber.subscription_path(args.project_id, args.bulk_subscription),
+             routing.BULK),
+        ]
+    elif args.bulk_subscription:
+        log.warning('Ignoring --bulk_subscription, direct dispatch takes every job from %s', subscription_path)
+
+    publisher = transport.publisher_client()
+    topic_path = None
+    if args.pubsub_topic:
+        topic_path = publisher.topic_path(args.project_id, args.pubsub_topic)
+        for path, lane in lanes:
+            routing.ensure_subscription(
+                subscriber,
+                path,
+                topic_path,
+                'rek',
+                args.device_id,
+                args.dispatch,
+                lane)
+    else:
+        log.warning('Without --pubsub_topic images cannot be chained to the '
+                    'polly nodes; devices started with --chain get the labels instead')
     global count
     count = 0
+    load = bidding.LoadTracker(args.capacity)
+    JOBS_IN_FLIGHT.set_function(lambda: load.in_flight)
     # Create the MQTT client and connect to Cloud IoT.
-    client = mqtt.Client(
+    client = transport.mqtt_client(
         client_id='projects/{}/locations/{}/registries/{}/devices/{}'.format(
             args.project_id,
             args.cloud_region,
             args.registry_id,
             args.device_id))
-    client.username_pw_set(
-        username='unused',
-        password=create_jwt(
-            args.project_id,
-            args.private_key_file,
-            args.algorithm))
-    client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
-
-    device = Device(args.device_id, args.service_account_json)
+    if not transport.is_local():
+        client.username_pw_set(
+            username='unused',
+            password=create_jwt(
+                args.project_id,
+                args.private_key_file,
+                args.algorithm))
+        client.tls_set(ca_certs=args.ca_certs, tls_version=ssl.PROTOCOL_TLSv1_2)
+
+    device = Device(args.device_id, args.service_account_json, args.config_delay)
     os.system("rm -rf receieved_images" + device.get_id())
     os.system("mkdir receieved_images" + device.get_id())
 
@@ -355,8 +501,66 @@ def main():
 
     # Wait up to 5 seconds for the device to connect.
     device.wait_for_connection(5)
-    
-    def callback(message):
+
+    def publish_polly_job(data, labels):
+        """Send the caption straight to the polly nodes for the device."""
+        img = data['img_name']
+        payload_json = {'type': 'POLJOB', 'img_name': img, 'dev_id': data['dev_id'],
+                        'img_data': captions.build_caption(img, labels),
+                        'segments': captions.caption_segments(img, labels),
+                        'device_class': data.get('device_class', 'standard')}
+        message_log.info("Publishing polly job for device %s for image %s", data['dev_id'], img)
+        with tracing.span('publish POLJOB', kind=tracing.PRODUCER):
+            tracing.inject(payload_json)
+            publisher.publish(
+                topic_path, json.dumps(payload_json).encode('utf-8'),
+                **routing.message_attributes('POLJOB', data['dev_id'])).result()
+        PUBLISHED.labels('POLJOB').inc()
+
+    count_mutex = Lock()
+
+    def recognize(data, parent=None):
+        """Label the image of one job and return its entry of the REKRES."""
+        global count
+        with count_mutex:
+            count = count + 1
+            number = count
+        with tracing.span('recognize', parent=parent, image=data['img_name']):
+            bucket_name = 'project2-buck'
+            image_name = device.get_id() + 'image' + str(number) + '.jpg'
+            location = claimcheck.s3_location(data.get('img_ref'))
+            if location is not None:
+                # Rekognition reads the claim-check object where the device
+                # put it.
+                bucket_name, image_name = location
+                is_uploaded = True
+            else:
+                image_path = "receieved_images" + device.get_id() + "/receieved_image" + str(number) + ".jpeg"
+                try:
+                    image_data = fetcher.load(data)
+                    with io.open(image_path, 'wb') as f:
+                        f.write(image_data)
+                    is_uploaded = upload_to_aws(image_path, bucket_name, image_name)
+                except claimcheck.ClaimCheckError as e:
+                    log.error("Cannot fetch image %s of device %s: %s", data['img_name'], data['dev_id'], e)
+                    is_uploaded = False
+            labels = list()
+            if is_uploaded == True:
+                #Call rekognition
+                labels = detect_labels(image_name,bucket_name)
+            # In a chain the caption goes on to the polly nodes from here.
+            chained = bool(data.get('chain')) and is_uploaded and topic_path is not None
+            result = {'img_name': data['img_name'], 'is_success': is_uploaded,
+                      'labels': labels, 'chained': chained}
+            if chained:
+                publish_polly_job(data, labels)
+            elif data.get('chain') and is_uploaded:
+                # The device falls back to asking the polly nodes itself.
+                log.warning("Cannot chain image %s to the polly nodes without --pubsub_topic", data['img_name'])
+                result['unchained'] = 'rekognition node has no --pubsub_topic'
+        return result
+
+    def callback(message, lane=None):
         """Logic executed when a message is received from
         subscribed topic.
         """
@@ -369,89 +573,138 @@ def main():
             message.ack()
             return
         '''
-        global count
+        # Traffic for other roles or other nodes is dropped on its attributes
+        # alone, without decoding the (possibly multi-megabyte) body.
+        if not routing.accepts(message.attributes, 'rek', device.get_id(), lane):
+            MESSAGES.labels('other').inc()
+            message.ack()
+            return
         try:
             try:
                 data = json.loads(message.data.decode('utf-8'))
             except ValueError as e:
-                print('Loading Payload ({}) threw an Exception: {}.'.format(
-                    message.data, e))
+                MESSAGES.labels('invalid').inc()
+                log.warning('Loading Payload (%s) threw an Exception: %s.',
+                            logutil.truncate(message.data), e)
                 message.ack()
                 return
-            if data['type'] == 'REK':
-                dev_id = data['dev_id']
-                img = data['img_name']
-                print("Recieved initial request from device " + dev_id + "for image " + img + "\n\n\n")
-                message.ack()
-                mqtt_config_topic = '/devices/{}/config/'.format(dev_id)
-                payload_json = {'type' : 'REKSYM', 'img_name':img, 'node_id': device.get_id()}
-                payload = json.dumps(payload_json)
-                device_project_id = args.project_id
-                device_registry_id = args.registry_id
-                device_id = dev_id
-                device_region = args.cloud_region
-                print("Sending acknowledgement to device " + dev_id + "for image " + img + "\n\n\n")
-                # Send the config to the device.
-                device._update_device_config(
-                  device_project_id,
-                  device_region,
-                  device_registry_id,
-                  device_id,
-                  payload)
-                # print("10.....................")
-                time.sleep(1)
-                
-            elif data['type'] == 'REKACK':
-                if(data['node_id'] == device.get_id()):
-                    image_data = base64.b64decode(data['img_data'])
-                    print("Recieved acknowledgement from device " + data['dev_id'] + "for image " + data['img_name'] + "\n\n\n")
-                    message.ack()
-                    count = count + 1
-                    # dateTimeObj = datetime.now()
-                    # dateStr = dateTimeObj.strftime("%b%d%Y%H:%M:%S.%f")
-                    with io.open("receieved_images" + device.get_id() + "/receieved_image" + str(count) + ".jpeg", 'wb') as f:
-                        f.write(image_data)
-                        bucket_name = 'project2-buck'
-                        image_name = device.get_id() + 'image' + str(count) + '.jpg'
-                        is_uploaded = upload_to_aws("receieved_images" + device.get_id() + "/receieved_image" + str(count) + ".jpeg",bucket_name, image_name)
-                        num_labels = 0
-                        labels = list()
-                        if is_uploaded == True:
-                            #Call rekognition
-                            labels = detect_labels(image_name,bucket_name)
-                        payload_json = {'type': 'REKRES', 'img_name':data['img_name'], 'is_success':is_uploaded, 'labels': labels, 'node_id': device.get_id()}
-                        payload = json.dumps(payload_json)
-                        device_project_id = args.project_id
-                        device_registry_id = args.registry_id
-                        device_id = data['dev_id']
-                        device_region = args.cloud_region
-                        print("Publishing rekognition results to device " + data['dev_id'] + " for image " + data['img_name'])
-                        print("The labels in image are : ")
-                        for l in labels:
-                            print(l)
-                        print("\n\n\n\n")
-                        # Send the config to the device.
-                        device._update_device_config(
-                          device_project_id,
-                          device_region,
-                          device_registry_id,
-                          device_id,
-                          payload)
-                        time.sleep(1)
-                        # Signal to the main thread that we can exit.
-                        #job_done.set()
-                else:
+            MESSAGES.labels(data['type']).inc()
+            with tracing.span('handle ' + data['type'], parent=tracing.extract(data),
+                              kind=tracing.CONSUMER, image=data.get('img_name')):
+                if data['type'] in ('REK', 'REKBATCH'):
+                    dev_id = data['dev_id']
+                    img = data['img_name']
+                    message_log.info("Received initial request from device %s for image %s", dev_id, img)
                     message.ack()
+                    # A batch is bid on as a whole, with a credit per image.
+                    bid = load.bid((dev_id, img), len(data.get('img_names', [img])))
+                    if bid is None:
+                        BIDS.labels('declined').inc()
+                        message_log.info("Declining request from device %s for image %s, node is at capacity", dev_id, img)
+                        return
+                    BIDS.labels('bid').inc()
+                    mqtt_config_topic = '/devices/{}/config/'.format(dev_id)
+                    payload_json = {'type' : 'REKSYM', 'img_name':img, 'node_id': device.get_id()}
+                    if 'batch_id' in data:
+                        payload_json['batch_id'] = data['batch_id']
+                    payload_json.update(bid)
+                    tracing.inject(payload_json)
+                    payload = json.dumps(payload_json)
+                    device_project_id = args.project_id
+                    device_registry_id = args.registry_id
+                    device_id = dev_id
+                    device_region = args.cloud_region
+                    message_log.info("Sending acknowledgement to device %s for image %s", dev_id, img)
+                    # Send the config to the device.
+                    device._update_device_config(
+                      device_project_id,
+                      device_region,
+                      device_registry_id,
+                      device_id,
+                      payload)
+                    # print("10.....................")
+                    time.sleep(1)
+                
+                elif data['type'] in ('REKACK', 'REKJOB'):
+                    if data['type'] == 'REKJOB' or data['node_id'] == device.get_id():
+                        message_log.info("Received %s from device %s for image %s", data['type'], data['dev_id'], data['img_name'])
+                        if data['type'] == 'REKACK':
+                            message.ack()
+                        jobs = batching.expand(data, 'items')
+                        # dateTimeObj = datetime.now()
+                        # dateStr = dateTimeObj.strftime("%b%d%Y%H:%M:%S.%f")
+                        started = [load.start((job['dev_id'], job.get('batch_id', job['img_name'])))
+                                   for job in jobs]
+                        try:
+                            if len(jobs) == 1:
+                                results = [recognize(jobs[0])]
+                            else:
+                                # The images of a batch are labelled in
+                                # parallel and answered in one REKRES.
+                                parent = tracing.current()
+                                with ThreadPoolExecutor(max_workers=min(len(jobs), args.capacity)) as executor:
+                                    results = list(executor.map(
+                                        lambda job: recognize(job, parent), jobs))
+                            # In a chain the device only hears of the labels
+                            # if it asked for them.
+                            if not all(result['chained'] for result in results) or data.get('send_labels'):
+                                payload_json = {'type': 'REKRES', 'img_name':data['img_name'], 'node_id': device.get_id()}
+                                if 'items' in data:
+                                    payload_json.update({'batch_id': data['batch_id'], 'results': results})
+                                else:
+                                    payload_json.update(results[0])
+                                payload_json['credits'] = load.credits
+                                tracing.inject(payload_json)
+                                payload = json.dumps(payload_json)
+                                device_project_id = args.project_id
+                                device_registry_id = args.registry_id
+                                device_id = data['dev_id']
+                                device_region = args.cloud_region
+                                message_log.info("Publishing rekognition results to device %s for image %s, labels: %s", data['dev_id'], data['img_name'], [result['labels'] for result in results])
+                                # Send the config to the device.
+                                device._update_device_config(
+                                  device_project_id,
+                                  device_region,
+                                  device_registry_id,
+                                  device_id,
+                                  payload)
+                                time.sleep(1)
+                            # Signal to the main thread that we can exit.
+                            #job_done.set()
+                        finally:
+                            for job_started in started:
+                                load.finish(job_started)
+                                JOB_SECONDS.observe(time.time() - job_started)
+                        if data['type'] == 'REKJOB':
+                            # A job from the shared subscription is acked once
+                            # its result went out, so if this node dies first
+                            # Pub/Sub hands it to another node.
+                            message.ack()
+                    else:
+                        message.ack()
         
         except binascii.Error:
             message.ack()  # To move forward if a message can't be processed
 
-    print('Listening for messages on {}'.format(subscription_path))  
-    subscriber.subscribe(subscription_path, callback=callback)      
+    for path, lane in lanes:
+        flow_control = pubsub_v1.types.FlowControl()
+        scheduler = None
+        if args.dispatch == routing.DIRECT or lane == routing.BULK:
+            # Lease no more jobs than this node works on at once, so the
+            # rest stay in the subscription, shared with idle nodes when
+            # dispatch is direct.
+            flow_control = pubsub_v1.types.FlowControl(max_messages=args.capacity)
+        if lane == routing.BULK:
+            scheduler = transport.scheduler(args.capacity)
+        elif lane == routing.CONTROL:
+            scheduler = transport.scheduler(args.control_workers)
+        log.info('Listening for %s messages on %s', lane or 'all', path)
+        subscriber.subscribe(path, callback=functools.partial(callback, lane=lane),
+                             flow_control=flow_control, scheduler=scheduler)
     time.sleep(3000)
     client.disconnect()
     client.loop_stop()
-    print('Finished loop successfully. Goodbye!')
+    log.info('Finished loop successfully. Goodbye!')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,125 @@
+"""Attribute-based routing for messages on the central Pub/Sub topic.
+
+Every message published on the central topic carries its type and, when it
+is addressed to a single node, the target node id as Pub/Sub message
+attributes. Nodes use the attributes twice: in a subscription filter, so the
+service never delivers traffic meant for another role, and in a pre-check at
+the top of the subscriber callback, so a message for another node is acked
+without its body ever being decoded.
+
+Work reaches the nodes in one of two dispatch modes. With BID dispatch
+every node of a role has its own subscription: a request (REK, POL) is
+broadcast, each node bids by pushing a config to the device, and the device
+sends the job (REKACK, POLACK) to the node it picked. With DIRECT dispatch
+the device publishes the whole job (REKJOB, POLJOB) once and all nodes of a
+role pull from one shared subscription, so Pub/Sub hands each job to a
+single node without the bid round trips.
+
+With BID dispatch a node may also split its traffic into two lanes, each
+with its own subscription, flow control and worker pool: the CONTROL lane
+carries the requests it bids on, and the BULK lane the jobs, which carry
+the payloads and hold a worker until the work is done. A burst of jobs then
+queues on the bulk lane while bids keep going out.
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Message types each role consumes from the central topic.
+ROLE_TYPES = {
+    'rek': ('REK', 'REKBATCH', 'REKACK'),
+    'pol': ('POL', 'POLBATCH', 'POLACK'),
+    'dapp': ('AUTH',),
+}
+
+# The job message of each role with DIRECT dispatch.
+JOB_TYPES = {
+    'rek': 'REKJOB',
+    'pol': 'POLJOB',
+}
+
+BID = 'bid'
+DIRECT = 'direct'
+DISPATCH_MODES = (BID, DIRECT)
+
+CONTROL = 'control'
+BULK = 'bulk'
+
+# Message types of each lane.
+LANE_TYPES = {
+    CONTROL: ('REK', 'REKBATCH', 'POL', 'POLBATCH', 'AUTH'),
+    BULK: ('REKACK', 'POLACK', 'REKJOB', 'POLJOB'),
+}
+
+# Message types addressed to a single node rather than broadcast. AUTH is
+# addressed to the DApp replica that owns the device on the hash ring.
+TARGETED_TYPES = ('REKACK', 'POLACK', 'AUTH')
+
+
+def message_attributes(msg_type, dev_id, node_id=None):
+    """Return the Pub/Sub attributes for a message sent by a device."""
+    attributes = {'type': msg_type, 'dev_id': dev_id}
+    if node_id is not None:
+        attributes['node_id'] = node_id
+    return attributes
+
+
+def subscription_filter(role, node_id, dispatch=BID, lane=None):
+    """Return the Pub/Sub filter expression for a node of the given role.
+
+    With DIRECT dispatch the subscription is shared by all nodes of the
+    role and only delivers its jobs. With a `lane` it only delivers the
+    message types of that lane.
+    """
+    if dispatch == DIRECT:
+        return 'attributes.type = "{}"'.format(JOB_TYPES[role])
+    clauses = list()
+    for msg_type in ROLE_TYPES[role]:
+        if lane is not None and msg_type not in LANE_TYPES[lane]:
+            continue
+        if msg_type in TARGETED_TYPES:
+            clauses.append(
+                '(attributes.type = "{}" AND attributes.node_id = "{}")'.format(
+                    msg_type, node_id))
+        else:
+            clauses.append('attributes.type = "{}"'.format(msg_type))
+    return ' OR '.join(clauses)
+
+
+def accepts(attributes, role, node_id, lane=None):
+    """Check the attributes of a received message before decoding it.
+
+    Messages published without routing attributes are accepted, so that
+    devices which predate attribute routing still reach the JSON dispatch;
+    with lanes they are handled on the control lane only.
+    """
+    msg_type = attributes.get('type')
+    if msg_type is None:
+        return lane != BULK
+    if msg_type not in ROLE_TYPES[role] and msg_type != JOB_TYPES.get(role):
+        return False
+    if lane is not None and msg_type not in LANE_TYPES[lane]:
+        return False
+    if msg_type in TARGETED_TYPES:
+        return attributes.get('node_id') == node_id
+    return True
+
+
+def ensure_subscription(subscriber, subscription_path, topic_path, role,
+                        node_id, dispatch=BID, lane=None):
+    """Create the filtered subscription for a node unless it already exists.
+
+    Pub/Sub filters are fixed when a subscription is created, so an existing
+    subscription is left untouched.
+    """
+    from google.api_core import exceptions
+
+    message_filter = subscription_filter(role, node_id, dispatch, lane)
+    try:
+        subscriber.create_subscription(
+            subscription_path, topic_path, filter_=message_filter)
+        log.info('Created subscription %s with filter %s',
+                 subscription_path, message_filter)
+    except exceptions.AlreadyExists:
+        log.info('Using existing subscription %s', subscription_path)
@@ -0,0 +1,37 @@
+"""Tests for the attribute routing of the central topic."""
+
+import routing
+
+
+def test_bid_filter_targets_jobs_at_the_node():
+    assert routing.subscription_filter('pol', 'pol-0') == (
+        'attributes.type = "POL" OR attributes.type = "POLBATCH" OR '
+        '(attributes.type = "POLACK" AND attributes.node_id = "pol-0")')
+
+
+def test_direct_filter_only_delivers_jobs():
+    assert routing.subscription_filter('rek', 'rek-0', routing.DIRECT) == (
+        'attributes.type = "REKJOB"')
+
+
+def test_lane_filters_split_requests_and_jobs():
+    assert routing.subscription_filter('rek', 'rek-0', lane=routing.CONTROL) == (
+        'attributes.type = "REK" OR attributes.type = "REKBATCH"')
+    assert routing.subscription_filter('rek', 'rek-0', lane=routing.BULK) == (
+        '(attributes.type = "REKACK" AND attributes.node_id = "rek-0")')
+
+
+def test_accepts_matches_the_filters():
+    ack = routing.message_attributes('REKACK', 'dev-0', 'rek-0')
+    assert routing.accepts(ack, 'rek', 'rek-0')
+    assert not routing.accepts(ack, 'rek', 'rek-1')
+    assert not routing.accepts(ack, 'pol', 'rek-0')
+    assert not routing.accepts(ack, 'rek', 'rek-0', routing.CONTROL)
+    assert routing.accepts(ack, 'rek', 'rek-0', routing.BULK)
+    assert routing.accepts(routing.message_attributes('REKJOB', 'dev-0'), 'rek', 'rek-0')
+
+
+def test_messages_without_attributes_go_to_the_control_lane():
+    assert routing.accepts({}, 'rek', 'rek-0')
+    assert routing.accepts({}, 'rek', 'rek-0', routing.CONTROL)
+    assert not routing.accepts({}, 'rek', 'rek-0', routing.BULK)
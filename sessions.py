@@ -0,0 +1,49 @@
+"""Session tokens the DApp server issues after a verified payment.
+
+A token is an HS256 JWT naming the device and the paying address, signed
+with a secret known only to the DApp server. A device that presents a
+valid, unexpired token is authorized by checking the signature locally,
+without another payment transaction.
+"""
+
+import io
+import os
+import time
+
+import jwt
+
+ALGORITHM = 'HS256'
+
+
+def issue_token(secret, dev_id, addr, ttl):
+    """Return a token authorizing `dev_id` for `ttl` seconds."""
+    now = int(time.time())
+    claims = {'sub': dev_id, 'addr': addr, 'iat': now, 'exp': now + ttl}
+    token = jwt.encode(claims, secret, algorithm=ALGORITHM)
+    if isinstance(token, bytes):
+        token = token.decode('ascii')
+    return token
+
+
+def verify_token(secret, token, dev_id):
+    """Return the claims of `token` if it is valid for `dev_id`, else None."""
+    try:
+        claims = jwt.decode(token, secret, algorithms=[ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    if claims.get('sub') != dev_id:
+        return None
+    return claims
+
+
+def load_token(path):
+    """Return the token cached at `path`, or None."""
+    if not os.path.isfile(path):
+        return None
+    with io.open(path, 'r') as f:
+        return f.read().strip() or None
+
+
+def save_token(path, token):
+    with io.open(path, 'w') as f:
+        f.write(token)
@@ -0,0 +1,46 @@
+"""Tests for the DApp session tokens."""
+
+import time
+
+import sessions
+
+SECRET = 'shared-secret'
+ADDRESS = '0x00000000000000000000000000000000000000aa'
+
+
+def test_issued_token_verifies_for_its_device():
+    token = sessions.issue_token(SECRET, 'dev1', ADDRESS, 3600)
+    claims = sessions.verify_token(SECRET, token, 'dev1')
+    assert claims['sub'] == 'dev1'
+    assert claims['addr'] == ADDRESS
+    assert claims['exp'] == claims['iat'] + 3600
+
+
+def test_expired_token_is_rejected(monkeypatch):
+    issued = time.time() - 7200
+    monkeypatch.setattr(sessions.time, 'time', lambda: issued)
+    token = sessions.issue_token(SECRET, 'dev1', ADDRESS, 3600)
+    monkeypatch.undo()
+    assert sessions.verify_token(SECRET, token, 'dev1') is None
+
+
+def test_token_of_another_device_is_rejected():
+    token = sessions.issue_token(SECRET, 'dev1', ADDRESS, 3600)
+    assert sessions.verify_token(SECRET, token, 'dev2') is None
+
+
+def test_token_signed_with_another_secret_is_rejected():
+    token = sessions.issue_token('other-secret', 'dev1', ADDRESS, 3600)
+    assert sessions.verify_token(SECRET, token, 'dev1') is None
+    assert sessions.verify_token(SECRET, 'not a token', 'dev1') is None
+
+
+def test_saved_token_loads_back(tmp_path):
+    path = str(tmp_path / 'session_token')
+    assert sessions.load_token(path) is None
+    token = sessions.issue_token(SECRET, 'dev1', ADDRESS, 3600)
+    sessions.save_token(path, token)
+    assert sessions.load_token(path) == token
+
+    sessions.save_token(path, '')
+    assert sessions.load_token(path) is None
@@ -0,0 +1,59 @@
+"""Consistent hashing of devices onto DApp server replicas.
+
+Every replica and every device id is hashed onto the same ring; a device is
+served by the first replica at or after its own position. Each replica owns
+many virtual points, so devices spread evenly, and adding or removing a
+replica only moves the devices next to its points. Devices compute the ring
+themselves from the list of replica ids, so no coordinator is needed.
+"""
+
+import bisect
+import hashlib
+
+VIRTUAL_NODES = 100
+
+
+def _position(key):
+    digest = hashlib.md5(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def parse_replicas(value):
+    """Split a comma separated list of replica ids."""
+    return [replica.strip() for replica in value.split(',') if replica.strip()]
+
+
+class HashRing(object):
+    """Maps keys to nodes so that membership changes move few keys."""
+
+    def __init__(self, nodes, virtual_nodes=VIRTUAL_NODES):
+        if not nodes:
+            raise ValueError('A hash ring needs at least one node')
+        self.nodes = sorted(set(nodes))
+        points = list()
+        for node in self.nodes:
+            for i in range(virtual_nodes):
+                points.append((_position('{}#{}'.format(node, i)), node))
+        points.sort()
+        self._positions = [position for position, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key):
+        """Return the node that owns `key`."""
+        return self.preference(key)[0]
+
+    def preference(self, key):
+        """Return every node in the order `key` should try them.
+
+        The first node owns the key; the others are the fallbacks that would
+        own it if the nodes before them were removed.
+        """
+        start = bisect.bisect(self._positions, _position(key))
+        order = list()
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in order:
+                order.append(node)
+                if len(order) == len(self.nodes):
+                    break
+        return order
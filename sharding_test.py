@@ -0,0 +1,38 @@
+"""Tests for the DApp replica hash ring."""
+
+import pytest
+
+import sharding
+
+
+def test_preference_lists_every_replica_once():
+    ring = sharding.HashRing(['dapp-0', 'dapp-1', 'dapp-2'])
+    order = ring.preference('dev-7')
+    assert sorted(order) == ['dapp-0', 'dapp-1', 'dapp-2']
+    assert ring.node_for('dev-7') == order[0]
+
+
+def test_removing_a_replica_only_moves_its_devices():
+    devices = ['dev-{}'.format(i) for i in range(200)]
+    ring = sharding.HashRing(['dapp-0', 'dapp-1', 'dapp-2'])
+    smaller = sharding.HashRing(['dapp-0', 'dapp-2'])
+    for device in devices:
+        order = ring.preference(device)
+        if order[0] != 'dapp-1':
+            assert smaller.node_for(device) == order[0]
+        else:
+            # The fallback takes over.
+            assert smaller.node_for(device) == order[1]
+
+
+def test_devices_spread_over_the_replicas():
+    ring = sharding.HashRing(['dapp-0', 'dapp-1', 'dapp-2'])
+    owners = [ring.node_for('dev-{}'.format(i)) for i in range(300)]
+    for replica in ring.nodes:
+        assert owners.count(replica) > 50
+
+
+def test_parse_replicas_and_empty_ring():
+    assert sharding.parse_replicas(' dapp-0, ,dapp-1') == ['dapp-0', 'dapp-1']
+    with pytest.raises(ValueError):
+        sharding.HashRing([])
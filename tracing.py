@@ -0,0 +1,277 @@
+"""Trace context carried through the captioning messages, and spans.
+
+Every payload of an image's workflow (REK through POLRES) and of an auth
+request carries a W3C `traceparent` field, 00-<trace id>-<span id>-01, so
+the spans each process records for that image share one trace id:
+
+  with tracing.span('handle REKACK', parent=tracing.extract(data)):
+      with tracing.span('detect_labels', kind=tracing.CLIENT):
+          ...
+      tracing.inject(payload_json)
+
+span() uses the innermost open span of the thread as the parent unless one
+is given, and inject() writes that span's context into an outgoing payload.
+
+Spans are written to --span_file as Zipkin v2 JSON, one span per line, and
+several processes may append to the same file. Ids are always generated,
+so the context keeps flowing through a process that writes no spans.
+
+  $ python tracing.py spans.jsonl --slowest=3
+  $ python tracing.py spans.jsonl --zipkin=spans.json
+
+prints the span trees of the three slowest traces, or writes the spans as
+one JSON array to upload to Zipkin (POST /api/v2/spans) or open in Jaeger.
+"""
+
+import argparse
+import io
+import json
+import random
+import threading
+import time
+
+CLIENT = 'CLIENT'
+SERVER = 'SERVER'
+PRODUCER = 'PRODUCER'
+CONSUMER = 'CONSUMER'
+
+FIELD = 'traceparent'
+
+_service = None
+_output = None
+_output_mutex = threading.Lock()
+_local = threading.local()
+
+
+class SpanContext(object):
+
+    __slots__ = ('trace_id', 'span_id')
+
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    def traceparent(self):
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    @classmethod
+    def parse(cls, value):
+        """Return the context of a traceparent, or None if it is invalid."""
+        try:
+            version, trace_id, span_id, flags = value.split('-')
+            int(trace_id, 16)
+            int(span_id, 16)
+        except (AttributeError, ValueError):
+            return None
+        if len(trace_id) != 32 or len(span_id) != 16:
+            return None
+        return cls(trace_id, span_id)
+
+
+def _new_id(bits):
+    return '{:0{}x}'.format(random.getrandbits(bits), bits // 4)
+
+
+class Span(object):
+    """A timed operation; ends when its `with` block exits or on end()."""
+
+    def __init__(self, name, parent=None, kind=None, tags=None):
+        self.name = name
+        self.kind = kind
+        self.tags = dict(tags or {})
+        self.parent_id = parent.span_id if parent is not None else None
+        trace_id = parent.trace_id if parent is not None else _new_id(128)
+        self.context = SpanContext(trace_id, _new_id(64))
+        self.started = time.time()
+        self.ended = None
+
+    def tag(self, key, value):
+        self.tags[key] = value
+
+    def end(self):
+        if self.ended is not None:
+            return
+        self.ended = time.time()
+        _write(self)
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = list()
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.stack.pop()
+        if exc_type is not None:
+            self.tags['error'] = repr(exc_value)
+        self.end()
+
+    def to_zipkin(self):
+        record = {
+            'traceId': self.context.trace_id,
+            'id': self.context.span_id,
+            'name': self.name,
+            'timestamp': int(self.started * 1000000),
+            'duration': max(int((self.ended - self.started) * 1000000), 1),
+            'localEndpoint': {'serviceName': _service},
+            'tags': dict((k, str(v)) for k, v in self.tags.items()),
+        }
+        if self.parent_id is not None:
+            record['parentId'] = self.parent_id
+        if self.kind is not None:
+            record['kind'] = self.kind
+        return record
+
+
+def current():
+    """Return the innermost open span of this thread, or None."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def span(name, parent=None, kind=None, **tags):
+    """Start a span under `parent`, or under the current span if None.
+
+    `parent` may be a Span or a SpanContext.
+    """
+    if parent is None:
+        parent = current()
+    if isinstance(parent, Span):
+        parent = parent.context
+    return Span(name, parent, kind, tags)
+
+
+def inject(payload_json, parent=None):
+    """Carry the context of `parent`, or of the current span, in a payload."""
+    if parent is None:
+        parent = current()
+    if isinstance(parent, Span):
+        parent = parent.context
+    if parent is not None:
+        payload_json[FIELD] = parent.traceparent()
+    return payload_json
+
+
+def extract(data):
+    """Return the SpanContext a payload carries, or None."""
+    return SpanContext.parse(data.get(FIELD))
+
+
+def _write(finished):
+    if _output is None:
+        return
+    line = json.dumps(finished.to_zipkin()) + '\n'
+    with _output_mutex:
+        _output.write(line)
+
+
+def configure(service, path=None):
+    """Name this process in its spans and write them to `path`, if given."""
+    global _service, _output
+    _service = service
+    if path:
+        # Line buffered, so every span is one append and processes sharing
+        # the file do not interleave within a line.
+        _output = io.open(path, 'a', buffering=1)
+
+
+def add_arguments(parser):
+    """Add the tracing flags shared by the scripts to an argparse parser."""
+    parser.add_argument(
+        '--span_file',
+        default=None,
+        help='Append the spans of this process to this file as Zipkin v2 JSON.')
+
+
+def read_spans(paths):
+    spans = list()
+    for path in paths:
+        with io.open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    spans.append(json.loads(line))
+    return spans
+
+
+def traces(spans):
+    """Group spans by trace id."""
+    grouped = dict()
+    for record in spans:
+        grouped.setdefault(record['traceId'], list()).append(record)
+    return grouped
+
+
+def trace_duration(records):
+    start = min(r['timestamp'] for r in records)
+    return max(r['timestamp'] + r['duration'] for r in records) - start
+
+
+def format_trace(records):
+    """Return the span tree of one trace, one span per line.
+
+    Each line gives the span's start relative to the trace and its duration
+    in milliseconds; a gap between a span and its parent's previous child is
+    time spent waiting, e.g. for a bid window or a config delay.
+    """
+    start = min(r['timestamp'] for r in records)
+    ids = set(r['id'] for r in records)
+    children = dict()
+    for record in records:
+        parent = record.get('parentId')
+        children.setdefault(parent if parent in ids else None, list()).append(record)
+    lines = list()
+
+    def visit(parent, depth):
+        for record in sorted(children.get(parent, ()), key=lambda r: r['timestamp']):
+            lines.append('{:>10.1f} {:>10.1f}  {}{} [{}]'.format(
+                (record['timestamp'] - start) / 1000.0,
+                record['duration'] / 1000.0,
+                '  ' * depth, record['name'],
+                record['localEndpoint'].get('serviceName')))
+            visit(record['id'], depth + 1)
+
+    visit(None, 0)
+    return lines
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(
+        description='Show or convert the spans written with --span_file.')
+    parser.add_argument('paths', nargs='+', help='Span files to read.')
+    parser.add_argument(
+        '--trace_id', default=None, help='Show the trace with this id.')
+    parser.add_argument(
+        '--slowest', type=int, default=1, help='Show this many slowest traces.')
+    parser.add_argument(
+        '--zipkin',
+        default=None,
+        help='Write all spans to this file as one Zipkin v2 JSON array.')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    spans = read_spans(args.paths)
+    if args.zipkin:
+        with io.open(args.zipkin, 'w') as f:
+            json.dump(spans, f)
+        return
+    grouped = traces(spans)
+    if args.trace_id:
+        selected = [args.trace_id]
+    else:
+        selected = sorted(grouped, key=lambda t: trace_duration(grouped[t]),
+                          reverse=True)[:args.slowest]
+    for trace_id in selected:
+        records = grouped.get(trace_id, [])
+        print('Trace {}: {} spans, {:.1f} ms'.format(
+            trace_id, len(records),
+            trace_duration(records) / 1000.0 if records else 0))
+        print('{:>10} {:>10}  {}'.format('start ms', 'ms', 'span'))
+        for line in format_trace(records):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Tests for the trace context and spans."""
+
+import pytest
+
+import tracing
+
+
+@pytest.fixture
+def span_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(tracing, '_service', None)
+    monkeypatch.setattr(tracing, '_output', None)
+    path = str(tmp_path / 'spans.jsonl')
+    tracing.configure('rek-0', path)
+    yield path
+    tracing._output.close()
+
+
+def test_nested_spans_share_the_trace_and_link_parents():
+    with tracing.span('handle REKACK') as outer:
+        assert tracing.current() is outer
+        with tracing.span('detect_labels', kind=tracing.CLIENT) as inner:
+            assert tracing.current() is inner
+        assert tracing.current() is outer
+    assert tracing.current() is None
+
+    assert outer.parent_id is None
+    assert inner.parent_id == outer.context.span_id
+    assert inner.context.trace_id == outer.context.trace_id
+    assert len(outer.context.trace_id) == 32
+    assert inner.context.span_id != outer.context.span_id
+
+
+def test_context_travels_in_payloads():
+    payload = {'type': 'REKRES'}
+    assert tracing.inject(payload) == {'type': 'REKRES'}
+    with tracing.span('handle REK') as sent:
+        tracing.inject(payload)
+    assert payload[tracing.FIELD] == '00-{}-{}-01'.format(
+        sent.context.trace_id, sent.context.span_id)
+
+    received = tracing.span('handle REKRES', parent=tracing.extract(payload))
+    assert received.parent_id == sent.context.span_id
+    assert received.context.trace_id == sent.context.trace_id
+
+    assert tracing.extract({}) is None
+    assert tracing.extract({tracing.FIELD: '00-abc-def-01'}) is None
+
+
+def test_spans_are_written_as_zipkin(span_file):
+    with tracing.span('handle POLACK', device='dev-0') as parent:
+        with pytest.raises(ValueError):
+            with tracing.span('SynthesizeSpeech', kind=tracing.CLIENT):
+                raise ValueError('throttled')
+
+    spans = tracing.read_spans([span_file])
+    assert [record['name'] for record in spans] == ['SynthesizeSpeech', 'handle POLACK']
+    child, root = spans
+    assert child['parentId'] == parent.context.span_id == root['id']
+    assert 'parentId' not in root
+    assert child['kind'] == tracing.CLIENT
+    assert child['tags']['error'] == "ValueError('throttled')"
+    assert root['tags'] == {'device': 'dev-0'}
+    assert root['localEndpoint'] == {'serviceName': 'rek-0'}
+
+
+def test_format_trace_indents_children():
+    records = [
+        {'traceId': 't', 'id': 'a', 'name': 'REK', 'timestamp': 0,
+         'duration': 3000, 'localEndpoint': {'serviceName': 'dev-0'}},
+        {'traceId': 't', 'id': 'b', 'parentId': 'a', 'name': 'bid',
+         'timestamp': 1000, 'duration': 1000, 'localEndpoint': {'serviceName': 'rek-0'}},
+    ]
+    lines = tracing.format_trace(records)
+    assert lines[0].endswith('  REK [dev-0]')
+    assert lines[1].endswith('    bid [rek-0]')
+    assert tracing.trace_duration(records) == 3000
+    assert list(tracing.traces(records)) == ['t']
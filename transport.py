@@ -0,0 +1,429 @@
+"""Selects the cloud services the scripts talk to.
+
+With the google transport the scripts use the Pub/Sub clients, the paho
+MQTT client for the Cloud IoT bridge and the Cloud IoT admin API as before.
+With the local transport the same calls go to the broker in localbus.py,
+through clients that mimic the parts of those APIs the scripts use, so the
+whole device, rekognition, polly and DApp flow runs on one machine.
+
+Each script calls configure() once with its --transport and --local_broker
+flags and then builds its clients with the functions below.
+"""
+
+import base64
+import datetime
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import localbus
+
+GOOGLE = 'google'
+LOCAL = 'local'
+TRANSPORTS = (GOOGLE, LOCAL)
+
+# Defaults of the Pub/Sub client library.
+MAX_OUTSTANDING_MESSAGES = 1000
+CALLBACK_THREADS = 10
+
+_transport = GOOGLE
+_address = localbus.DEFAULT_ADDRESS
+_broker = None
+_broker_mutex = threading.Lock()
+
+log = logging.getLogger(__name__)
+
+
+def configure(transport, address=None):
+    global _transport, _address
+    _transport = transport
+    if address:
+        _address = localbus.parse_address(address)
+
+
+def is_local():
+    return _transport == LOCAL
+
+
+def broker():
+    """Return this process's connection to the local broker."""
+    global _broker
+    with _broker_mutex:
+        if _broker is None:
+            _broker = localbus.connect(_address)
+        return _broker
+
+
+def publisher_client():
+    if not is_local():
+        from google.cloud import pubsub_v1
+        return pubsub_v1.PublisherClient()
+    return LocalPublisher(broker())
+
+
+def subscriber_client():
+    if not is_local():
+        from google.cloud import pubsub
+        return pubsub.SubscriberClient()
+    return LocalSubscriber(broker())
+
+
+def scheduler(workers):
+    """Return a subscriber scheduler running callbacks on `workers` threads.
+
+    Every subscription given its own scheduler gets a worker pool of its
+    own, instead of the default pool of CALLBACK_THREADS.
+    """
+    if not is_local():
+        from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+        return ThreadScheduler(ThreadPoolExecutor(max_workers=workers))
+    return LocalScheduler(workers)
+
+
+def mqtt_client(client_id):
+    if not is_local():
+        import paho.mqtt.client as mqtt
+        return mqtt.Client(client_id=client_id)
+    return LocalMqttClient(broker(), client_id)
+
+
+def cloudiot_service():
+    """Return a stand-in for the Cloud IoT admin API of the local broker."""
+    return LocalCloudIot(broker())
+
+
+def _api_error(error):
+    from google.api_core import exceptions
+    if error.status == 409:
+        # The gRPC API reports an existing resource as ALREADY_EXISTS.
+        return exceptions.AlreadyExists(error.message)
+    return exceptions.from_http_status(error.status, error.message)
+
+
+def _http_error(error):
+    import httplib2
+    from googleapiclient.errors import HttpError
+    response = httplib2.Response({'status': error.status})
+    response.reason = error.message
+    return HttpError(response, error.message.encode('utf-8'))
+
+
+class LocalPublisher(object):
+    """The subset of pubsub_v1.PublisherClient used by the scripts."""
+
+    def __init__(self, bus):
+        self._bus = bus
+
+    @staticmethod
+    def topic_path(project, topic):
+        return 'projects/{}/topics/{}'.format(project, topic)
+
+    def publish(self, topic, data, **attributes):
+        if not isinstance(data, bytes):
+            raise TypeError('Data being published to Pub/Sub must be sent '
+                            'as a bytestring.')
+        future = Future()
+        try:
+            future.set_result(self._bus.publish(topic, data, attributes))
+        except localbus.BusError as e:
+            future.set_exception(_api_error(e))
+        return future
+
+
+class LocalMessage(object):
+    """A received Pub/Sub message that is acked back to the local broker."""
+
+    def __init__(self, stream, ack_id, message_id, data, attributes,
+                 publish_time, delivery_attempt):
+        self._stream = stream
+        self._ack_id = ack_id
+        self.message_id = message_id
+        self.data = data
+        self.attributes = attributes
+        self.publish_time = datetime.datetime.utcfromtimestamp(publish_time)
+        self.delivery_attempt = delivery_attempt
+
+    def ack(self):
+        self._stream.settle(self._ack_id, True)
+
+    def nack(self):
+        self._stream.settle(self._ack_id, False)
+
+
+class StreamingPull(object):
+    """Pulls a subscription and runs the callback, like a streaming pull.
+
+    At most `max_messages` messages are leased at once, and their leases
+    are extended while the callback runs. A callback that raises nacks its
+    message, as in the client library.
+    """
+
+    def __init__(self, bus, subscription, callback, max_messages,
+                 workers=CALLBACK_THREADS):
+        self._bus = bus
+        self._subscription = subscription
+        self._callback = callback
+        self._max_messages = max_messages
+        self._outstanding = set()
+        self._mutex = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._future = Future()
+        for target in (self._pull, self._lease):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _pull(self):
+        while not self._future.done():
+            with self._mutex:
+                while len(self._outstanding) >= self._max_messages:
+                    self._mutex.wait(1.0)
+                capacity = self._max_messages - len(self._outstanding)
+            try:
+                pulled = self._bus.pull(self._subscription, capacity, 1.0)
+            except localbus.BusError as e:
+                self._finish(_api_error(e))
+                return
+            for received in pulled:
+                message = LocalMessage(self, *received)
+                with self._mutex:
+                    self._outstanding.add(message._ack_id)
+                self._executor.submit(self._run, message)
+
+    def _run(self, message):
+        try:
+            self._callback(message)
+        except Exception:
+            log.exception('Top-level exception occurred in callback while '
+                          'processing a message.')
+            message.nack()
+
+    def _lease(self):
+        while not self._future.done():
+            time.sleep(localbus.ACK_DEADLINE / 2.0)
+            with self._mutex:
+                ack_ids = list(self._outstanding)
+            if ack_ids:
+                self._bus.modify_ack_deadline(
+                    self._subscription, ack_ids, localbus.ACK_DEADLINE)
+
+    def settle(self, ack_id, ack):
+        with self._mutex:
+            if ack_id not in self._outstanding:
+                return
+            self._outstanding.discard(ack_id)
+            self._mutex.notify_all()
+        if ack:
+            self._bus.ack(self._subscription, [ack_id])
+        else:
+            self._bus.modify_ack_deadline(self._subscription, [ack_id], 0)
+
+    def _finish(self, error=None):
+        if self._future.done():
+            return
+        if error is None:
+            self._future.set_result(None)
+        else:
+            self._future.set_exception(error)
+
+    def cancel(self):
+        self._finish()
+        self._executor.shutdown(wait=False)
+
+    def result(self, timeout=None):
+        return self._future.result(timeout)
+
+
+class LocalSubscriber(object):
+    """The subset of pubsub.SubscriberClient used by the scripts."""
+
+    def __init__(self, bus):
+        self._bus = bus
+
+    @staticmethod
+    def subscription_path(project, subscription):
+        return 'projects/{}/subscriptions/{}'.format(project, subscription)
+
+    @staticmethod
+    def topic_path(project, topic):
+        return 'projects/{}/topics/{}'.format(project, topic)
+
+    def create_subscription(self, name, topic, filter_=None):
+        try:
+            self._bus.create_subscription(name, topic, filter_)
+        except localbus.BusError as e:
+            raise _api_error(e)
+
+    def subscribe(self, subscription, callback, flow_control=None,
+                  scheduler=None):
+        max_messages = MAX_OUTSTANDING_MESSAGES
+        if flow_control is not None and flow_control.max_messages:
+            max_messages = flow_control.max_messages
+        workers = CALLBACK_THREADS
+        if scheduler is not None:
+            workers = scheduler.workers
+        return StreamingPull(self._bus, subscription, callback, max_messages,
+                             workers)
+
+
+class LocalScheduler(object):
+    """Stands in for a ThreadScheduler with its own pool of `workers`."""
+
+    def __init__(self, workers):
+        self.workers = workers
+
+
+class _Request(object):
+
+    def __init__(self, call):
+        self._call = call
+
+    def execute(self):
+        try:
+            return self._call()
+        except localbus.BusError as e:
+            raise _http_error(e)
+
+
+class LocalCloudIot(object):
+    """The device config methods of the Cloud IoT admin API.
+
+    Stands in for the discovery client, so the scripts keep calling
+    projects().locations().registries().devices().
+    """
+
+    def __init__(self, bus):
+        self._bus = bus
+
+    def projects(self):
+        return self
+
+    def locations(self):
+        return self
+
+    def registries(self):
+        return self
+
+    def devices(self):
+        return self
+
+    def modifyCloudToDeviceConfig(self, name, body):
+        data = base64.b64decode(body.get('binary_data', body.get('binaryData', '')))
+        version = int(body.get('version_to_update', body.get('versionToUpdate', 0)))
+        return _Request(lambda: self._bus.update_config(name, data, version))
+
+    def get(self, name, fieldMask=None):
+        return _Request(lambda: {'name': name, 'config': self._bus.get_config(name)})
+
+    def configVersions(self):
+        return _LocalConfigVersions(self._bus)
+
+
+class _LocalConfigVersions(object):
+
+    def __init__(self, bus):
+        self._bus = bus
+
+    def list(self, name, numVersions=0):
+        count = numVersions or localbus.CONFIG_HISTORY
+        return _Request(lambda: {'deviceConfigs': self._bus.config_versions(name, count)})
+
+
+class LocalMqttMessage(object):
+
+    def __init__(self, topic, payload, qos, mid):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.mid = mid
+        self.retain = False
+
+
+class LocalMqttClient(object):
+    """The subset of paho's mqtt.Client used with the Cloud IoT bridge.
+
+    Subscribing to the device's config topic delivers its latest config,
+    and every newer version after that, and acks each one once on_message
+    returns. Callbacks run on the loop thread, as in paho.
+    """
+
+    def __init__(self, bus, client_id):
+        self._bus = bus
+        self._device = client_id
+        self._mids = itertools.count(1)
+        self._config_topic = None
+        self._config_qos = 0
+        self._pending = list()
+        self._running = False
+        self._thread = None
+        self._userdata = None
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_publish = None
+        self.on_subscribe = None
+        self.on_message = None
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def tls_set(self, *args, **kwargs):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        self._pending.append(
+            lambda: self.on_connect and self.on_connect(self, self._userdata, {}, 0))
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        mid = next(self._mids)
+        device_id = self._device.rsplit('/', 1)[-1]
+        if topic.rstrip('/') == '/devices/{}/config'.format(device_id):
+            self._config_topic = topic
+            self._config_qos = qos
+            granted = (qos,)
+        else:
+            # Only the config topic is emulated.
+            granted = (128,)
+        self._pending.append(
+            lambda: self.on_subscribe and self.on_subscribe(
+                self, self._userdata, mid, granted))
+        return 0, mid
+
+    def loop_start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def loop_stop(self):
+        self._running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def disconnect(self):
+        self._pending.append(
+            lambda: self.on_disconnect and self.on_disconnect(self, self._userdata, 0))
+        return 0
+
+    def _loop(self):
+        version = -1
+        while self._running or self._pending:
+            while self._pending:
+                self._pending.pop(0)()
+            if not self._running or self._config_topic is None:
+                time.sleep(0.1)
+                continue
+            config = self._bus.wait_config(self._device, version, 0.5)
+            if config is None:
+                continue
+            version, data = config
+            message = LocalMqttMessage(
+                self._config_topic, data, self._config_qos, next(self._mids))
+            if self.on_message is not None:
+                try:
+                    self.on_message(self, self._userdata, message)
+                except Exception as e:
+                    log.error('Caught exception in on_message: %s', e)
+            self._bus.ack_config(self._device, version)